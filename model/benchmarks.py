@@ -0,0 +1,316 @@
+#!/usr/bin/python
+
+""" Throughput and memory benchmarks of the model's hot paths, run on CPU with synthetic data.
+
+    Each benchmark runs in a fresh subprocess, so that its memory use is not confounded by that of the others,
+    and the results of all of them are emitted as a single JSON document so that regressions can be tracked
+    over time. Peak memory is measured from the peak resident set size of the subprocess, as the CPU allocator
+    does not keep track of its own peak.
+"""
+
+__author__ = "Mohammed AlQuraishi"
+__copyright__ = "Copyright 2018, Harvard Medical School"
+__license__ = "MIT"
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import OrderedDict
+from shutil import rmtree
+
+import numpy as np
+import tensorflow as tf
+
+from config import RGNConfig
+from geom_ops import dihedral_to_point, point_to_coordinate, pairwise_distance, drmsd
+from model import RGNModel
+from net_ops import read_protein, curriculum_weights, weighting_matrix
+from synthetic_data import write_shard
+
+# constants
+RECURRENT_UNITS = ['Basic', 'GRU', 'LSTM', 'LNLSTM', 'LSTMBlock']  # cuDNN units are GPU-only
+NUM_EVO_ENTRIES = 20
+NUM_SYNTHETIC_RECORDS = 64
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+
+def write_synthetic_proteins(filename, length):
+    """ Writes NUM_SYNTHETIC_RECORDS synthetic proteins of the given length as TF Records. """
+
+    write_shard(filename, NUM_SYNTHETIC_RECORDS, 0, min_length=length, max_length=length,
+                length_distribution='uniform', num_evo_entries=NUM_EVO_ENTRIES)
+
+
+def _random_variable(shape, low=-np.pi, high=np.pi):
+    # variables, unlike constants, keep grappler from folding the benchmarked ops away
+    return tf.Variable(np.random.uniform(low, high, shape).astype(np.float32), trainable=False)
+
+
+def _random_coordinates(length, batch_size):
+    return tf.Variable(point_to_coordinate(dihedral_to_point(_random_variable([length, batch_size, 3]))),
+                       trainable=False)
+
+
+# benchmarks. each sets up its graph in session and returns a function performing one run, along with
+# the number of units processed per run and their name.
+def benchmark_dihedral_to_point(session, data_dir, length, batch_size):
+    points = dihedral_to_point(_random_variable([length, batch_size, 3]))
+    session.run(tf.global_variables_initializer())
+
+    return session.make_callable(points.op), length * batch_size, 'residues'
+
+
+def benchmark_point_to_coordinate(session, data_dir, length, batch_size, num_fragments):
+    points = tf.Variable(dihedral_to_point(_random_variable([length, batch_size, 3])), trainable=False)
+    coordinates = point_to_coordinate(points, num_fragments=num_fragments)
+    session.run(tf.global_variables_initializer())
+
+    return session.make_callable(coordinates.op), length * batch_size, 'residues'
+
+
+def benchmark_pairwise_distance(session, data_dir, length, batch_size):
+    distances = pairwise_distance(_random_coordinates(length, batch_size))
+    session.run(tf.global_variables_initializer())
+
+    return session.make_callable(distances.op), length * batch_size, 'residues'
+
+
+def benchmark_drmsd(session, data_dir, length, batch_size):
+    weights = tf.tile(weighting_matrix(curriculum_weights(base=float(length), slope=1., max_seq_length=length))[...,
+                      tf.newaxis], [1, 1, batch_size])
+    drmsds = drmsd(_random_coordinates(length, batch_size), _random_coordinates(length, batch_size), weights)
+    session.run(tf.global_variables_initializer())
+
+    return session.make_callable(drmsds.op), length * batch_size, 'residues'
+
+
+def benchmark_weighting_matrix(session, data_dir, length):
+    base = tf.Variable(float(length), trainable=False)  # a variable, like the curriculum step, so it isn't folded
+    matrix = weighting_matrix(curriculum_weights(base=base, slope=1., max_seq_length=length))
+    session.run(tf.global_variables_initializer())
+
+    return session.make_callable(matrix.op), 1, 'matrices'
+
+
+def benchmark_weighting_matrix_construction(session, data_dir, length):
+    # times building the ops in a fresh graph, which loops over the diagonals of the matrix in python
+    def construct():
+        with tf.Graph().as_default():
+            weighting_matrix(curriculum_weights(base=float(length), slope=1., max_seq_length=length))
+
+    return construct, 1, 'matrices'
+
+
+def benchmark_read_protein(session, data_dir, length):
+    filename = os.path.join(data_dir, 'proteins')
+    write_synthetic_proteins(filename, length)
+
+    filename_queue = tf.train.string_input_producer([filename])
+    protein = read_protein(filename_queue, length, 0, NUM_EVO_ENTRIES)
+    tf.train.start_queue_runners(session)
+
+    return session.make_callable([tensor.op for tensor in protein]), 1, 'records'
+
+
+def _model_config(data_dir, length, batch_size, recurrent_unit, recurrent_size, num_cpus):
+    filename = os.path.join(data_dir, 'proteins')
+    write_synthetic_proteins(filename, length)
+
+    config = RGNConfig(config={'checkpointsDirectory': os.path.join(data_dir, 'checkpoints', ''),
+                               'logModelSummaries': False,
+                               'recurrentUnit': recurrent_unit,
+                               'recurrentSize': [recurrent_size],
+                               'batchSize': batch_size,
+                               'maxSeqLength': length,
+                               'numEdgeResidues': 0,
+                               'minAfterDequeue': batch_size,
+                               'numCPUs': num_cpus,
+                               'trainingDevice': 'CPU',
+                               'evaluationDevice': 'CPU'})
+    config.io['data_files'] = [filename]
+
+    return config
+
+
+def benchmark_training(session, data_dir, length, batch_size, recurrent_unit, recurrent_size, num_cpus):
+    config = _model_config(data_dir, length, batch_size, recurrent_unit, recurrent_size, num_cpus)
+    training_model = RGNModel('training', config)
+    training_model.start([], session, False)
+
+    return lambda: training_model.train(session), batch_size, 'proteins'
+
+
+def benchmark_prediction(session, data_dir, length, batch_size, recurrent_unit, recurrent_size, num_cpus):
+    config = _model_config(data_dir, length, batch_size, recurrent_unit, recurrent_size, num_cpus)
+    training_model = RGNModel('training', config)
+    evaluation_model = RGNModel('evaluation', config)
+    training_model.start([evaluation_model], session, False)
+
+    return lambda: evaluation_model.predict(session), batch_size, 'proteins'
+
+
+def benchmark_cases(num_cpus):
+    """ Returns the list of (benchmark, parameters) pairs making up the suite. """
+
+    cases = []
+    for length in [100, 300, 700]:
+        cases.append(('dihedral_to_point', {'length': length, 'batch_size': 32}))
+    for length in [100, 300, 700]:
+        for num_fragments in [1, 6, 12]:
+            cases.append(('point_to_coordinate', {'length': length, 'batch_size': 32, 'num_fragments': num_fragments}))
+    for length in [100, 300, 700]:
+        cases.append(('pairwise_distance', {'length': length, 'batch_size': 32}))
+        cases.append(('drmsd', {'length': length, 'batch_size': 32}))
+    for length in [100, 300, 700]:
+        cases.append(('weighting_matrix', {'length': length}))
+        cases.append(('weighting_matrix_construction', {'length': length}))
+    for length in [100, 300]:
+        cases.append(('read_protein', {'length': length}))
+    for recurrent_unit in RECURRENT_UNITS:
+        cases.append(('training', {'length': 100, 'batch_size': 16, 'recurrent_unit': recurrent_unit,
+                                   'recurrent_size': 64, 'num_cpus': num_cpus}))
+    cases.append(('prediction', {'length': 100, 'batch_size': 16, 'recurrent_unit': 'LSTM',
+                                 'recurrent_size': 64, 'num_cpus': num_cpus}))
+
+    return cases
+
+
+# running of benchmarks
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.  # ru_maxrss is in KB on Linux
+
+
+def run_benchmark(name, params, min_time, min_runs, num_cpus):
+    """ Runs a single benchmark in the current process and returns its results. """
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        with tf.Graph().as_default():
+            session = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0},
+                                                       intra_op_parallelism_threads=num_cpus,
+                                                       inter_op_parallelism_threads=num_cpus))
+            baseline_rss = _peak_rss_mb()
+
+            # set up and warm up
+            start = time.time()
+            run, units, unit = globals()['benchmark_' + name](session, data_dir, **params)
+            run()
+            setup_time = time.time() - start
+
+            # time runs until both min_time and min_runs are reached
+            times = []
+            while sum(times) < min_time or len(times) < min_runs:
+                start = time.time()
+                run()
+                times.append(time.time() - start)
+            session.close()  # stops any queue runners
+    finally:
+        rmtree(data_dir)
+
+    return OrderedDict([('name', name),
+                        ('params', params),
+                        ('runs', len(times)),
+                        ('setup_seconds', setup_time),
+                        ('mean_seconds', np.mean(times)),
+                        ('median_seconds', np.median(times)),
+                        ('min_seconds', np.min(times)),
+                        ('throughput', units / np.median(times)),
+                        ('unit', unit + '/s'),
+                        ('peak_memory_mb', _peak_rss_mb() - baseline_rss),
+                        ('peak_rss_mb', _peak_rss_mb())])
+
+
+def run_suite(cases, args):
+    """ Runs each benchmark in its own subprocess and returns the list of results. """
+
+    results = []
+    for name, params in cases:
+        print >> sys.stderr, 'Benchmarking ' + name + ' ' + json.dumps(params, sort_keys=True)
+        try:
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                              '--case', json.dumps([name, params]),
+                                              '-t', str(args.min_time),
+                                              '-r', str(args.min_runs),
+                                              '-n', str(args.num_cpus)],
+                                             env=dict(os.environ, CUDA_VISIBLE_DEVICES=''))
+            results.append(json.loads(output.splitlines()[-1], object_pairs_hook=OrderedDict))
+        except subprocess.CalledProcessError as e:
+            results.append(OrderedDict([('name', name), ('params', params), ('error', e.returncode)]))
+
+    return results
+
+
+def environment():
+    """ Returns a description of the environment the benchmarks are run in. """
+
+    return OrderedDict([('time', time.strftime('%Y-%m-%d %H:%M:%S')),
+                        ('host', platform.node()),
+                        ('platform', platform.platform()),
+                        ('processor', platform.processor()),
+                        ('python', platform.python_version()),
+                        ('tensorflow', tf.__version__),
+                        ('numpy', np.__version__)])
+
+
+# main
+if __name__ == '__main__':
+    # parse command-line arguments
+    parser = argparse.ArgumentParser(description="Benchmark the throughput and memory use of RGN hot paths on CPU.")
+
+    parser.add_argument('-b',
+                        '--benchmark',
+                        action='append',
+                        help='benchmark to run (more than one is allowed). default is to run all of them. '
+                             + 'must be one of: ' + ', '.join(OrderedDict(benchmark_cases(1)).keys()) + '.')
+
+    parser.add_argument('-o',
+                        '--output',
+                        help='file to write JSON results to. default is stdout.')
+
+    # noinspection PyTypeChecker
+    parser.add_argument('-t',
+                        '--min_time',
+                        type=float,
+                        default=2.,
+                        help='minimum number of seconds each benchmark is timed for')
+
+    # noinspection PyTypeChecker
+    parser.add_argument('-r',
+                        '--min_runs',
+                        type=int,
+                        default=5,
+                        help='minimum number of timed runs of each benchmark')
+
+    # noinspection PyTypeChecker
+    parser.add_argument('-n',
+                        '--num_cpus',
+                        type=int,
+                        default=4,
+                        help='number of CPU threads TF uses for intra- and inter-op parallelism')
+
+    parser.add_argument('--case',
+                        help=argparse.SUPPRESS)  # internal: runs a single JSON-encoded [name, params] case
+
+    args = parser.parse_args()
+
+    if args.case is not None:
+        name, params = json.loads(args.case)
+        print json.dumps(run_benchmark(name, params, args.min_time, args.min_runs, args.num_cpus))
+    else:
+        cases = [(name, params) for name, params in benchmark_cases(args.num_cpus)
+                 if args.benchmark is None or name in args.benchmark]
+        results = json.dumps(OrderedDict([('environment', environment()),
+                                          ('benchmarks', run_suite(cases, args))]), indent=4)
+        if args.output is None:
+            print results
+        else:
+            with open(args.output, 'w') as f:
+                f.write(results)
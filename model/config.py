@@ -71,10 +71,16 @@ class RGNConfig(Config):
                    'detailed_logs': str_or_bool(config.get('detailedLogs', True)),
                    'max_checkpoints': int_or_none(config.get('maxCheckpoints', None)),
                    'checkpoint_every_n_hours': int(
-                       config.get('checkpointEveryNHours', 24))}  # this is in addition to the max_checkpoints
+                       config.get('checkpointEveryNHours', 24)),  # this is in addition to the max_checkpoints
+                   'checkpoint_base_frequency': int(config.get('checkpointBaseFrequency', 1)),  # 1 is no deltas
+                   'prediction_outputs': eval_if_str(config.get('predictionOutputs', ['tertiary', 'recurrent_states'])),
+                   'recurrent_states_dtype': config.get('recurrentStatesDtype', 'float32'),
+                   'predict_primary': str_or_bool(config.get('predictPrimary', False)),  # set for structure formats
+                   'ensemble_prediction': str_or_bool(config.get('ensemblePrediction', False))}  # set for ensembles
 
         # compute-related issues 
         self.computing = {'num_cpus': int(config.get('numCPUs', 4)),
+                          'num_restore_shards': int(config.get('numRestoreShards', 1)),
                           'num_recurrent_shards': int(config.get('numRecurrentShards', 1)),
                           'num_recurrent_parallel_iters': int(config.get('numRecurrentParallelIters', 32)),
                           'default_device': config.get('defaultDevice', ''),
@@ -133,6 +139,8 @@ class RGNConfig(Config):
                          'batch_queue_capacity': int(config.get('batchQueueCapacity', 10000)),
                          'min_after_dequeue': int(config.get('minAfterDequeue', 500)),
                          'shuffle': str_or_bool(config.get('shuffle', True)),
+                         'cache_data': str_or_bool(config.get('cacheData', False)),
+                         'exact_evaluation': str_or_bool(config.get('exactEvaluation', False)),
                          'bucket_boundaries': eval_if_str(config.get('bucketBoundaries', None)),
                          'num_evaluation_invocations': int(config.get('numEvaluationInvocations', 1))}
 
@@ -222,11 +230,19 @@ class RunConfig(Config):
                    'sample_testing_glob': config.get('sampleTestingGlob', '*'),
                    'evaluation_frequency': int(config.get('evaluationFrequency', 10)),
                    'prediction_frequency': int(config.get('predictionFrequency', 100)),
-                   'checkpoint_frequency': int(config.get('checkpointFrequency', 10000))}
+                   'checkpoint_frequency': int(config.get('checkpointFrequency', 10000)),
+                   'prediction_format': config.get('predictionFormat', 'text'),  # text, npy, npz, store, pdb, cif
+                   'asynchronous_predictions': str_or_bool(config.get('asynchronousPredictions', False)),
+                   'prediction_queue_capacity': int(config.get('predictionQueueCapacity', 2)),
+                   'asynchronous_checkpoints': str_or_bool(config.get('asynchronousCheckpoints', False)),
+                   'cache_graph': str_or_bool(config.get('cacheGraph', False)),
+                   'trace_frequency': int_or_none(config.get('traceFrequency', None))}
 
         # compute-related issues
         self.computing = {'training_device': config.get('trainingDevice', 'GPU'),
-                          'evaluation_device': config.get('evaluationDevice', 'GPU')}
+                          'evaluation_device': config.get('evaluationDevice', 'GPU'),
+                          'fuse_step_fetches': str_or_bool(config.get('fuseStepFetches', False)),
+                          'steps_between_checks': int(config.get('stepsBetweenChecks', 1))}
 
         # optimization
         self.optimization = {'validation_milestone': eval_if_str(config.get('validationMilestone', {})),
@@ -242,7 +258,8 @@ class RunConfig(Config):
                          'training_min_after_dequeue': int(config.get('trainingMinAfterDequeue', 500)),
                          'evaluation_min_after_dequeue': int(config.get('evaluationMinAfterDequeue', 10)),
                          'training_shuffle': str_or_bool(config.get('trainingShuffle', True)),
-                         'evaluation_shuffle': str_or_bool(config.get('evaluationShuffle', False))}
+                         'evaluation_shuffle': str_or_bool(config.get('evaluationShuffle', False)),
+                         'evaluation_cache_data': str_or_bool(config.get('evaluationCacheData', False))}
 
         # evaluation
         self.evaluation = {'num_training_samples': int(config.get('numTrainingSamples', 98)),
@@ -259,7 +276,9 @@ class RunConfig(Config):
                            'include_unweighted_validation': str_or_bool(
                                config.get('includeUnweightedValidation', False)),
                            'include_unweighted_testing': str_or_bool(config.get('includeUnweightedTesting', False)),
-                           'include_diagnostics': str_or_bool(config.get('includeDiagnostics', True))}
+                           'include_diagnostics': str_or_bool(config.get('includeDiagnostics', True)),
+                           'asynchronous_evaluation': str_or_bool(config.get('asynchronousEvaluation', False)),
+                           'exact_evaluation': str_or_bool(config.get('exactEvaluation', False))}
 
         # loss
         self.loss = {'training_tertiary_normalization': config.get('trainingTertiaryNormalization', 'first'),
@@ -12,14 +12,21 @@ __author__ = "Mohammed AlQuraishi"
 __copyright__ = "Copyright 2018, Harvard Medical School"
 __license__ = "MIT"
 
+import cPickle
+import hashlib
 import os
+import time
+from collections import namedtuple
 from copy import deepcopy
+from functools import partial
 from glob import glob
 from itertools import izip_longest
+from pprint import pformat
 
 import tensorflow.contrib.layers as layers
 from tensorflow.contrib.cudnn_rnn.python.layers import cudnn_rnn
 from tensorflow.contrib.cudnn_rnn.python.ops import cudnn_rnn_ops
+from tensorflow.python.client import timeline
 from tensorflow.python.ops import control_flow_ops
 
 import rnn_cell_extended
@@ -33,6 +40,22 @@ SCOPE = 'RGN'
 DUMMY_LOSS = -1.
 PREFETCH_BUFFER = 10
 LOSS_SCALING_FACTOR = 0.01  # this is to convert recorded losses to angstroms
+UNWEIGHTED_PREFIX = 'unweighted_'  # prefix of losses computed for the unweighted counterpart of a shared model
+DELTA_CHECKPOINT_SUFFIX = '.delta.npz'  # appended to the prefix of the full checkpoint that a delta is taken against
+FULL_TRACE_OPTIONS = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+TIMELINE_SUFFIX = '.timeline.json'  # appended to trace prefixes, in Chrome trace format
+TRACE_SUMMARY_SUFFIX = '.ops.txt'  # appended to trace prefixes
+TRACE_MEMORY_SUFFIX = '.memory.txt'  # appended to trace prefixes
+BATCH_SUMMARIES = 'batch_summaries'  # collection of summaries of tensors of a batch, suffixed to model names
+STATE_DIAGNOSTICS = ['min_weight', 'max_weight', 'curriculum_step', 'alphabet']  # read variables updated by training
+TRACE_SCOPE_DEPTH = 3  # depth of the name scopes op times are summarized by, e.g. RGN/training/point_to_coordinate
+# attributes that refer to the graph, and are saved with cached graphs
+GRAPH_STATE_ATTRIBUTES = ['_training_ops', '_diagnostic_ops', '_full_diagnostic_ops', '_grads_and_vars_length',
+                          '_global_step', '_evaluation_ops', '_last_evaluation_ops', '_prediction_ops',
+                          '_exact_evaluation_ops', '_last_batch_ops', '_exact_losses', '_loss_groups',
+                          '_evaluation_state_ops', '_evaluated_losses', '_data_ops', '_ensemble_input_ops',
+                          '_ensemble_member_ops', '_ensemble_dihedrals', '_ensemble_coordinates', '_pipeline_ops',
+                          '_saver', '_restore_savers']
 
 
 class RGNModel(object):
@@ -44,9 +67,16 @@ class RGNModel(object):
     is_started = False
     _num_models = 0
 
-    def __init__(self, mode, config):
+    def __init__(self, mode, config, unweighted_config=None, cached_graph=None):
         """
         Sets up type of instance object and invokes TF graph creation function.
+
+        An evaluation model can optionally be shared with the unweighted counterpart of its loss curriculum,
+        whose config is then passed as unweighted_config. Both sets of losses are derived from the same
+        predicted structures, and the unweighted ones are returned with keys prefixed by UNWEIGHTED_PREFIX.
+
+        If a cached graph, as returned by load_graph, is passed, the model is bound to its part of the already
+        imported graph instead of creating it.
         """
 
         # make sure model hasn't been started, otherwise bail.
@@ -54,13 +84,17 @@ class RGNModel(object):
             # instance variables
             self.mode = mode
             self.config = deepcopy(config)
+            self.unweighted_config = deepcopy(unweighted_config)
 
             # set up and expose appropriate methods based on mode (for initial state)
             if mode == 'training':
                 self.start = self._start
             else:
                 self.evaluate = self._evaluate
+                self.update_evaluation_state = self._update_evaluation_state
                 self.predict = self._predict
+                if config.io['ensemble_prediction']:
+                    self.predict_ensemble = self._predict_ensemble
 
             # process config for derived properties
             io = self.config.io
@@ -76,6 +110,11 @@ class RGNModel(object):
             elif curr['mode'] is not None and curr['behavior'] is None:
                 raise RuntimeError('Curriculum behavior must be set when curriculum mode is set.')
 
+            # test for correct sharing configuration; only loss curricula leave the evaluated structures unchanged
+            if unweighted_config is not None and (mode != 'evaluation' or curr['mode'] != 'loss'
+                                                  or unweighted_config.curriculum['mode'] is not None):
+                raise RuntimeError('Only evaluation models with a loss curriculum can be shared with unweighted ones.')
+
             # model name
             if io['name'] is None:
                 io['name'] = 'model_' + str(RGNModel._num_models)
@@ -119,13 +158,25 @@ class RGNModel(object):
                 if type(reg[key]) is not list:
                     reg[key] = [reg[key]] * len(arch['recurrent_layer_size'])
 
-            # create graph
-            self._create_graph(mode, self.config)
+            # create graph, or bind to the cached one
+            self._graph_is_cached = cached_graph is not None
+            with timed('model ' + io['name']):
+                if self._graph_is_cached:
+                    self.__dict__.update(_names_to_graph_elements(cached_graph[io['name']]))
+                    if mode == 'training':
+                        self._coordinator = tf.train.Coordinator()
+                    if getattr(self, '_data_ops', None) is not None:
+                        # the data itself isn't cached with the graph, so it's read again from its files
+                        self._cached_data = _cached_data_arrays(
+                            merge_dicts(io, self.config.initialization, self.config.optimization, self.config.queueing),
+                            self.config.optimization['num_steps'], io['evaluation_sub_groups'])
+                else:
+                    self._create_graph(mode, self.config, self.unweighted_config)
 
         else:
             raise RuntimeError('Model already started; cannot create new objects.')
 
-    def _create_graph(self, mode, config):
+    def _create_graph(self, mode, config, unweighted_config=None):
         """
         Creates TensorFlow computation graph
 
@@ -162,7 +213,14 @@ class RGNModel(object):
         else:
             self._evaluation_ops = evaluation_ops = {}  # collection of ops for evaluation of losses
             self._last_evaluation_ops = last_evaluation_ops = {}  # collection of ops for the last evaluation in a multi-invocation evaluation
+            self._evaluation_state_ops = evaluation_state_ops = {}  # ops updating state from evaluated losses (min losses, curriculum history)
+            self._evaluated_losses = {}  # loss nodes fed to the evaluation state ops, keyed by prefix
             self._prediction_ops = prediction_ops = {}  # collection of ops for prediction of structures
+            self._exact_evaluation_ops = exact_evaluation_ops = {} if config.queueing[
+                'exact_evaluation'] else None  # collection of per-protein ops for exact evaluation of losses
+            self._last_batch_ops = {}  # collection of ops run along with the last batch of an exact evaluation
+            self._exact_losses = exact_losses = {}  # loss nodes fed with exactly evaluated losses of all groups, keyed by prefix
+            self._loss_groups = {}  # groups whose losses are evaluated, in order, keyed by prefix
 
         # set variable scoping, op scoping, and place on appropriate device
         # noinspection PyUnusedLocal
@@ -194,8 +252,20 @@ class RGNModel(object):
                 max_length = config.optimization['num_steps']
 
             data_flow_config = merge_dicts(config.io, config.initialization, config.optimization, config.queueing)
-            ids, primaries, evolutionaries, secondaries, tertiaries, masks, num_steps = _data_flow(data_flow_config,
-                                                                                                   max_length)
+            sub_groups = config.io['evaluation_sub_groups'] if mode == 'evaluation' else []
+            if config.queueing['exact_evaluation'] and not config.queueing['cache_data']:
+                raise RuntimeError('Exact evaluation requires cached data.')
+            if config.queueing['cache_data']:
+                if mode == 'training':
+                    raise RuntimeError('Cannot cache data with training mode.')
+                self._cached_data = _cached_data_arrays(data_flow_config, max_length, sub_groups)
+                ids, primaries, evolutionaries, secondaries, tertiaries, masks, num_steps, group_indices, valid, \
+                    self._data_ops = _cached_data_flow(data_flow_config, self._cached_data, sub_groups)
+                self._pipeline_ops = None
+            else:
+                ids, primaries, evolutionaries, secondaries, tertiaries, masks, num_steps, group_indices, \
+                    self._pipeline_ops = _data_flow(data_flow_config, max_length, sub_groups)
+                valid, self._data_ops = None, None
 
             # Set up inputs
             inputs = _inputs(merge_dicts(config.architecture, config.initialization),
@@ -242,85 +312,161 @@ class RGNModel(object):
                 drmsds = _drmsds(merge_dicts(config.optimization, config.loss, config.io), coordinates, tertiaries,
                                  weights)
 
+                # Unweighted dRMSDs of the same structures for a shared unweighted counterpart
+                if unweighted_config is not None:
+                    with tf.name_scope(SCOPE + '/' + unweighted_config.io['name'] + '/'):
+                        unweighted_weights, _ = _weights(merge_dicts(unweighted_config.optimization,
+                                                                     unweighted_config.curriculum,
+                                                                     unweighted_config.loss,
+                                                                     unweighted_config.io), masks)
+                        unweighted_drmsds = _drmsds(merge_dicts(unweighted_config.optimization,
+                                                                unweighted_config.loss,
+                                                                unweighted_config.io), coordinates, tertiaries,
+                                                    unweighted_weights)
+
                 if mode == 'evaluation':
                     # noinspection PyUnboundLocalVariable
-                    prediction_ops.update({'ids': ids,
-                                           'coordinates': coordinates,
-                                           'num_steps': num_steps,
-                                           'recurrent_states': recurrent_states})
+                    prediction_ops.update({'ids': ids, 'num_steps': num_steps})
+                    if 'tertiary' in config.io['prediction_outputs']:
+                        prediction_ops.update({'coordinates': coordinates})
+                    if 'recurrent_states' in config.io['prediction_outputs']:
+                        prediction_ops.update({'recurrent_states': tf.cast(recurrent_states,
+                                                                           config.io['recurrent_states_dtype'])})
+                    if config.io['predict_primary']:
+                        prediction_ops.update({'primaries': tf.argmax(primaries, 2, output_type=tf.int32)})
+
+                    # ensembles run one batch of inputs through the weights of several checkpoints, fed in place
+                    # of the variables, and then reconstruct consensus structures from the mean of their dihedrals
+                    if config.io['ensemble_prediction']:
+                        self._ensemble_input_ops = {k: prediction_ops[k] for k in ['ids', 'num_steps', 'primaries']
+                                                    if k in prediction_ops}
+                        self._ensemble_input_ops.update({'inputs': inputs})
+                        self._ensemble_member_ops = {'dihedrals': dihedrals, 'coordinates': coordinates}
+                        self._ensemble_dihedrals = tf.placeholder(dihedrals.dtype,
+                                                                  [None] + dihedrals.get_shape().as_list(),
+                                                                  name='ensemble_dihedrals')
+                        self._ensemble_coordinates = _ensemble_coordinates(
+                            merge_dicts(config.computing, config.optimization, config.queueing),
+                            self._ensemble_dihedrals)
 
             # Losses
             if config.loss['include']:
-                filters = {grp: id_filter(ids, grp) for grp in
-                           config.io['evaluation_sub_groups']} if mode == 'evaluation' else {}
-                filters.update({'all': tf.tile([True], tf.shape(ids))})
+                # models shared with an unweighted counterpart also compute its losses from the same structures, with
+                # the corresponding ops and variables placed under the unweighted model's name (as if it were separate)
+                loss_variants = [(config, '', drmsds if config.loss['tertiary_weight'] > 0 else None)]
+                if unweighted_config is not None:
+                    loss_variants.append((unweighted_config, UNWEIGHTED_PREFIX,
+                                          unweighted_drmsds if config.loss['tertiary_weight'] > 0 else None))
+
+                # exact evaluation reduces per-protein losses on the host, so the factors of each protein are fetched
+                loss_quotient_config = merge_dicts(config.loss, config.io, config.optimization)
+                if mode == 'evaluation' and exact_evaluation_ops is not None and config.loss['tertiary_weight'] > 0:
+                    numerator_factors, denominator_factors = _loss_quotient_factors(loss_quotient_config, drmsds, masks)
+                    exact_evaluation_ops.update({'ids': ids, 'valid': valid, 'numerator_factors': numerator_factors,
+                                                 'denominator_factors': denominator_factors})
+                    if group_indices is not None:
+                        exact_evaluation_ops.update({'group_indices': group_indices})
+
+                history_losses = {}
+                for variant_config, prefix, variant_drmsds in loss_variants:
+                    with tf.name_scope(SCOPE + '/' + variant_config.io['name'] + '/'):
+                        # membership matrix of all groups, which are reduced together. 'all' always comes first, and
+                        # proteins repeated to fill up batches of cached data are excluded from all groups (their index is -1)
+                        groups = ['all'] + sub_groups
+                        memberships = tf.expand_dims(valid if valid is not None else tf.tile([True], tf.shape(ids)), 1)
+                        if group_indices is not None:
+                            memberships = tf.concat([memberships, tf.equal(tf.expand_dims(group_indices, 1),
+                                                                           tf.range(len(sub_groups)))], 1)
+                        memberships = tf.identity(memberships, name='group_memberships')
+                        # [BATCH_SIZE, NUM_GROUPS]
 
-                for group_id, group_filter in filters.iteritems():
-                    with tf.variable_scope(group_id):
                         # Tertiary loss
-                        effective_tertiary_loss = 0.
                         if config.loss['tertiary_weight'] > 0:
                             if config.queueing['num_evaluation_invocations'] > 1 and mode == 'training':
                                 raise RuntimeError('Cannot use multiple invocations with training mode.')
-                            else:
-                                # Compute tertiary loss quotient parts by reducing dRMSDs based on normalization behavior
-                                tertiary_loss_numerator, tertiary_loss_denominator = _reduce_loss_quotient(
-                                    merge_dicts(config.loss, config.io, config.optimization),
-                                    drmsds, masks, group_filter,
-                                    name_prefix='tertiary_loss')
-
-                                # Handles multiple invocations and gracefully degrades for single invocations.
-                                # Variables are created below _per_ evaluation model, which is a deviation from my general design
-                                # the scope of those variables is the evaluation model's, _not_ the training model's as usual
-                                tertiary_loss, min_loss_achieved, min_loss_op, update_accu_op, reduce_accu_op = _accumulate_loss(
-                                    merge_dicts(config.io, config.queueing),
-                                    tertiary_loss_numerator, tertiary_loss_denominator,
-                                    name_prefix='tertiary_loss')
-
-                                if mode == 'evaluation':
-                                    # noinspection PyUnboundLocalVariable
-                                    evaluation_ops.update({'update_accumulator_' + group_id + '_op': update_accu_op})
+
+                            # Compute tertiary loss quotient parts of all groups by reducing dRMSDs based on normalization behavior
+                            tertiary_loss_numerators, tertiary_loss_denominators = _reduce_loss_quotients(
+                                loss_quotient_config,
+                                variant_drmsds, masks, memberships,
+                                name_prefix='tertiary_losses')
+
+                            # Handles multiple invocations and gracefully degrades for single invocations.
+                            # Variables are created below _per_ evaluation model, which is a deviation from my general design
+                            # the scope of those variables is the evaluation model's, _not_ the training model's as usual
+                            tertiary_losses, update_accu_op, reduce_accu_op = _accumulate_losses(
+                                merge_dicts(config.io, config.queueing),
+                                tertiary_loss_numerators, tertiary_loss_denominators,
+                                name_prefix='tertiary_losses')
+
+                            if mode == 'evaluation':
+                                if exact_evaluation_ops is not None:
+                                    exact_evaluation_ops.update({prefix + 'drmsds': variant_drmsds})
+                                    exact_losses.update({prefix: tertiary_losses})
+                                # noinspection PyUnboundLocalVariable
+                                evaluation_ops.update({prefix + 'update_accumulator_op': update_accu_op})
+                                # noinspection PyUnboundLocalVariable
+                                last_evaluation_ops.update({prefix + 'reduce_accumulator_op': reduce_accu_op})
+
+                        min_losses_achieved, min_loss_ops = [], []
+                        for i, group_id in enumerate(groups):
+                            with tf.variable_scope(group_id):
+                                effective_tertiary_loss = 0.
+                                if config.loss['tertiary_weight'] > 0:
                                     # noinspection PyUnboundLocalVariable
-                                    last_evaluation_ops.update(
-                                        {'tertiary_loss_' + group_id: tertiary_loss * LOSS_SCALING_FACTOR,
-                                         'reduce_accumulator_' + group_id + '_op': reduce_accu_op,
-                                         'min_tertiary_loss_achieved_' + group_id: min_loss_achieved * LOSS_SCALING_FACTOR,
-                                         'min_tertiary_loss_' + group_id + '_op': min_loss_op})
-
-                            if config.io['log_model_summaries']:
-                                tf.add_to_collection(config.io['name'] + '_tertiary_losses', tertiary_loss)
-                            effective_tertiary_loss = config.loss['tertiary_weight'] * tertiary_loss
-
-                        # Final loss and related housekeeping
-                        loss = tf.identity(effective_tertiary_loss, name='loss')
-                        update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)  # batch_norm related
-                        if update_ops:
-                            loss = control_flow_ops.with_dependencies(tf.tuple(update_ops), loss)
-                        if config.io['log_model_summaries']:
-                            tf.add_to_collection(config.io['name'] + '_losses', loss)
-                        if group_id == config.curriculum['loss_history_subgroup']:
-                            curriculum_loss = loss
+                                    tertiary_loss = tf.identity(tertiary_losses[i], name='tertiary_loss')
+                                    min_loss_achieved, min_loss_op = _min_loss(tertiary_loss, name_prefix='tertiary_loss')
+                                    min_losses_achieved.append(min_loss_achieved)
+                                    min_loss_ops.append(min_loss_op)
+
+                                    if config.io['log_model_summaries']:
+                                        tf.add_to_collection(variant_config.io['name'] + '_tertiary_losses', tertiary_loss)
+                                    effective_tertiary_loss = config.loss['tertiary_weight'] * tertiary_loss
+
+                                # Final loss and related housekeeping
+                                loss = tf.identity(effective_tertiary_loss, name='loss')
+                                update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)  # batch_norm related
+                                if update_ops:
+                                    loss = control_flow_ops.with_dependencies(tf.tuple(update_ops), loss)
+                                if config.io['log_model_summaries']:
+                                    tf.add_to_collection(variant_config.io['name'] + '_losses', loss)
+                                if group_id == config.curriculum['loss_history_subgroup'] \
+                                        and variant_config.curriculum['update_loss_history']:
+                                    history_losses.update({prefix: loss})
+
+                        # losses of all groups are fetched together, and unpacked by group on the host
+                        # updates of the state that depends on them are kept apart from the evaluation itself, and
+                        # are fed the evaluated losses (see _update_evaluation_state)
+                        if mode == 'evaluation' and config.loss['tertiary_weight'] > 0:
+                            self._loss_groups.update({prefix: groups})
+                            self._evaluated_losses.update({prefix: tertiary_losses})
+                            last_evaluation_ops.update({prefix + 'tertiary_losses': tertiary_losses})
+                            evaluation_state_ops.update(
+                                {prefix + 'min_tertiary_losses_achieved': tf.stack(min_losses_achieved) * LOSS_SCALING_FACTOR,
+                                 prefix + 'min_tertiary_losses_op': tf.group(*min_loss_ops)})
 
                 # Curriculum loss history; not always used but design is much cleaner if always created.
                 curriculum_loss_history = tf.get_variable(
                     initializer=tf.constant_initializer([DUMMY_LOSS] * config.curriculum['change_num_iterations']),
                     shape=[config.curriculum['change_num_iterations']], trainable=False, name='curriculum_loss_history')
-                if mode == 'evaluation' and config.curriculum['update_loss_history']:
-                    update_curriculum_history_op = _history(curriculum_loss, curriculum_loss_history)
-                    last_evaluation_ops.update({'update_curriculum_history_op': update_curriculum_history_op})
-
+                if mode == 'evaluation':
+                    for prefix, curriculum_loss in history_losses.iteritems():
+                        update_curriculum_history_op = _history(curriculum_loss, curriculum_loss_history)
+                        evaluation_state_ops.update({prefix + 'update_curriculum_history_op': update_curriculum_history_op})
             # Training
             if mode == 'training':
                 # get grads, training ops
-                self._global_step, minimize_op, grads_and_vars_dict = _training(config.optimization, loss)
+                self._global_step, minimize_op, grads_and_vars_dict, extrema_dict, norms_dict = _training(
+                    config.optimization, loss)
                 self._grads_and_vars_length = len(grads_and_vars_dict) / 2
+                self._full_diagnostic_ops = merge_dicts(grads_and_vars_dict, norms_dict)  # only fetched on demand
 
                 # update relevant op dicts
                 # update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
                 # if update_ops: training_ops.update({'update_ops': tf.tuple(update_ops)})
                 # noinspection PyUnboundLocalVariable
                 training_ops.update({'minimize_op': minimize_op, 'global_step': self._global_step, 'ids': ids})
-                diagnostic_ops.update(grads_and_vars_dict)
+                diagnostic_ops.update(extrema_dict)
 
             # Curriculum
             if mode == 'training' and config.curriculum['behavior'] in ['fixed_rate', 'loss_threshold', 'loss_change']:
@@ -328,33 +474,130 @@ class RGNModel(object):
                                                    [minimize_op])
                 training_ops.update({'curriculum_update_op': curriculum_update_op})
 
-    def _train(self, session):
+    def _train(self, session, num_steps=1, trace_prefix=None):
         """
-        Performs one iteration of training and, if applicable, advances the curriculum.
+        Performs num_steps iterations of training, one run each, and, if applicable, advances the curriculum
+        after each. Returns the global step and ids of the last iteration.
+
+        If trace_prefix is passed, the last iteration is traced (see _traced).
         """
-        training_dict = ops_to_dict(session, self._training_ops)
+        for _ in range(num_steps if trace_prefix is None else num_steps - 1):
+            training_dict = self._training_callable()
+        if trace_prefix is not None:
+            training_dict = self._traced(self._training_callable, trace_prefix)
+        # noinspection PyUnboundLocalVariable
         return training_dict['global_step'], training_dict['ids']
 
-    def _evaluate(self, session, pretty=True):
+    def _train_and_diagnose(self, session, num_steps=1, pretty=True, trace_prefix=None):
+        """
+        Performs num_steps iterations of training and computes diagnostics in the same run as the last one,
+        returning both.
+
+        Unlike a separate call to diagnose, diagnostics are computed from the batch used for training,
+        rather than from an additional one, and gradients are the ones applied in this iteration.
+        Diagnostics of variables updated by training (weights, curriculum step, etc.) are not fetched
+        in the same run, where their reads would race with the update, but in a small run right after,
+        and so are of the updated variables.
+
+        If trace_prefix is passed, the last iteration is traced (see _traced).
+        """
+        if num_steps > 1:
+            self._train(session, num_steps - 1)
+        training_dict = self._traced(self._train_and_diagnose_callable, trace_prefix)
+        diagnostic_dict = merge_dicts({k: training_dict[k] for k in self._diagnostic_ops if k not in STATE_DIAGNOSTICS},
+                                      self._state_diagnostic_callable())
+        return training_dict['global_step'], training_dict['ids'], self._diagnostics(diagnostic_dict, pretty)
+
+    def _evaluate(self, session, pretty=True, snapshot=None, trace_prefix=None, update_state=True):
         """
         Evaluates loss(es) and returns dicts with the relevant loss(es).
+
+        If exact evaluation is enabled, every protein of the data set is evaluated exactly once,
+        and per-protein dRMSDs (and the corresponding ids) are returned along with the losses.
+
+        If a snapshot (as returned by the head model's snapshot method) is passed, the model is
+        evaluated as of the snapshot, otherwise the current state of the model is used.
+
+        If update_state is False, the state that depends on the losses (minimum losses achieved and
+        the curriculum loss history) is left alone, and the raw result is returned instead, to be passed
+        to update_evaluation_state. Only that part writes to variables that training reads, so the rest
+        can run concurrently with training, e.g. against a snapshot on a background thread.
+
+        If trace_prefix is passed, the last batch is traced (see _traced).
         """
         if RGNModel.is_started:
+            # rewind cached data so that every evaluation sees the same batches
+            if self._data_ops is not None:
+                session.run(self._data_ops['rewind_op'])
+
             # evaluate
-            num_invocations = self.config.queueing['num_evaluation_invocations']
-            for invocation in range(num_invocations):
-                if invocation < num_invocations - 1:
-                    evaluation_dict = ops_to_dict(session, self._evaluation_ops)
-                else:
-                    evaluation_dict = ops_to_dict(session,
-                                                  merge_dicts(self._evaluation_ops,
-                                                              self._last_evaluation_ops))
+            if self._exact_evaluation_ops is not None:
+                # stream once through the data set and reduce losses on the host, feeding them to the remaining ops
+                num_batches = self._data_ops['num_batches']
+                run_batch = partial(ops_to_dict, session, self._exact_evaluation_ops, feed_dict=snapshot)
+                run_last_batch = partial(ops_to_dict, session, merge_dicts(self._exact_evaluation_ops,
+                                                                           self._last_batch_ops), feed_dict=snapshot)
+                batch_dicts = [run_batch() for _ in range(num_batches - 1)] + \
+                              [self._traced(run_last_batch, trace_prefix)]
+                protein_dict = {k: np.concatenate([batch_dict[k] for batch_dict in batch_dicts])
+                                for k in self._exact_evaluation_ops}
+                evaluation_dict = ops_to_dict(session, self._last_evaluation_ops,
+                                              feed_dict=merge_dicts(snapshot or {},
+                                                                    _exact_losses(protein_dict, self._loss_groups,
+                                                                                  self._exact_losses)))
+                evaluation_dict.update({k: batch_dicts[-1][k] for k in self._last_batch_ops})
+
+                # per-protein dRMSDs of valid (non-repeated) proteins
+                valid = protein_dict['valid']
+                for prefix in self._exact_losses:
+                    evaluation_dict.update({prefix + 'ids': protein_dict['ids'][valid],
+                                            prefix + 'drmsds': protein_dict[prefix + 'drmsds'][valid] * LOSS_SCALING_FACTOR})
+            else:
+                num_invocations = self.config.queueing['num_evaluation_invocations']
+                for invocation in range(num_invocations):
+                    if invocation < num_invocations - 1:
+                        evaluation_dict = ops_to_dict(session, self._evaluation_ops, feed_dict=snapshot)
+                    else:
+                        evaluation_dict = self._traced(partial(ops_to_dict, session,
+                                                               merge_dicts(self._evaluation_ops,
+                                                                           self._last_evaluation_ops),
+                                                               feed_dict=snapshot),
+                                                       trace_prefix)
+
+            if update_state:
+                return self._update_evaluation_state(session, evaluation_dict, pretty)
+            else:
+                return evaluation_dict
+
+        else:
+            raise RuntimeError('Model has not been started or has already finished.')
+
+    def _update_evaluation_state(self, session, evaluation_dict, pretty=True):
+        """
+        Updates the state that depends on the losses of an evaluation run with update_state set to False,
+        i.e. the minimum losses achieved and the curriculum loss history, and returns the same dicts as
+        evaluate. Must be called from the thread that trains the model.
+        """
+        if RGNModel.is_started:
+            evaluation_dict = merge_dicts(evaluation_dict, ops_to_dict(
+                session, self._evaluation_state_ops,
+                feed_dict={self._evaluated_losses[prefix]: evaluation_dict[prefix + 'tertiary_losses']
+                           for prefix in self._evaluated_losses}))
+
+            # unpack losses by group
+            for prefix, groups in self._loss_groups.iteritems():
+                tertiary_losses = evaluation_dict.pop(prefix + 'tertiary_losses') * LOSS_SCALING_FACTOR
+                min_tertiary_losses_achieved = evaluation_dict.pop(prefix + 'min_tertiary_losses_achieved')
+                for group_id, tertiary_loss, min_tertiary_loss_achieved in zip(groups, tertiary_losses,
+                                                                               min_tertiary_losses_achieved):
+                    evaluation_dict.update({prefix + 'tertiary_loss_' + group_id: tertiary_loss,
+                                            prefix + 'min_tertiary_loss_achieved_' + group_id: min_tertiary_loss_achieved})
 
             # write event summaries to disk
             if self.config.io['log_model_summaries']:
-                # noinspection PyUnboundLocalVariable
-                self._summary_writer.add_summary(evaluation_dict['merged_summaries_op'],
-                                                 global_step=evaluation_dict['global_step'])
+                for op in ['merged_summaries_op', 'batch_summaries_op']:
+                    if evaluation_dict.get(op) is not None:
+                        self._summary_writer.add_summary(evaluation_dict[op], global_step=evaluation_dict['global_step'])
 
             # remove non-user facing ops
             if pretty:
@@ -367,6 +610,22 @@ class RGNModel(object):
         else:
             raise RuntimeError('Model has not been started or has already finished.')
 
+    def _traced(self, run, trace_prefix=None):
+        """
+        Returns run(), where run accepts options and run_metadata like the callables of ops_to_callable.
+
+        If trace_prefix is passed, the run is fully traced, and its timeline and summaries of its op times and
+        memory use are written to files starting with trace_prefix followed by the model's name (see _write_trace).
+        """
+        if trace_prefix is None:
+            return run()
+
+        run_metadata = tf.RunMetadata()
+        result = run(options=FULL_TRACE_OPTIONS, run_metadata=run_metadata)
+        _write_trace(trace_prefix + self.config.io['name'], run_metadata, self._queue_memory())
+
+        return result
+
     def _predict(self, session):
         """
         Predict 3D structures.
@@ -375,51 +634,112 @@ class RGNModel(object):
             # evaluate prediction dict
             prediction_dict = ops_to_dict(session, self._prediction_ops)
 
-            # process tertiary sequences
-            if prediction_dict.has_key('coordinates'):
-                prediction_dict['coordinates'] = np.transpose(prediction_dict['coordinates'], (1, 2, 0))
-
-            # generate return dict
-            predictions = {}
-            for id_, num_steps, tertiary, recurrent_states in izip_longest(*[prediction_dict.get(key, [])
-                                                                             for key in ['ids',
-                                                                                         'num_steps',
-                                                                                         'coordinates',
-                                                                                         'recurrent_states']]):
-                prediction = {}
+            return self._prediction_dict_to_predictions(prediction_dict)
 
-                if tertiary:
-                    last_atom = (num_steps - self.config.io['num_edge_residues']) * NUM_DIHEDRALS
-                    prediction.update({'tertiary': tertiary[:, :last_atom]})
+        else:
+            raise RuntimeError('Model has not been started or has already finished.')
 
-                prediction.update({'recurrent_states': recurrent_states})
+    def _predict_ensemble(self, session, ensemble):
+        """
+        Predict 3D structures using an ensemble of weights, as returned by the head model's load_ensemble.
 
-                predictions.update({id_: prediction})
+        Returns the consensus structure of each protein as its tertiary output, and the structure predicted
+        by the i-th member of the ensemble as its tertiary_i output. Recurrent states are not returned.
+        """
+        if RGNModel.is_started:
+            # dequeue one batch of inputs, and then run it through every member of the ensemble
+            prediction_dict = ops_to_dict(session, self._ensemble_input_ops)
+            inputs_feed_dict = {self._ensemble_input_ops[k]: prediction_dict[k] for k in ['inputs', 'num_steps']}
+            member_dicts = [ops_to_dict(session, self._ensemble_member_ops, feed_dict=merge_dicts(inputs_feed_dict,
+                                                                                                   weights))
+                            for weights in ensemble]
+
+            # consensus structures
+            prediction_dict['coordinates'] = session.run(self._ensemble_coordinates, feed_dict={
+                self._ensemble_dihedrals: np.stack([member_dict['dihedrals'] for member_dict in member_dicts])})
+            predictions = self._prediction_dict_to_predictions(prediction_dict)
+
+            # structures of individual members
+            for i, member_dict in enumerate(member_dicts):
+                member_predictions = self._prediction_dict_to_predictions(
+                    merge_dicts(prediction_dict, {'coordinates': member_dict['coordinates']}))
+                for id_, prediction in member_predictions.iteritems():
+                    predictions[id_].update({'tertiary_' + str(i): prediction['tertiary']})
 
             return predictions
 
         else:
             raise RuntimeError('Model has not been started or has already finished.')
 
-    def _diagnose(self, session, pretty=True):
+    def _prediction_dict_to_predictions(self, prediction_dict):
         """
-        Compute and return diagnostic measurements like weight norms and curriculum quantiles.
+        Splits a dict of batched prediction outputs into a dict of per-protein predictions keyed by id.
         """
+        prediction_dict = dict(prediction_dict)
+
+        # process tertiary sequences
+        if prediction_dict.has_key('coordinates'):
+            prediction_dict['coordinates'] = np.transpose(prediction_dict['coordinates'], (1, 2, 0))
+
+        # process primary sequences
+        if prediction_dict.has_key('primaries'):
+            prediction_dict['primaries'] = np.transpose(prediction_dict['primaries'], (1, 0))
+
+        # generate return dict
+        predictions = {}
+        for id_, num_steps, tertiary, recurrent_states, primary in izip_longest(*[prediction_dict.get(key, [])
+                                                                                  for key in ['ids',
+                                                                                              'num_steps',
+                                                                                              'coordinates',
+                                                                                              'recurrent_states',
+                                                                                              'primaries']]):
+            prediction = {}
+
+            if tertiary is not None:
+                last_atom = (num_steps - self.config.io['num_edge_residues']) * NUM_DIHEDRALS
+                prediction.update({'tertiary': tertiary[:, :last_atom]})
+
+            if primary is not None:
+                prediction.update({'primary': primary[:num_steps]})
+
+            if recurrent_states is not None:
+                prediction.update({'recurrent_states': recurrent_states})
+
+            predictions.update({id_: prediction})
 
-        diagnostic_dict = ops_to_dict(session, self._diagnostic_ops)
+        return predictions
+
+    def _diagnose(self, session, pretty=True, full=False):
+        """
+        Compute and return diagnostic measurements like weight extrema and curriculum quantiles.
+
+        Extrema are reduced on the device, so by default only a few scalars are fetched. If full is
+        set, the norms of all weights and gradients are returned as well, along with lists of their
+        values ('weights' and 'gradients', in matching order).
+        """
+
+        if full:
+            return self._diagnostics(ops_to_dict(session, merge_dicts(self._diagnostic_ops,
+                                                                      self._full_diagnostic_ops)), pretty)
+        else:
+            return self._diagnostics(self._diagnostic_callable(), pretty)
+
+    def _diagnostics(self, diagnostic_dict, pretty=True):
+        """
+        Computes diagnostic measurements from the fetched diagnostic ops.
+        """
 
         # write event summaries to disk
         if self.config.io['log_model_summaries']:
             for op in ['merged_summaries_op', 'base_merged_summaries_op']:
                 self._summary_writer.add_summary(diagnostic_dict[op], global_step=diagnostic_dict['global_step'])
 
-        # compute max/min of vars and grads
-        vars_ = [diagnostic_dict['v' + str(i)] for i in range(self._grads_and_vars_length)]
-        grads = [diagnostic_dict['g' + str(i)] for i in range(self._grads_and_vars_length)]
-        diagnostic_dict.update({'min_weight': np.min([np.min(var) for var in vars_]),
-                                'max_weight': np.max([np.max(var) for var in vars_]),
-                                'min_grad': np.min([np.min(grad) for grad in grads]),
-                                'max_grad': np.max([np.max(grad) for grad in grads])})
+        # collect vars and grads if fetched
+        if 'v0' in diagnostic_dict:
+            diagnostic_dict.update({'weights': [diagnostic_dict.pop('v' + str(i))
+                                                for i in range(self._grads_and_vars_length)],
+                                    'gradients': [diagnostic_dict.pop('g' + str(i))
+                                                  for i in range(self._grads_and_vars_length)]})
 
         # compute curriculum quantiles if applicable.
         if self.config.curriculum['mode'] == 'loss':
@@ -431,66 +751,63 @@ class RGNModel(object):
         # remove non-user facing ops and tensors
         if pretty:
             diagnostic_dict.pop('flat_curriculum_weights', None)
-            for i in range(self._grads_and_vars_length):
-                diagnostic_dict.pop('v' + str(i))
-                diagnostic_dict.pop('g' + str(i))
 
         return diagnostic_dict
 
-    def _start(self, evaluation_models, session=None, restore_if_checkpointed=True):
+    def _start(self, evaluation_models, session=None, restore_if_checkpointed=True, restore_training_state=True,
+               graph_cache_prefix=None):
         """
         Initializes model from scratch or loads state from disk.
         Must be run once (and only once) before model is used.
+
+        If restore_training_state is False, only the state needed for evaluation and prediction (model weights,
+        global step, and curriculum step) is restored from the checkpoint, and the rest (optimizer slots,
+        curriculum history, etc.) is initialized. The model must then not be checkpointed.
+
+        If graph_cache_prefix is passed and the graph wasn't itself loaded from a cache, the completed graph is
+        cached there, for use by load_graph.
         """
 
         if not RGNModel.is_started:
-            # Checkpointing. Must be done here after all models have been instantiated, because evaluation models may introduce additional variables
-            self._saver = tf.train.Saver(max_to_keep=self.config.io['max_checkpoints'],
-                                         keep_checkpoint_every_n_hours=self.config.io['checkpoint_every_n_hours'])
+            # shared evaluation models may be passed more than once
+            evaluation_models = [model for i, model in enumerate(evaluation_models) if model not in evaluation_models[:i]]
+
+            # graph construction that has to wait until all models have been instantiated. skipped if the graph was
+            # loaded from a cache, which already includes it
+            if not self._graph_is_cached:
+                # Checkpointing. Must be done here after all models have been instantiated, because evaluation models may introduce additional variables
+                with timed('saver'):
+                    self._saver = tf.train.Saver(
+                        max_to_keep=self.config.io['max_checkpoints'],
+                        keep_checkpoint_every_n_hours=self.config.io['checkpoint_every_n_hours'])
+
+                # restoring is split over savers of similarly sized shards of the variables, so that they're read in
+                # parallel. there's one set of savers for all variables and one for just the state needed for prediction
+                with timed('restore savers'):
+                    saveables = tf.get_collection(tf.GraphKeys.SAVEABLE_OBJECTS)  # e.g. canonical cuDNN parameters
+                    model_vars = tf.trainable_variables() + \
+                                 [var for var in tf.model_variables() if var not in tf.trainable_variables()]
+                    model_vars += [self._global_step] + \
+                                  [var for var in tf.global_variables() if var.op.name == SCOPE + '/curriculum_step']
+                    num_shards = self.config.computing['num_restore_shards']
+                    self._restore_savers = {True: _shard_savers(tf.global_variables() + saveables, num_shards),
+                                            False: _shard_savers(model_vars + saveables, num_shards)}
+
+                self._create_summaries(evaluation_models)
+
+                if graph_cache_prefix is not None:
+                    self._export_graph(graph_cache_prefix, evaluation_models)
+
+            self._delta_base = None  # (prefix, {name: value}) of the last full checkpoint if deltas are enabled
+            self._num_deltas = 0
+            self._checkpoint_times = {}  # prefix: time of the checkpoints written from snapshots
+            self._next_kept_checkpoint_time = time.time() + self.config.io['checkpoint_every_n_hours'] * 3600
 
-            # variable tracking and summarization. it has to be done here after all models have been instantiated
-            model_names = set([model.config.io['name'] for model in evaluation_models] + [self.config.io['name']])
             if self.config.io['log_model_summaries']:
-                # add histogram and scalar summaries losses
-                for model_name in model_names:
-                    for coll in ['tertiary_losses', 'losses']:
-                        for node in tf.get_collection(model_name + '_' + coll):
-                            tf.summary.scalar(node.name, node, collections=[model_name + '_' + tf.GraphKeys.SUMMARIES])
-                if self.config.io['detailed_logs']:
-                    # additional detailed summaries for losses
-                    for model_name in model_names:
-                        for coll in ['scess', 'matches', 'drmsdss', tf.GraphKeys.ACTIVATIONS]:
-                            for node_or_named_output in tf.get_collection(model_name + '_' + coll):
-                                if type(node_or_named_output) is tf.Tensor:
-                                    tf.summary.histogram(node_or_named_output.name, node_or_named_output,
-                                                         collections=[model_name + '_' + tf.GraphKeys.SUMMARIES])
-                                elif type(node_or_named_output) is layers.utils.NamedOutputs:
-                                    tf.summary.histogram(node_or_named_output[1].name, node_or_named_output[1],
-                                                         collections=[model_name + '_' + tf.GraphKeys.SUMMARIES])
-
-                    # summaries for trainable variables and their activations
-                    for var in tf.trainable_variables():
-                        tf.summary.histogram(var.name, var)
-                    layers.summarize_activations()
-
-                    # add housekeeping training ops that merge and write summaries
                 self._summary_writer = tf.summary.FileWriter(self.config.io['logs_directory'])
-                self._diagnostic_ops.update({'global_step': self._global_step,
-                                             'base_merged_summaries_op': tf.summary.merge_all(),
-                                             # leftovers not covered by model-specific 'summaries'
-                                             'merged_summaries_op': tf.summary.merge_all(self.config.io['name']
-                                                                                         + '_'
-                                                                                         + tf.GraphKeys.SUMMARIES)})
-
-                # ditto for evaluation models
                 for model in evaluation_models:
                     if model.mode == 'evaluation':
                         model._summary_writer = self._summary_writer
-                        # noinspection PyProtectedMember
-                        model._last_evaluation_ops.update({
-                            'global_step': self._global_step,
-                            'merged_summaries_op': tf.summary.merge_all(
-                                model.config.io['name'] + '_' + tf.GraphKeys.SUMMARIES)})
 
             # start session with appropriate device settings if no Session is passed
             if self.config.computing['fill_gpu']:
@@ -499,34 +816,67 @@ class RGNModel(object):
                 gpu_fraction = self.config.computing['gpu_fraction']
 
             if session is None:
-                session = tf.Session(config=tf.ConfigProto(
-                    allow_soft_placement=False,
-                    inter_op_parallelism_threads=self.config.computing['num_cpus'],
-                    intra_op_parallelism_threads=self.config.computing['num_cpus'],
-                    gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=gpu_fraction,
-                                              allow_growth=self.config.computing['allow_gpu_growth'])))
+                with timed('session'):
+                    session = tf.Session(config=tf.ConfigProto(
+                        allow_soft_placement=False,
+                        inter_op_parallelism_threads=self.config.computing['num_cpus'],
+                        intra_op_parallelism_threads=self.config.computing['num_cpus'],
+                        gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=gpu_fraction,
+                                                  allow_growth=self.config.computing['allow_gpu_growth'])))
 
             # retrieve latest checkpoint, if any
             latest_checkpoint = tf.train.latest_checkpoint(self.config.io['checkpoints_directory'])
 
             # restore latest checkpoint if found, initialize from scratch otherwise.
             if not restore_if_checkpointed or latest_checkpoint is None:
-                tf.global_variables_initializer().run(session=session)
-                tf.local_variables_initializer().run(session=session)
+                with timed('initialization'):
+                    tf.global_variables_initializer().run(session=session)
+                    tf.local_variables_initializer().run(session=session)
             else:
-                self._saver.restore(session, latest_checkpoint)
-                tf.local_variables_initializer().run(session=session)
+                with timed('restore'):
+                    restored_vars = self._restore(session, latest_checkpoint, restore_training_state)
+                    if not restore_training_state:
+                        tf.variables_initializer([var for var in tf.global_variables()
+                                                  if var not in restored_vars]).run(session=session)
+                    tf.local_variables_initializer().run(session=session)
+
+            # load cached data of evaluation models into memory
+            with timed('evaluation data load'):
+                # noinspection PyProtectedMember
+                for model in evaluation_models:
+                    if model.mode == 'evaluation' and model._data_ops is not None:
+                        placeholders = model._data_ops['load_placeholders']
+                        session.run(model._data_ops['load_op'],
+                                    feed_dict={placeholders[key]: array for key, array in model._cached_data.iteritems()})
+                        del model._cached_data  # held by the TF variables from now on
+                        session.run(model._data_ops['rewind_op'])
+
+            # precompile runs of the training loop
+            with timed('callables'):
+                self._training_callable = ops_to_callable(session, self._training_ops)
+                self._diagnostic_callable = ops_to_callable(session, self._diagnostic_ops)
+                self._train_and_diagnose_callable = ops_to_callable(session, merge_dicts(
+                    self._training_ops,
+                    {k: op for k, op in self._diagnostic_ops.iteritems() if k not in STATE_DIAGNOSTICS}))
+                self._state_diagnostic_callable = ops_to_callable(
+                    session, {k: op for k, op in self._diagnostic_ops.iteritems() if k in STATE_DIAGNOSTICS})
 
             # start coordinator and queueing threads
-            self._threads = tf.train.start_queue_runners(sess=session, coord=self._coordinator)
+            with timed('queue runners'):
+                self._threads = tf.train.start_queue_runners(sess=session, coord=self._coordinator)
             RGNModel.is_started = True
 
             # expose new methods and hide old ones
             self.train = self._train
+            self.train_and_diagnose = self._train_and_diagnose
             self.diagnose = self._diagnose
             self.save = self._save
             self.is_done = self._is_done
             self.current_step = self._current_step
+            self.snapshot = self._snapshot
+            self.restore_snapshot = self._restore_snapshot
+            self.pipeline_health = self._pipeline_health
+            self.load_ensemble = self._load_ensemble
             self.finish = self._finish
             del self.start
 
@@ -535,17 +885,260 @@ class RGNModel(object):
         else:
             raise RuntimeError('Model already started.')
 
-    def _save(self, session):
+    @timed_calls('summaries')
+    def _create_summaries(self, evaluation_models):
+        """
+        Creates the summaries of all models, and the ops that merge them. Must be run after all models have been
+        instantiated.
+        """
+
+        # variable tracking and summarization. it has to be done here after all models have been instantiated
+        model_names = set([model.config.io['name'] for model in evaluation_models] + [self.config.io['name']]
+                          + [model.unweighted_config.io['name'] for model in evaluation_models
+                             if model.unweighted_config is not None])
+        if self.config.io['log_model_summaries']:
+            # add histogram and scalar summaries losses
+            for model_name in model_names:
+                for coll in ['tertiary_losses', 'losses']:
+                    for node in tf.get_collection(model_name + '_' + coll):
+                        tf.summary.scalar(node.name, node, collections=[model_name + '_' + tf.GraphKeys.SUMMARIES])
+            if self.config.io['detailed_logs']:
+                # additional detailed summaries for losses. they're of tensors of a batch, and so are kept apart
+                for model_name in model_names:
+                    for coll in ['scess', 'matches', 'drmsdss', tf.GraphKeys.ACTIVATIONS]:
+                        for node_or_named_output in tf.get_collection(model_name + '_' + coll):
+                            if type(node_or_named_output) is tf.Tensor:
+                                tf.summary.histogram(node_or_named_output.name, node_or_named_output,
+                                                     collections=[model_name + '_' + BATCH_SUMMARIES])
+                            elif type(node_or_named_output) is layers.utils.NamedOutputs:
+                                tf.summary.histogram(node_or_named_output[1].name, node_or_named_output[1],
+                                                     collections=[model_name + '_' + BATCH_SUMMARIES])
+
+                # summaries for trainable variables and their activations
+                for var in tf.trainable_variables():
+                    tf.summary.histogram(var.name, var)
+                layers.summarize_activations()
+
+            # like merge_all, there's no op if there's nothing to merge (e.g. when only predicting)
+            def merged_summaries(model_names_, collections):
+                summaries = [summary for model_name in model_names_ for coll in collections
+                             for summary in tf.get_collection(model_name + '_' + coll)]
+                return tf.summary.merge(summaries) if summaries else None
+
+            # add housekeeping training ops that merge and write summaries
+            self._diagnostic_ops.update({'global_step': self._global_step,
+                                         'base_merged_summaries_op': tf.summary.merge_all(),
+                                         # leftovers not covered by model-specific 'summaries'
+                                         'merged_summaries_op': merged_summaries([self.config.io['name']],
+                                                                                 [tf.GraphKeys.SUMMARIES,
+                                                                                  BATCH_SUMMARIES])})
+
+            # ditto for evaluation models. exact evaluations feed their losses to the last evaluation ops, so that
+            # summaries of batch tensors are merged separately and fetched along with their last batch instead
+            for model in evaluation_models:
+                if model.mode == 'evaluation':
+                    names = [model.config.io['name']] + ([model.unweighted_config.io['name']]
+                                                         if model.unweighted_config is not None else [])
+                    # noinspection PyProtectedMember
+                    if model._exact_evaluation_ops is not None:
+                        model._last_evaluation_ops.update({
+                            'global_step': self._global_step,
+                            'merged_summaries_op': merged_summaries(names, [tf.GraphKeys.SUMMARIES])})
+                        batch_summaries_op = merged_summaries(names, [BATCH_SUMMARIES])
+                        if batch_summaries_op is not None:
+                            # noinspection PyProtectedMember
+                            model._last_batch_ops.update({'batch_summaries_op': batch_summaries_op})
+                    else:
+                        model._last_evaluation_ops.update({
+                            'global_step': self._global_step,
+                            'merged_summaries_op': merged_summaries(names, [tf.GraphKeys.SUMMARIES, BATCH_SUMMARIES])})
+
+    @timed_calls('graph export')
+    def _export_graph(self, prefix, evaluation_models):
+        """
+        Caches the graph as a MetaGraphDef, along with the graph-related state of all models, for use by load_graph.
+
+        The state is saved in a sidecar file, with graph elements replaced by their names. Both files are written
+        under temporary names and renamed into place, the MetaGraphDef last, so that partial caches are never used.
+        """
+
+        if not os.path.exists(os.path.dirname(prefix)):
+            os.makedirs(os.path.dirname(prefix))
+
+        states = {}
+        for model in [self] + evaluation_models:
+            states.update({model.config.io['name']: _graph_elements_to_names(
+                {attr: getattr(model, attr) for attr in GRAPH_STATE_ATTRIBUTES if hasattr(model, attr)})})
+
+        with open(prefix + '_temp.pkl', 'wb') as file_:
+            cPickle.dump(states, file_, cPickle.HIGHEST_PROTOCOL)
+        tf.train.export_meta_graph(prefix + '_temp.meta', saver_def=self._saver.saver_def)
+
+        os.rename(prefix + '_temp.pkl', prefix + '.pkl')
+        os.rename(prefix + '_temp.meta', prefix + '.meta')
+
+    @staticmethod
+    @timed_calls('graph import')
+    def load_graph(prefix):
+        """
+        Imports a graph cached by start into the default graph.
+
+        Returns the cached state of its models, to be passed to their constructors, or None if there is no cache.
+        """
+
+        if not os.path.exists(prefix + '.meta'):
+            return None
+
+        tf.train.import_meta_graph(prefix + '.meta')
+        with open(prefix + '.pkl', 'rb') as file_:
+            return cPickle.load(file_)
+
+    @staticmethod
+    @timed_calls('graph cache key')
+    def graph_cache_key(configs):
+        """
+        Returns a key identifying the graph built from the passed model configs.
+
+        Besides the configs, the key covers everything else the graph depends on, namely the TF version, the
+        source of the modules that build it, and the data files it reads (whose names are baked into the graph).
+        """
+
+        key_parts = [tf.__version__] + [pformat(config.__dict__) for config in configs]
+
+        for module_file in sorted(glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+            with open(module_file) as file_:
+                key_parts.append(file_.read())
+
+        for config in configs:
+            if config.io['data_files'] is not None:
+                files = config.io['data_files']
+            elif config.io['data_files_glob'] is not None:
+                files = sorted(glob(config.io['data_files_glob']))
+            else:
+                files = []
+            key_parts += [file_ + ' ' + str(os.path.getsize(file_)) + ' ' + str(os.path.getmtime(file_))
+                          for file_ in files]
+
+        return hashlib.sha1('\n'.join(key_parts)).hexdigest()
+
+    def _save(self, session, snapshot=None):
         """
         Checkpoints current model.
+
+        If a full snapshot is passed it is checkpointed instead of the current state of the model, by feeding it
+        to the saver's save op, so that checkpoints can be written from a background thread while training
+        continues. The checkpoint is written under a temporary prefix and renamed into place once complete, before
+        it's recorded as the latest checkpoint, so that an interrupted write never leaves a partial checkpoint.
+
+        If checkpoint_base_frequency is greater than one, only every so many checkpoints are full ones, and the
+        ones in between are written as a compressed delta of the variables that changed since the last full
+        checkpoint, which supersedes that checkpoint's previous delta.
         """
 
         checkpoints_dir = self.config.io['checkpoints_directory']
         if not os.path.exists(checkpoints_dir):
             os.makedirs(checkpoints_dir)
-        return self._saver.save(session,
-                                checkpoints_dir,
-                                global_step=self._global_step)
+
+        base_frequency = self.config.io['checkpoint_base_frequency']
+        if snapshot is None and base_frequency == 1:
+            return self._saver.save(session,
+                                    checkpoints_dir,
+                                    global_step=self._global_step)
+        elif snapshot is None:
+            snapshot = self._snapshot(session, full=True)
+
+        if self._delta_base is not None and self._num_deltas < base_frequency - 1:
+            base_prefix, base_values = self._delta_base
+            delta_file = base_prefix + DELTA_CHECKPOINT_SUFFIX
+            _save_checkpoint_delta(delta_file, base_values, {var.op.name: value for var, value in snapshot.iteritems()})
+            self._num_deltas += 1
+
+            return delta_file
+        else:
+            # same naming as Saver.save
+            checkpoint_prefix = checkpoints_dir + '-' + str(snapshot[self._global_step])
+            temp_prefix = checkpoint_prefix + '_temp'
+
+            saver_def = self._saver.saver_def
+            session.run(saver_def.save_tensor_name,
+                        feed_dict=merge_dicts(snapshot, {saver_def.filename_tensor_name: temp_prefix}))
+            tf.train.export_meta_graph(temp_prefix + '.meta', graph=session.graph, saver_def=saver_def)
+
+            # the index is moved last, as a checkpoint is only readable once its index exists
+            for temp_file in sorted(glob(temp_prefix + '.*'), key=lambda file_: file_.endswith('.index')):
+                os.rename(temp_file, checkpoint_prefix + temp_file[len(temp_prefix):])
+
+            # keep the newest max_checkpoints checkpoints, plus one every checkpoint_every_n_hours, as Saver.save does,
+            # and only then record the new one as the latest, so that the recorded ones all exist
+            now = time.time()
+            checkpoints = [(prefix, self._checkpoint_times.get(prefix, now)) for prefix in self._saver.last_checkpoints
+                           if prefix != checkpoint_prefix] + [(checkpoint_prefix, now)]
+            while self.config.io['max_checkpoints'] and len(checkpoints) > self.config.io['max_checkpoints']:
+                prefix, checkpoint_time = checkpoints.pop(0)
+                if checkpoint_time >= self._next_kept_checkpoint_time:
+                    self._next_kept_checkpoint_time = checkpoint_time + self.config.io['checkpoint_every_n_hours'] * 3600
+                else:
+                    tf.train.remove_checkpoint(prefix)
+            self._checkpoint_times = dict(checkpoints)
+            self._saver.set_last_checkpoints_with_time(checkpoints)
+            tf.train.update_checkpoint_state(os.path.dirname(checkpoint_prefix), checkpoint_prefix,
+                                             all_model_checkpoint_paths=[prefix for prefix, _ in checkpoints],
+                                             all_model_checkpoint_timestamps=[t for _, t in checkpoints])
+
+            # start a new series of deltas. those of older checkpoints are no longer needed to resume
+            if base_frequency > 1:
+                self._delta_base = (checkpoint_prefix, {var.op.name: value for var, value in snapshot.iteritems()})
+                self._num_deltas = 0
+                for delta_file in glob(checkpoints_dir + '-*' + DELTA_CHECKPOINT_SUFFIX):
+                    if delta_file != checkpoint_prefix + DELTA_CHECKPOINT_SUFFIX:
+                        os.remove(delta_file)
+
+            return checkpoint_prefix
+
+    def _restore(self, session, checkpoint, training_state=True):
+        """
+        Restores a checkpoint, along with its delta if one was saved.
+
+        Shards of the checkpoint are read in parallel by the restoring savers. If training_state is False only the
+        state needed for prediction is restored. Returns the list of restored variables.
+        """
+
+        vars_, savers = self._restore_savers[training_state]
+        saver_defs = [saver.saver_def for saver in savers]
+        session.run([saver_def.restore_op_name for saver_def in saver_defs],
+                    feed_dict={saver_def.filename_tensor_name: checkpoint for saver_def in saver_defs})
+
+        delta_file = checkpoint + DELTA_CHECKPOINT_SUFFIX
+        if os.path.exists(delta_file):
+            deltas = np.load(delta_file)
+            delta_vars = [var for var in vars_ if var.op.name in deltas.files]
+            for var, value in zip(delta_vars, session.run(delta_vars)):
+                var.load(_apply_checkpoint_delta(value, deltas[var.op.name]), session)
+
+        return vars_
+
+    def _load_ensemble(self, session, checkpoints):
+        """
+        Loads the model weights of each checkpoint into host memory, for use by predict_ensemble.
+
+        Each checkpoint is restored into the session in turn, so that checkpoint formats that depend on
+        the saver (e.g. cuDNN parameters) are handled transparently, and the session's original
+        weights are put back afterwards. Returns a list of {variable: value} dicts.
+        """
+
+        vars_ = tf.trainable_variables() + [var for var in tf.model_variables() if var not in tf.trainable_variables()]
+        restored_vars = self._restore_savers[False][0]
+        original_values = session.run(restored_vars)
+
+        ensemble = []
+        for checkpoint in checkpoints:
+            self._restore(session, checkpoint, training_state=False)
+            ensemble.append(dict(zip(vars_, session.run(vars_))))
+
+        for var, value in zip(restored_vars, original_values):
+            var.load(value, session)
+
+        return ensemble
 
     def _is_done(self):
         """
@@ -553,11 +1146,75 @@ class RGNModel(object):
         """
         return self._coordinator.should_stop()
 
-    def _current_step(self, session):
+    def _current_step(self, session, snapshot=None):
         """
-        Returns the current global step.
+        Returns the current global step, or that of the snapshot if one is passed.
         """
-        return session.run(self._global_step)
+        return session.run(self._global_step, feed_dict=snapshot)
+
+    def _snapshot(self, session, full=False):
+        """
+        Copies the state of the model needed for evaluation into host memory.
+
+        Returns a {variable: value} dict of the model weights, global step, and curriculum step, which can be
+        fed to evaluation models so that they see the model as it was when the snapshot was taken, e.g. while
+        training continues concurrently. Variables that evaluation models update are not included.
+
+        If full is True all checkpointed variables are included instead (optimizer slots, curriculum history,
+        minimum losses achieved, etc.), so that the snapshot can be put back using restore_snapshot.
+        """
+
+        if full:
+            vars_ = tf.global_variables()
+        else:
+            vars_ = tf.trainable_variables() + [var for var in tf.model_variables() if var not in tf.trainable_variables()]
+            vars_ += [self._global_step] + [var for var in tf.global_variables() if var.op.name == SCOPE + '/curriculum_step']
+
+        return dict(zip(vars_, session.run(vars_)))
+
+    def _restore_snapshot(self, session, snapshot):
+        """
+        Loads the values of a snapshot back into the model's variables.
+
+        Used to roll back training in-session, e.g. after a nan, without rebuilding the graph or reading a
+        checkpoint. Values are loaded through the variables' initializers, so no ops are added to the graph.
+        """
+
+        for var, value in snapshot.iteritems():
+            var.load(value, session)
+
+    def _pipeline_health(self, session):
+        """
+        Returns the current values of the ops measuring the health of the input pipeline (see _data_flow).
+        """
+
+        return ops_to_dict(session, self._pipeline_ops)
+
+    def _queue_memory(self):
+        """
+        Returns estimates of the memory taken by the model's input queues when full, as (queue name, capacity,
+        bytes) tuples. Queued records are assumed to be of maximal length, and queued file names are not counted.
+        """
+        scope = SCOPE + '/' + self.config.io['name'] + '/'
+        record_bytes = _record_bytes(self.config.io['num_evo_entries'], self.config.optimization['num_steps'])
+        batch_size = self.config.optimization['batch_size']
+
+        # the queue runners of imported graphs refer to queue ops rather than queues
+        queue_ops = set(qr.queue.queue_ref.op if hasattr(qr.queue, 'queue_ref') else qr.queue
+                        for qr in tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS))
+
+        queues = []
+        for op in sorted([op for op in queue_ops if op.name.startswith(scope)], key=lambda op: op.name):
+            if all(dtype == tf.string for dtype in op.get_attr('component_types')):
+                continue
+
+            # elements are batches if they have a leading batch dimension, as in bucket_by_sequence_length's top queue
+            shapes = [tf.TensorShape(shape) for shape in op.get_attr('shapes')]
+            batched = any(shape.ndims > 1 and shape[0].value == batch_size for shape in shapes)
+            capacity = op.get_attr('capacity')
+            queues.append((op.name, capacity, capacity * record_bytes * (batch_size if batched else 1)))
+
+        return queues
 
     def _finish(self, session, save=True, close_session=True, reset_graph=True):
         """
@@ -578,7 +1235,8 @@ class RGNModel(object):
         RGNModel._num_models = 0
         RGNModel.is_started = False
 
-        del self.train, self.diagnose, self.save, self.is_done, self.current_step, self.finish
+        del self.train, self.train_and_diagnose, self.diagnose, self.save, self.is_done, self.current_step, self.snapshot, \
+            self.restore_snapshot, self.pipeline_health, self.load_ensemble, self.finish
 
 
 # Private functions
@@ -610,9 +1268,207 @@ def _device_function_constructor(functions_on_devices=None, default_device=''):
     return device_function
 
 
-def _data_flow(config, max_length):
+def _shard_savers(saveables, num_shards):
+    """ Returns the variables among saveables and a list of savers, each for one of num_shards shards of saveables.
+
+        Variables are spread greedily by size, largest first, so that the shards take similar times to restore.
+        Other saveable objects (whose size isn't known statically) are assigned to the first shard.
+    """
+
+    sizes = [(var.shape.num_elements() or 0) * var.dtype.base_dtype.size if isinstance(var, tf.Variable) else 0
+             for var in saveables]
+
+    shards = [[] for _ in range(num_shards)]
+    shard_sizes = [0] * num_shards
+    for size, saveable in sorted(zip(sizes, saveables), key=lambda size_and_saveable: -size_and_saveable[0]):
+        lightest = shard_sizes.index(min(shard_sizes)) if size > 0 else 0
+        shards[lightest].append(saveable)
+        shard_sizes[lightest] += size
+
+    vars_ = [saveable for saveable in saveables if isinstance(saveable, tf.Variable)]
+    savers = [tf.train.Saver(var_list=shard, name='restore_shard_' + str(i)) for i, shard in enumerate(shards) if shard]
+
+    return vars_, savers
+
+
+def _write_trace(prefix, run_metadata, queues=()):
+    """
+    Writes the timeline of a traced run in Chrome trace format (for chrome://tracing), a summary of the time
+    spent in its ops by op type and by name scope, on each device, and a summary of its memory use along with
+    the passed queue estimates (see _write_memory_summary).
+    """
+
+    if not os.path.exists(os.path.dirname(prefix)):
+        os.makedirs(os.path.dirname(prefix))
+
+    with open(prefix + TIMELINE_SUFFIX, 'w') as file_:
+        file_.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+
+    # total microseconds and number of ops, keyed by (kind, device, op type or scope)
+    op_times = {}
+    device_times = {}
+    starts, ends = [], []
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            label = node_stats.timeline_label
+            op_type = label.split(' = ', 1)[1].split('(', 1)[0] if ' = ' in label \
+                else node_stats.node_name.split(':')[-1]
+            scope = _trace_scope(node_stats.node_name, TRACE_SCOPE_DEPTH)
+
+            device = dev_stats.device.split('device:')[-1]  # e.g. CPU:0, or GPU:0/stream:all
+            for key in [('op type', device, op_type), ('scope', device, scope)]:
+                times = op_times.setdefault(key, [0, 0])
+                times[0] += node_stats.all_end_rel_micros
+                times[1] += 1
+            device_times[device] = device_times.get(device, 0) + node_stats.all_end_rel_micros
+            starts.append(node_stats.all_start_micros)
+            ends.append(node_stats.all_start_micros + node_stats.all_end_rel_micros)
+
+    # ops run concurrently, so their times add up to more than the wall time of the run
+    lines = ['wall time: {:.3f} ms'.format((max(ends) - min(starts)) / 1000. if starts else 0.)]
+    for kind in ['op type', 'scope']:
+        lines += ['', '{:>12} {:>7} {:>8}  device  {}'.format('total ms', '% dev', 'ops', kind)]
+        for (_, device, name), (micros, count) in sorted([item for item in op_times.iteritems() if item[0][0] == kind],
+                                                         key=lambda item: -item[1][0]):
+            lines.append('{:12.3f} {:7.1f} {:8d}  {}  {}'.format(micros / 1000.,
+                                                                 100. * micros / max(device_times[device], 1),
+                                                                 count, device, name))
+
+    with open(prefix + TRACE_SUMMARY_SUFFIX, 'w') as file_:
+        file_.write('\n'.join(lines) + '\n')
+
+    _write_memory_summary(prefix + TRACE_MEMORY_SUFFIX, run_metadata, queues)
+
+
+def _write_memory_summary(filename, run_metadata, queues=()):
+    """
+    Writes the peak memory of each allocator during a traced run, and the peak memory of each model and name
+    scope (stage) on their own and at the allocator's peak. Peaks are found by replaying the run's allocations
+    and deallocations in order. The estimated memory of queues, as returned by _queue_memory, is appended,
+    as queues are filled outside of the run.
+    """
+
+    # allocations (positive) and deallocations (negative) of each allocator, as (micros, bytes, model, scope)
+    allocations = {}
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            model = _trace_scope(node_stats.node_name, 2, gradients_suffix='')
+            scope = _trace_scope(node_stats.node_name, TRACE_SCOPE_DEPTH)
+            for memory in node_stats.memory:
+                allocations.setdefault(memory.allocator_name, []).extend(
+                    [(record.alloc_micros, record.alloc_bytes, model, scope) for record in memory.allocation_records])
+
+    lines = []
+    for allocator, records in sorted(allocations.iteritems()):
+        # live, peak, and total allocated bytes, keyed by (kind, model or scope)
+        live, peaks, allocated = {}, {}, {}
+        total = peak = 0
+        live_at_peak = {}
+        for _, bytes_, model, scope in sorted(records):
+            total += bytes_
+            for key in [('model', model), ('scope', scope)]:
+                live[key] = live.get(key, 0) + bytes_
+                peaks[key] = max(peaks.get(key, 0), live[key])
+                allocated[key] = allocated.get(key, 0) + max(bytes_, 0)
+            if total > peak:
+                peak, live_at_peak = total, dict(live)
+
+        lines += ['{} allocator peak: {:.3f} MB'.format(allocator, peak / 1e6)]
+        for kind in ['model', 'scope']:
+            lines += ['', '{:>12} {:>12} {:>12}  {}'.format('peak MB', 'at peak MB', 'allocated MB', kind)]
+            for key, key_peak in sorted([item for item in peaks.iteritems() if item[0][0] == kind and item[1] >= 500],
+                                        key=lambda item: -item[1]):  # peaks that round to zero MB are left out
+                lines.append('{:12.3f} {:12.3f} {:12.3f}  {}'.format(key_peak / 1e6,
+                                                                     max(live_at_peak.get(key, 0), 0) / 1e6,
+                                                                     allocated[key] / 1e6,
+                                                                     key[1]))
+        lines.append('')
+
+    if queues:
+        lines += ['queues (estimated when full)', '{:>12} {:>12}  {}'.format('capacity', 'MB', 'queue')]
+        for name, capacity, bytes_ in queues:
+            lines.append('{:12d} {:12.3f}  {}'.format(capacity, bytes_ / 1e6, name))
+        lines.append('{:>12} {:12.3f}'.format('total', sum(bytes_ for _, _, bytes_ in queues) / 1e6))
+
+    with open(filename, 'w') as file_:
+        file_.write('\n'.join(lines) + '\n')
+
+
+def _trace_scope(node_name, depth, gradients_suffix=' (gradients)'):
+    """
+    Returns the name scope of a traced node up to depth, e.g. RGN/training/point_to_coordinate for depth 3.
+    Gradient ops are attributed to the scope of the ops they're the gradients of, followed by gradients_suffix.
+    """
+
+    name = node_name.split(':')[0]
+    forward_name = name.split('/gradients/', 1)[-1]
+
+    return ('/'.join(forward_name.split('/')[:-1][:depth]) or '/') + (gradients_suffix if forward_name != name else '')
+
+
+def _record_bytes(num_evo_entries, length):
+    """
+    Returns the bytes taken by a record of the given length as read by read_protein, not counting its id. The
+    tertiary masking matrix dominates, growing quadratically with length.
+    """
+
+    return 4 * (length * (NUM_AAS + num_evo_entries + 1 + NUM_DIHEDRALS * NUM_DIMENSIONS) + length ** 2 + 3)
+
+
+_GraphElementName = namedtuple('_GraphElementName', ['kind', 'name'])  # picklable reference to a graph element
+
+
+def _graph_elements_to_names(obj):
+    """ Returns a copy of obj (nested dicts, lists, and tuples) with graph elements replaced by their names """
+
+    if isinstance(obj, tf.Variable):
+        return _GraphElementName('variable', obj.op.name)
+    elif isinstance(obj, (tf.Tensor, tf.Operation)):
+        return _GraphElementName('element', obj.name)
+    elif isinstance(obj, tf.train.Saver):
+        return _GraphElementName('saver', obj.saver_def.SerializeToString())
+    elif isinstance(obj, dict):
+        return {_graph_elements_to_names(k): _graph_elements_to_names(v) for k, v in obj.iteritems()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_graph_elements_to_names(v) for v in obj)
+    else:
+        return obj
+
+
+def _names_to_graph_elements(obj, variables=None):
+    """ Inverse of _graph_elements_to_names, looking up graph elements in the default graph """
+
+    if variables is None:
+        variables = {var.op.name: var for var in tf.global_variables() + tf.local_variables()}
+
+    if isinstance(obj, _GraphElementName):
+        for case in Switch(obj.kind):
+            if case('variable'):
+                return variables[obj.name]
+            elif case('element'):
+                return tf.get_default_graph().as_graph_element(obj.name)
+            elif case('saver'):
+                return tf.train.Saver(saver_def=tf.train.SaverDef.FromString(obj.name))
+    elif isinstance(obj, dict):
+        return {_names_to_graph_elements(k, variables): _names_to_graph_elements(v, variables)
+                for k, v in obj.iteritems()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_names_to_graph_elements(v, variables) for v in obj)
+    else:
+        return obj
+
+
+@timed_calls('data flow')
+def _data_flow(config, max_length, groups=None):
     """
     Creates TF queues and nodes for inputting and batching data.
+
+    If groups are passed, the index of each protein's group is resolved as it's read, and returned
+    as an integer vector (with -1 for proteins belonging to no group), otherwise None is returned.
+
+    Also returns a dict of ops that measure the health of the pipeline: cumulative counts of records read and of
+    records dropped for exceeding max_length, the cumulative time spent waiting on batches from the start of runs
+    and the number of batches waited on, and the fill levels of the queues.
     """
     # files
     if config['data_files'] is not None:
@@ -633,6 +1489,13 @@ def _data_flow(config, max_length):
                           max_length,
                           config['num_edge_residues'],
                           config['num_evo_entries'])
+    if groups:
+        inputs = inputs[:-2] + (group_index(inputs[0], groups),) + inputs[-2:]
+
+    # count records as they're read. health counters are local variables, so they're neither saved nor restored
+    records_read = _local_counter('records_read')
+    with tf.control_dependencies([tf.assign_add(records_read, 1)]):
+        inputs = tuple(tf.identity(input_) for input_ in inputs)
 
     # randomization
     if config['shuffle']:  # based on https://github.com/tensorflow/tensorflow/issues/5147#issuecomment-271086206
@@ -652,6 +1515,11 @@ def _data_flow(config, max_length):
             tensor.set_shape(shape)
     num_steps, keep = inputs[-2:]
 
+    # count records dropped by the batching queue for being too long
+    records_dropped = _local_counter('records_dropped')
+    with tf.control_dependencies([tf.assign_add(records_dropped, tf.to_int64(tf.logical_not(keep)))]):
+        keep = tf.identity(keep)
+
     # bucketing
     if config['bucket_boundaries']:
         batch_fun = tf.contrib.training.bucket_by_sequence_length
@@ -664,15 +1532,192 @@ def _data_flow(config, max_length):
         batch_kwargs = {'capacity': config['batch_queue_capacity']}
         sel_slice = slice(len(inputs) - 1)
 
-    # batching
-    inputs = batch_fun(tensors=list(inputs)[:-1],
-                       keep_input=keep,
-                       dynamic_pad=True,
-                       batch_size=config['batch_size'],
-                       name='batching_queue',
-                       **batch_kwargs)
-    ids, primaries_batch_major, evolutionaries_batch_major, secondaries_batch_major, tertiaries_batch_major, masks_batch_major, num_steps = inputs[sel_slice]
+    # batching. the time from the start of the run until the batch is dequeued is what's spent waiting on it. the
+    # dequeue waits on the start stamp, so that the stamp can't be taken after it
+    dequeue_start = tf.timestamp()
+    queue_runners = tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS)
+    with tf.control_dependencies([dequeue_start]):
+        inputs = batch_fun(tensors=list(inputs)[:-1],
+                           keep_input=keep,
+                           dynamic_pad=True,
+                           batch_size=config['batch_size'],
+                           name='batching_queue',
+                           **batch_kwargs)
+    inputs = inputs[sel_slice]
+    batching_queues = [qr.queue for qr in tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS) if qr not in queue_runners]
+
+    with tf.control_dependencies(inputs):
+        dequeue_wait = tf.timestamp() - dequeue_start
+    total_dequeue_wait, num_dequeues = _local_counter('dequeue_wait', tf.float64), _local_counter('dequeues')
+    with tf.control_dependencies([tf.assign_add(total_dequeue_wait, dequeue_wait), tf.assign_add(num_dequeues, 1)]):
+        inputs = [tf.identity(input_) for input_ in inputs]
+
+    pipeline_ops = {'records_read': records_read,
+                    'records_dropped': records_dropped,
+                    'dequeue_wait': total_dequeue_wait,
+                    'dequeues': num_dequeues,
+                    'file_queue_fill': _queue_fill([file_queue]),
+                    'batching_queue_fill': _queue_fill(batching_queues)}
+    if config['shuffle']:
+        # noinspection PyUnboundLocalVariable
+        pipeline_ops.update({'randomization_queue_fill': _queue_fill([randomized_queue])})
+    ids, primaries_batch_major, evolutionaries_batch_major, secondaries_batch_major, tertiaries_batch_major, masks_batch_major = inputs[:6]
+    num_steps = inputs[-1]
+    group_indices = tf.identity(inputs[6], name='group_indices') if groups else None
+
+    return _time_step_major(ids, primaries_batch_major, evolutionaries_batch_major, secondaries_batch_major,
+                            tertiaries_batch_major, masks_batch_major, num_steps) + (group_indices, pipeline_ops)
+
+
+def _local_counter(name, dtype=tf.int64):
+    """ Creates a scalar local variable, initialized to zero, for accumulating counts """
+
+    return tf.Variable(tf.zeros([], dtype), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name=name)
+
+
+def _queue_fill(queues):
+    """ Returns the fraction of the total capacity of queues that's filled """
 
+    capacity = sum(queue.queue_ref.op.get_attr('capacity') for queue in queues)
+    return tf.to_float(tf.add_n([queue.size() for queue in queues])) / capacity
+
+
+@timed_calls('cached data read')
+def _cached_data_arrays(config, max_length, groups=None):
+    """
+    Reads the data that is held in memory by _cached_data_flow into a dict of numpy arrays.
+
+    Proteins are sorted by length and grouped into fixed batches, so that every pass over the data
+    yields the same batches with minimal padding. The last batch is filled up by repeating the
+    longest protein, and the repeats are marked as invalid so that they can be excluded from losses.
+    Group indices are resolved here once, with repeated proteins belonging to no group.
+    """
+    if not isinstance(max_length, int):
+        raise RuntimeError('Cached data cannot be used with a length curriculum.')
+
+    # files
+    if config['data_files'] is not None:
+        files = config['data_files']
+    else:
+        files = glob(config['data_files_glob'])
+
+    # read all proteins, sort by length, and fill up last batch
+    proteins = [protein for protein in _read_proteins(files, config['num_edge_residues'], config['num_evo_entries'])
+                if len(protein['primary']) <= max_length]
+    if not proteins:
+        raise RuntimeError('No proteins found in ' + str(files) + '.')
+    proteins.sort(key=lambda protein: (len(protein['primary']), protein['id']))
+
+    batch_size = config['batch_size']
+    num_batches = -(-len(proteins) // batch_size)
+    num_padding = num_batches * batch_size - len(proteins)
+    valid = np.array([True] * len(proteins) + [False] * num_padding)
+    proteins += proteins[-1:] * num_padding
+
+    # pad into arrays of the longest protein. primary is padded with -1 so that its one-hot encoding is all zeros
+    def pad(key, value=0):
+        arrays = [protein[key] for protein in proteins]
+        padded = np.full((len(arrays), max(len(array) for array in arrays)) + arrays[0].shape[1:], value,
+                         dtype=arrays[0].dtype)
+        for i, array in enumerate(arrays):
+            padded[i, :len(array)] = array
+        return padded
+
+    arrays = {'ids': np.array([protein['id'] for protein in proteins], dtype=object),
+              'primaries': pad('primary', -1),
+              'evolutionaries': pad('evolutionary'),
+              'secondaries': pad('secondary'),
+              'tertiaries': pad('tertiary'),
+              'masks': pad('mask'),
+              'num_steps': np.array([len(protein['primary']) for protein in proteins], dtype=np.int32),
+              'tertiary_lengths': np.array([len(protein['tertiary']) for protein in proteins], dtype=np.int32),
+              'mask_lengths': np.array([len(protein['mask']) for protein in proteins], dtype=np.int32),
+              'valid': valid}
+    if groups:
+        group_indices = [groups.index(protein['id'].split('#')[0]) if protein['id'].split('#')[0] in groups else -1
+                         for protein in proteins]
+        arrays.update({'group_indices': np.where(valid, group_indices, -1).astype(np.int32)})
+
+    return arrays
+
+
+@timed_calls('cached data flow')
+def _cached_data_flow(config, arrays, groups=None):
+    """
+    Creates TF nodes for inputting and batching data that is read once and held in memory.
+
+    The arrays, as returned by _cached_data_arrays, only determine the shapes of the nodes and are not
+    embedded in the graph. They are fed to the load op's placeholders when the model is started.
+
+    Returns the same nodes as _data_flow, plus a boolean vector indicating valid batch entries and
+    a dict of ops for loading the data into memory and for rewinding to the first batch.
+    """
+    batch_size = config['batch_size']
+    num_batches = len(arrays['valid']) // batch_size
+
+    # hold arrays in variables outside of all collections, so that they're neither initialized globally nor saved
+    cache = {}
+    placeholders = {}
+    for key, array in arrays.iteritems():
+        placeholders[key] = tf.placeholder(tf.string if array.dtype == object else tf.as_dtype(array.dtype),
+                                           array.shape)
+        cache[key] = tf.Variable(placeholders[key], trainable=False, collections=[], name='cached_' + key)
+
+    # iterate over batch indices, and slice and trim batches to their longest protein
+    iterator = tf.data.Dataset.range(num_batches).repeat(config['num_epochs']).make_initializable_iterator()
+    start = tf.to_int32(iterator.get_next()) * batch_size
+    batch = {key: var[start:start + batch_size] for key, var in cache.iteritems()}
+
+    ids = batch['ids']
+    num_steps = batch['num_steps']
+    max_steps = tf.reduce_max(num_steps)
+    primaries_batch_major = tf.one_hot(batch['primaries'][:, :max_steps], NUM_AAS)
+    evolutionaries_batch_major = batch['evolutionaries'][:, :max_steps]
+    secondaries_batch_major = batch['secondaries'][:, :max_steps]
+    tertiaries_batch_major = batch['tertiaries'][:, :tf.reduce_max(batch['tertiary_lengths'])]
+    masks = batch['masks'][:, :tf.reduce_max(batch['mask_lengths'])]
+    masks_batch_major = tf.expand_dims(masks, 2) * tf.expand_dims(masks, 1)
+    group_indices = tf.identity(batch['group_indices'], name='group_indices') if groups else None
+    for tensor in [ids, num_steps, primaries_batch_major, evolutionaries_batch_major, secondaries_batch_major,
+                   tertiaries_batch_major, masks_batch_major, batch['valid']]:
+        tensor.set_shape([batch_size] + tensor.get_shape().as_list()[1:])
+
+    data_ops = {'load_op': tf.group(*[var.initializer for var in cache.values()]),
+                'load_placeholders': placeholders,
+                'rewind_op': iterator.initializer,
+                'num_batches': num_batches}
+
+    return _time_step_major(ids, primaries_batch_major, evolutionaries_batch_major, secondaries_batch_major,
+                            tertiaries_batch_major, masks_batch_major, num_steps) + (group_indices, batch['valid'],
+                                                                                     data_ops)
+
+
+def _read_proteins(files, num_edge_residues, num_evo_entries):
+    """
+    Reads all proteins in files into a list of dicts of numpy arrays, using a separate graph and session.
+    """
+    proteins = []
+    with tf.Graph().as_default():
+        dataset = tf.data.TFRecordDataset(files).map(
+            lambda serialized_example: parse_protein(serialized_example, num_edge_residues, num_evo_entries))
+        next_protein = dataset.make_one_shot_iterator().get_next()
+        with tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})) as session:
+            while True:
+                try:
+                    id_, primary, evolutionary, secondary, tertiary, mask, _ = session.run(next_protein)
+                except tf.errors.OutOfRangeError:
+                    break
+                proteins.append({'id': id_, 'primary': primary, 'evolutionary': evolutionary,
+                                 'secondary': secondary, 'tertiary': tertiary, 'mask': mask})
+
+    return proteins
+
+
+def _time_step_major(ids, primaries_batch_major, evolutionaries_batch_major, secondaries_batch_major,
+                     tertiaries_batch_major, masks_batch_major, num_steps):
+    """
+    Transposes batch major data to time step major and names the resulting nodes.
+    """
     # transpose to time_step major
     primaries = tf.transpose(primaries_batch_major, perm=(1, 0, 2), name='primaries')
     # primary sequences, i.e. one-hot sequences of amino acids.
@@ -728,6 +1773,7 @@ def _inputs(config, primaries, evolutionaries):
     return inputs
 
 
+@timed_calls('weights')
 def _weights(config, masks, curriculum_step=None):
     """
     Returns dRMSD weights that mask meaningless (missing or longer than
@@ -768,6 +1814,7 @@ def _weights(config, masks, curriculum_step=None):
         raise NotImplementedError('Model does not currently support anything other than C alpha atoms for the loss function.')
 
 
+@timed_calls('recurrence')
 def _higher_recurrence(mode, config, inputs, num_steps, alphabet=None):
     """
     Higher-order recurrence that creates multiple layers, possibly with interleaving dihedrals.
@@ -1062,6 +2109,7 @@ def _alphabet(mode, config):
     return alphabet
 
 
+@timed_calls('dihedrals')
 def _dihedrals(mode, config, inputs, alphabet=None):
     """
     Converts internal representation resultant from RNN output activations
@@ -1200,6 +2248,7 @@ def _dihedrals(mode, config, inputs, alphabet=None):
     return dihedrals
 
 
+@timed_calls('coordinates')
 def _coordinates(config, dihedrals):
     """
     Converts dihedrals into full 3D structures.
@@ -1214,6 +2263,26 @@ def _coordinates(config, dihedrals):
     return coordinates
 
 
+def _ensemble_coordinates(config, ensemble_dihedrals):
+    """
+    Converts the dihedrals of an ensemble of models into consensus 3D structures, using their circular means.
+    """
+    # [NUM_MEMBERS, NUM_STEPS x BATCH_SIZE x NUM_DIHEDRALS]
+    num_members = tf.shape(ensemble_dihedrals)[0]
+    flattened_dihedrals = tf.reshape(ensemble_dihedrals, tf.stack([num_members, -1]))
+
+    # equal weights for all members; their scale is irrelevant to the resulting angles
+    radii = tf.ones(tf.stack([1, num_members]), dtype=ensemble_dihedrals.dtype)
+    mean_dihedrals = reduce_mean_angle(radii, flattened_dihedrals)  # [1, NUM_STEPS x BATCH_SIZE x NUM_DIHEDRALS]
+
+    # [NUM_STEPS, BATCH_SIZE, NUM_DIHEDRALS]
+    dihedrals = tf.reshape(mean_dihedrals, tf.shape(ensemble_dihedrals)[1:])
+    dihedrals.set_shape(ensemble_dihedrals.get_shape()[1:])
+
+    return _coordinates(config, dihedrals)
+
+
+@timed_calls('drmsds')
 def _drmsds(config, coordinates, targets, weights):
     """
     Computes reduced weighted dRMSD loss (as specified by weights)
@@ -1239,93 +2308,155 @@ def _drmsds(config, coordinates, targets, weights):
     return drmsds
 
 
-def _reduce_loss_quotient(config, losses, masks, group_filter, name_prefix=''):
+@timed_calls('loss factors')
+def _loss_quotient_factors(config, losses, masks):
     """
-    Reduces loss according to normalization order.
+    Returns the per-protein contributions to the numerator and denominator of the loss quotient,
+    according to normalization order.
     """
     normalization = config['tertiary_normalization']
     num_edge_residues = config['num_edge_residues']
     max_seq_length = config['num_steps']
 
-    losses_filtered = tf.boolean_mask(losses, group_filter)  # will give problematic results if all entries are removed
-
     for case in Switch(normalization):
         if case('zeroth'):
-            loss_factors = tf.ones_like(losses_filtered)
+            loss_factors = tf.ones_like(losses)
         elif case('first'):
-            loss_factors = tf.boolean_mask(effective_steps(masks, num_edge_residues), group_filter)
+            loss_factors = effective_steps(masks, num_edge_residues)
             fixed_denominator_factor = float(max_seq_length - num_edge_residues)
         elif case('second'):
-            eff_num_steps = tf.boolean_mask(effective_steps(masks, num_edge_residues), group_filter)
+            eff_num_steps = effective_steps(masks, num_edge_residues)
             loss_factors = (tf.square(eff_num_steps) - eff_num_steps) / 2.0
             fixed_denominator_factor = float(max_seq_length - num_edge_residues)
             fixed_denominator_factor = ((fixed_denominator_factor ** 2) - fixed_denominator_factor) / 2.0
 
-    # noinspection PyUnboundLocalVariable
-    numerator = tf.reduce_sum(loss_factors * losses_filtered, name=name_prefix + '_numerator')
-
     if config['batch_dependent_normalization'] or normalization == 'zeroth':
-        denominator = tf.reduce_sum(loss_factors, name=name_prefix + '_denominator')
+        # noinspection PyUnboundLocalVariable
+        denominator_factors = loss_factors
     else:
         # noinspection PyUnboundLocalVariable
-        denominator = tf.multiply(tf.cast(tf.size(loss_factors),
-                                          tf.float32),
-                                  fixed_denominator_factor,
-                                  name=name_prefix + '_denominator')
+        denominator_factors = tf.fill(tf.shape(loss_factors), fixed_denominator_factor)
+
+    return loss_factors, denominator_factors
+
+
+@timed_calls('loss reduction')
+def _reduce_loss_quotients(config, losses, masks, memberships, name_prefix=''):
+    """
+    Reduces loss of all groups at once according to normalization order.
+
+    memberships is a [BATCH_SIZE, NUM_GROUPS] boolean matrix, and the returned numerators and
+    denominators are [NUM_GROUPS] vectors. Groups with no members will give problematic results.
+    """
+    numerator_factors, denominator_factors = _loss_quotient_factors(config, losses, masks)
+
+    # non-members are selected out rather than multiplied by zero, so that they can't contaminate groups with nans
+    def reduce_by_group(contributions, name):
+        contributions = tf.tile(tf.expand_dims(contributions, 1), [1, tf.shape(memberships)[1]])
+        return tf.reduce_sum(tf.where(memberships, contributions, tf.zeros_like(contributions)), axis=0, name=name)
+
+    numerators = reduce_by_group(numerator_factors * losses, name_prefix + '_numerators')
+    denominators = reduce_by_group(denominator_factors, name_prefix + '_denominators')
 
-    return numerator, denominator
+    return numerators, denominators
 
 
-def _accumulate_loss(config, numerator, denominator, name_prefix=''):
+def _exact_losses(protein_dict, loss_groups, loss_nodes):
     """
-    Constructs ops to accumulate and reduce loss and maintain a memory of lowest loss achieved.
+    Reduces per-protein dRMSDs, as fetched by an exact evaluation, into the losses of all groups, and
+    returns a feed dict mapping loss nodes (keyed by prefix) to their values.
+
+    Only proteins marked valid are included. Groups without members (or whose members have no
+    effective residues) have a nan loss, as they do when reduced in the graph.
+    """
+    valid = protein_dict['valid']
+
+    feed_dict = {}
+    for prefix, loss_node in loss_nodes.iteritems():
+        memberships = valid[:, np.newaxis]
+        if 'group_indices' in protein_dict:
+            memberships = np.concatenate([memberships, valid[:, np.newaxis] & (
+                protein_dict['group_indices'][:, np.newaxis] == np.arange(len(loss_groups[prefix]) - 1))], axis=1)
+        contributions = protein_dict['numerator_factors'] * protein_dict[prefix + 'drmsds']
+        numerators = np.sum(np.where(memberships, contributions[:, np.newaxis], 0.), axis=0)
+        denominators = np.sum(np.where(memberships, protein_dict['denominator_factors'][:, np.newaxis], 0.), axis=0)
+
+        losses = np.full(numerators.shape, np.nan, dtype=np.float32)
+        nonempty = denominators > 0
+        losses[nonempty] = numerators[nonempty] / denominators[nonempty]
+        feed_dict.update({loss_node: losses})
+
+    return feed_dict
+
+
+@timed_calls('loss accumulation')
+def _accumulate_losses(config, numerators, denominators, name_prefix=''):
+    """
+    Constructs ops to accumulate and reduce losses of all groups.
     """
 
-    if config['num_evaluation_invocations'] == 1:
-        # return simple loss
-        accumulated_loss = tf.divide(numerator,
-                                     denominator,
-                                     name=name_prefix)
+    if config['exact_evaluation']:
+        # losses are reduced on the host and fed in
+        accumulated_losses = tf.placeholder(tf.float32, shape=numerators.get_shape(), name=name_prefix)
+        update_op = reduce_op = tf.no_op()
+    elif config['num_evaluation_invocations'] == 1:
+        # return simple losses
+        accumulated_losses = tf.divide(numerators,
+                                       denominators,
+                                       name=name_prefix)
         update_op = reduce_op = tf.no_op()
     else:
-        # create accumulator variables. note that tf.Variable uses name_scope (not variable_scope) for naming, which is what's desired in this instance
-        numerator_accumulator = tf.Variable(initial_value=0.,
+        # create accumulator variables. these are transient, and so are local variables that aren't checkpointed.
+        # note that tf.Variable uses name_scope (not variable_scope) for naming, which is what's desired in this instance
+        numerator_accumulator = tf.Variable(initial_value=tf.zeros(numerators.get_shape()),
                                             trainable=False,
+                                            collections=[tf.GraphKeys.LOCAL_VARIABLES],
                                             name=name_prefix + '_numerator_accumulator')
-        denominator_accumulator = tf.Variable(initial_value=0.,
+        denominator_accumulator = tf.Variable(initial_value=tf.zeros(denominators.get_shape()),
                                               trainable=False,
+                                              collections=[tf.GraphKeys.LOCAL_VARIABLES],
                                               name=name_prefix + '_denominator_accumulator')
 
         # accumulate
-        with tf.control_dependencies([numerator, denominator, numerator_accumulator, denominator_accumulator]):
-            accumulate_numerator = tf.assign_add(numerator_accumulator, numerator)
-            accumulate_denominator = tf.assign_add(denominator_accumulator, denominator)
+        with tf.control_dependencies([numerators, denominators, numerator_accumulator, denominator_accumulator]):
+            accumulate_numerator = tf.assign_add(numerator_accumulator, numerators)
+            accumulate_denominator = tf.assign_add(denominator_accumulator, denominators)
             update_op = tf.group(accumulate_numerator, accumulate_denominator, name=name_prefix + '_accumulate_op')
 
-        # divide to get final quotient
+        # divide to get final quotients
         with tf.control_dependencies([update_op]):
-            accumulated_loss = tf.divide(numerator_accumulator, denominator_accumulator,
-                                         name=name_prefix + '_accumulated')
+            accumulated_losses = tf.divide(numerator_accumulator, denominator_accumulator,
+                                           name=name_prefix + '_accumulated')
 
         # zero accumulators
-        with tf.control_dependencies([accumulated_loss]):
-            zero_numerator = tf.assign(numerator_accumulator, 0.)
-            zero_denominator = tf.assign(denominator_accumulator, 0.)
+        with tf.control_dependencies([accumulated_losses]):
+            zero_numerator = tf.assign(numerator_accumulator, tf.zeros_like(numerator_accumulator))
+            zero_denominator = tf.assign(denominator_accumulator, tf.zeros_like(denominator_accumulator))
             reduce_op = tf.group(zero_numerator, zero_denominator, name=name_prefix + '_reduce_op')
 
+    return accumulated_losses, update_op, reduce_op
+
+
+@timed_calls('minimum loss')
+def _min_loss(loss, name_prefix=''):
+    """
+    Constructs ops to maintain a memory of lowest loss achieved.
+    """
+
     min_loss_achieved = tf.Variable(initial_value=float('inf'),
                                     trainable=False,
                                     name='min_' + name_prefix + '_achieved')
     min_loss_op = tf.assign(min_loss_achieved,
                             tf.reduce_min([min_loss_achieved,
-                                           accumulated_loss]),
+                                           loss]),
                             name='min_' + name_prefix + '_achieved_op')
     with tf.control_dependencies([min_loss_op]):
         min_loss_achieved = tf.identity(min_loss_achieved)
 
-    return accumulated_loss, min_loss_achieved, min_loss_op, update_op, reduce_op
+    return min_loss_achieved, min_loss_op
 
 
+@timed_calls('optimizer')
 def _training(config, loss):
     """
     Creates loss optimizer and returns minimization op.
@@ -1367,14 +2498,25 @@ def _training(config, loss):
     minimize_op = optimizer.apply_gradients(grads_and_vars,
                                             global_step=global_step)
 
-    # dict useful for diagnostics
+    # dicts useful for diagnostics
     grads_and_vars_dict = {}
     grads_and_vars_dict.update({('g' + str(i)): g for i, (g, _) in enumerate(grads_and_vars)})
     grads_and_vars_dict.update({('v' + str(i)): v for i, (_, v) in enumerate(grads_and_vars)})
 
-    return global_step, minimize_op, grads_and_vars_dict
+    # extrema and norms are reduced on the device, so that only scalars need to be fetched
+    grads = [g for g, _ in grads_and_vars]
+    vars_ = [v for _, v in grads_and_vars]
+    extrema_dict = {'min_weight': tf.reduce_min([tf.reduce_min(v) for v in vars_]),
+                    'max_weight': tf.reduce_max([tf.reduce_max(v) for v in vars_]),
+                    'min_grad': tf.reduce_min([tf.reduce_min(g) for g in grads]),
+                    'max_grad': tf.reduce_max([tf.reduce_max(g) for g in grads])}
+    norms_dict = {'weight_norm': tf.global_norm(vars_),
+                  'grad_norm': tf.global_norm(grads)}
 
+    return global_step, minimize_op, grads_and_vars_dict, extrema_dict, norms_dict
 
+
+@timed_calls('curriculum')
 def _history(loss, loss_history=None, scaling_factor=LOSS_SCALING_FACTOR):
     """
     Creates op for loss history updating.
@@ -1389,6 +2531,7 @@ def _history(loss, loss_history=None, scaling_factor=LOSS_SCALING_FACTOR):
     return update_op
 
 
+@timed_calls('curriculum')
 def _curriculum(config, step, loss_history, dependency_ops):
     """
     Creates TF ops for maintaining and advancing the curriculum.
@@ -1448,3 +2591,43 @@ def _curriculum(config, step, loss_history, dependency_ops):
                                   name='update_curriculum_op')
 
     return update_op
+
+
+def _checkpoint_bytes(value):
+    """ Returns the raw bytes of an array (or scalar) as a flat uint8 array, grouped by position within elements.
+
+        Grouping the bytes by position (i.e. all the first bytes of elements, then all the second ones, and so on)
+        puts the slowly changing sign and exponent bytes of floats next to each other, which helps compression.
+    """
+
+    value = np.ascontiguousarray(value)
+
+    return value.reshape(-1).view(np.uint8).reshape(-1, value.itemsize).T.reshape(-1)
+
+
+def _save_checkpoint_delta(filename, base_values, values):
+    """ Saves the bytewise XOR of values against base_values, both {name: array} dicts, as a compressed npz file.
+
+        Unchanged variables are omitted, and the bits of changed ones that are the same in both (e.g. signs and
+        exponents of slowly changing weights) are zero and so compress well. The file is written under a
+        temporary name and renamed into place, so an interrupted write leaves any previous delta intact.
+    """
+
+    deltas = {}
+    for name, value in values.iteritems():
+        delta = np.bitwise_xor(_checkpoint_bytes(value), _checkpoint_bytes(base_values[name]))
+        if delta.any():
+            deltas[name] = delta
+
+    temp_filename = filename[:-len('.npz')] + '_temp.npz'
+    np.savez_compressed(temp_filename, **deltas)
+    os.rename(temp_filename, filename)
+
+
+def _apply_checkpoint_delta(base_value, delta):
+    """ Returns the value encoded by a delta saved by _save_checkpoint_delta, given the value it was taken against """
+
+    base_value = np.asarray(base_value)
+    value_bytes = np.bitwise_xor(_checkpoint_bytes(base_value), delta).reshape(base_value.itemsize, -1).T
+
+    return np.ascontiguousarray(value_bytes).view(base_value.dtype).reshape(base_value.shape)
@@ -19,6 +19,8 @@ __author__ = "Mohammed AlQuraishi"
 __copyright__ = "Copyright 2018, Harvard Medical School"
 __license__ = "MIT"
 
+import re
+
 import numpy as np
 import tensorflow as tf
 
@@ -125,6 +127,44 @@ def read_protein(filename_queue, max_length, num_edge_residues, num_evo_entries,
         _, serialized_example = reader.read(filename_queue)
 
         # Parse TF Record
+        id_, primary, evolutionary, secondary, tertiary, mask, pri_length = parse_protein(serialized_example,
+                                                                                          num_edge_residues,
+                                                                                          num_evo_entries)
+
+        # Predicate for when to retain protein
+        keep = pri_length <= max_length
+
+        # Convert primary to one-hot
+        one_hot_primary = tf.one_hot(primary, NUM_AAS)
+
+        # Generate tertiary masking matrix
+        ter_mask = masking_matrix(mask, name='ter_mask')
+
+        # Return tuple
+        return id_, one_hot_primary, evolutionary, secondary, tertiary, ter_mask, pri_length, keep
+
+
+def parse_protein(serialized_example, num_edge_residues, num_evo_entries, name=None):
+    """ Parses a serialized protein TF Record.
+
+        Unlike read_protein, primary sequences are returned as ints and masks as vectors, and no
+        filtering on length is done.
+
+    Args:
+        serialized_example: string containing a serialized SequenceExample
+
+    Returns:
+        id: string identifier of record
+        primary: AA sequence as int class labels
+        evolutionary: PSSM sequence as vectors
+        secondary: DSSP sequence as int class labels
+        tertiary: 3D coordinates of structure
+        mask: 0/1 vector indicating missing residues. If missing then all residues are assumed present
+        pri_length: Length of amino acid sequence
+
+    """
+
+    with tf.name_scope(name, 'parse_protein', [serialized_example]) as scope:
         context, features = tf.parse_single_sequence_example(
             serialized_example,
             context_features={'id': tf.FixedLenFeature((1,), tf.string)},
@@ -154,24 +194,16 @@ def read_protein(filename_queue, max_length, num_edge_residues, num_evo_entries,
         secondary = tf.to_int32(features['secondary'][:, 0])
         tertiary = features['tertiary']
         mask = features['mask'][:, 0]
-
-        # Predicate for when to retain protein
         pri_length = tf.size(primary)
-        keep = pri_length <= max_length
-
-        # Convert primary to one-hot
-        one_hot_primary = tf.one_hot(primary, NUM_AAS)
 
-        # Generate tertiary masking matrix. If mask is missing then assume all residues are present
+        # If mask is missing then assume all residues are present
         mask = tf.cond(
             tf.not_equal(tf.size(mask), 0),
             lambda: mask,
             lambda: tf.ones([pri_length - num_edge_residues])
         )
-        ter_mask = masking_matrix(mask, name='ter_mask')
 
-        # Return tuple
-        return id_, one_hot_primary, evolutionary, secondary, tertiary, ter_mask, pri_length, keep
+        return id_, primary, evolutionary, secondary, tertiary, mask, pri_length
 
 
 def curriculum_weights(base, slope, max_seq_length, name=None):
@@ -251,8 +283,23 @@ def id_filter(ids, filter_string, delimiter='#', name=None):
         ids = tf.convert_to_tensor(ids, name='ids')
         filter_string = tf.convert_to_tensor(filter_string, name='filter_string')
 
+        # ids without a delimiter belong to no group. Matching by prefix keeps the mask aligned with ids
         return tf.equal(
-            tf.string_split(ids, delimiter=delimiter).values[0::2],
+            tf.regex_replace(ids, re.escape(delimiter) + '.*', ''),
             filter_string,
             name=scope
         )
+
+
+def group_index(ids, groups, delimiter='#', name=None):
+    """ Returns the index in groups of the group of each id (as chosen by id_filter), or -1 if it belongs to none """
+
+    with tf.name_scope(name, 'group_index', [ids]) as scope:
+        ids = tf.convert_to_tensor(ids, name='ids')
+        groups = tf.convert_to_tensor(groups, dtype=tf.string, name='groups')
+
+        matches = tf.equal(tf.expand_dims(tf.regex_replace(ids, re.escape(delimiter) + '.*', ''), -1), groups)
+        return tf.where(tf.reduce_any(matches, -1),
+                        tf.argmax(tf.to_int32(matches), -1, output_type=tf.int32),
+                        -tf.ones_like(ids, dtype=tf.int32),
+                        name=scope)
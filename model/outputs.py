@@ -0,0 +1,265 @@
+""" Persistence of predicted structures and other model outputs.
+
+    Predictions are passed around as dicts keyed by protein id, each value of
+    which is itself a dict of named numpy arrays (e.g. 'tertiary' and
+    'recurrent_states'), as returned by RGNModel.predict. Functions in this
+    module only operate on numpy arrays, so that they can be run from
+    background workers or used for offline analysis of saved predictions.
+"""
+
+__author__ = "Mohammed AlQuraishi"
+__copyright__ = "Copyright 2018, Harvard Medical School"
+__license__ = "MIT"
+
+import os
+from glob import glob
+
+import numpy as np
+
+from utils import Switch
+
+# Constants
+PREDICTION_FORMATS = ['text', 'npy', 'npz', 'store', 'pdb', 'cif']
+STRUCTURE_FORMATS = ['pdb', 'cif']  # formats that require the primary sequence
+STORE_DATA_FILENAME = 'predictions.bin'
+STORE_INDEX_FILENAME = 'predictions.index'
+STORE_ALIGNMENT = 64  # byte alignment of arrays in the data file
+BACKBONE_ATOMS = ['N', 'CA', 'C']  # in the order generated by the model
+RESIDUE_NAMES = np.array(['ALA', 'CYS', 'ASP', 'GLU', 'PHE', 'GLY', 'HIS', 'ILE', 'LYS', 'LEU',
+                          'MET', 'ASN', 'PRO', 'GLN', 'ARG', 'SER', 'THR', 'VAL', 'TRP', 'TYR', 'UNK'])  # alphabetical by 1-letter code
+COORDINATE_SCALE = 0.01  # model coordinates are in picometers, structure files in angstroms
+
+
+def write_predictions(outputs_dir, predictions, format_='text'):
+    """ Writes predictions to outputs_dir in the requested format.
+
+    Args:
+        outputs_dir: existing directory to write into
+        predictions: dict of prediction dicts keyed by protein id
+        format_: one of
+            'text': one text file per protein and output, i.e. <id>.tertiary and <id>.recurrent_states (legacy format)
+            'npy':  one binary .npy file per protein and output, i.e. <id>.tertiary.npy
+            'npz':  one binary .npz archive per call, with entries named <id>.<output>
+            'store': appended to a single consolidated store, see append_to_store
+            'pdb':  one PDB file of backbone atoms per protein, i.e. <id>.pdb (requires 'primary' output)
+            'cif':  one mmCIF file of backbone atoms per protein, i.e. <id>.cif (requires 'primary' output)
+
+    """
+
+    for case in Switch(format_):
+        if case('text'):
+            for id_, dict_ in predictions.iteritems():
+                for output, array in dict_.iteritems():
+                    if array is not None:
+                        np.savetxt(os.path.join(outputs_dir, id_ + '.' + output), array,
+                                   header='\n' if output.startswith('tertiary') else '')
+        elif case('npy'):
+            for id_, dict_ in predictions.iteritems():
+                for output, array in dict_.iteritems():
+                    if array is not None:
+                        np.save(os.path.join(outputs_dir, id_ + '.' + output + '.npy'), array)
+        elif case('npz'):
+            # each call gets its own archive, numbered in order of writing
+            num_archives = len(glob(os.path.join(outputs_dir, 'predictions_*.npz')))
+            np.savez(os.path.join(outputs_dir, 'predictions_' + str(num_archives) + '.npz'),
+                     **{id_ + '.' + output: array
+                        for id_, dict_ in predictions.iteritems()
+                        for output, array in dict_.iteritems() if array is not None})
+        elif case('store'):
+            append_to_store(outputs_dir, predictions)
+        elif case('pdb'):
+            for id_, dict_ in predictions.iteritems():
+                if dict_.get('tertiary') is not None:
+                    with open(os.path.join(outputs_dir, id_ + '.pdb'), 'w') as file_:
+                        file_.write(backbone_to_pdb(dict_['tertiary'], dict_['primary']))
+        elif case('cif'):
+            for id_, dict_ in predictions.iteritems():
+                if dict_.get('tertiary') is not None:
+                    with open(os.path.join(outputs_dir, id_ + '.cif'), 'w') as file_:
+                        file_.write(backbone_to_mmcif(dict_['tertiary'], dict_['primary'], id_))
+        else:
+            raise ValueError('Unknown prediction format: ' + str(format_))
+
+
+def _backbone_atom_site(tertiary, primary):
+    """ Returns per-atom columns (atom names, residue names, residue numbers, coordinates) of a backbone.
+
+    Args:
+        tertiary: [3, NUM_RESIDUES * NUM_DIHEDRALS] array of coordinates, as returned by RGNModel.predict
+        primary:  [>= NUM_RESIDUES] array of integer amino acid indices
+
+    """
+
+    num_atoms = tertiary.shape[1] - tertiary.shape[1] % len(BACKBONE_ATOMS)
+    num_residues = num_atoms // len(BACKBONE_ATOMS)
+    if len(primary) < num_residues:
+        raise ValueError('Primary sequence is shorter than the number of residues in the structure.')
+
+    atom_names = np.tile(BACKBONE_ATOMS, num_residues)
+    residue_names = np.repeat(RESIDUE_NAMES[np.clip(primary[:num_residues], 0, len(RESIDUE_NAMES) - 1)],
+                              len(BACKBONE_ATOMS))
+    residue_numbers = np.repeat(np.arange(1, num_residues + 1), len(BACKBONE_ATOMS))
+    coordinates = np.transpose(tertiary[:, :num_atoms]).astype(np.float64) * COORDINATE_SCALE
+
+    return atom_names, residue_names, residue_numbers, coordinates
+
+
+def _format_rows(row_format, columns):
+    """ Formats equal-length columns into one line per row with a single string formatting call. """
+
+    num_rows = len(columns[0])
+    values = np.empty((num_rows, len(columns)), dtype=object)
+    for i, column in enumerate(columns):
+        values[:, i] = column.tolist()
+
+    return (row_format * num_rows) % tuple(values.ravel().tolist())
+
+
+def backbone_to_pdb(tertiary, primary, chain_id='A'):
+    """ Returns the contents of a PDB file with the N, CA, and C atoms of a predicted backbone.
+
+    Args:
+        tertiary: [3, NUM_RESIDUES * NUM_DIHEDRALS] array of coordinates, as returned by RGNModel.predict
+        primary:  [>= NUM_RESIDUES] array of integer amino acid indices
+        chain_id: single character chain identifier
+
+    """
+
+    atom_names, residue_names, residue_numbers, coordinates = _backbone_atom_site(tertiary, primary)
+    num_atoms = len(atom_names)
+
+    # PDB atom names of one or two characters start in the second column of the field
+    atom_names = np.char.ljust(np.char.add(' ', atom_names), 4)
+    elements = np.array([name[1] for name in atom_names])
+
+    row_format = 'ATOM  %5d %4s %3s ' + chain_id + '%4d    %8.3f%8.3f%8.3f  1.00  0.00          %2s  \n'
+    atoms = _format_rows(row_format, [np.arange(1, num_atoms + 1), atom_names, residue_names, residue_numbers,
+                                      coordinates[:, 0], coordinates[:, 1], coordinates[:, 2], elements])
+
+    terminus = 'TER   %5d      %3s %s%4d\n' % (num_atoms + 1, residue_names[-1], chain_id, residue_numbers[-1]) \
+               if num_atoms > 0 else ''
+
+    return atoms + terminus + 'END\n'
+
+
+def backbone_to_mmcif(tertiary, primary, id_, chain_id='A'):
+    """ Returns the contents of an mmCIF file with the N, CA, and C atoms of a predicted backbone.
+
+    Args:
+        tertiary: [3, NUM_RESIDUES * NUM_DIHEDRALS] array of coordinates, as returned by RGNModel.predict
+        primary:  [>= NUM_RESIDUES] array of integer amino acid indices
+        id_:      protein id, used as the data block name
+        chain_id: chain identifier
+
+    """
+
+    atom_names, residue_names, residue_numbers, coordinates = _backbone_atom_site(tertiary, primary)
+    num_atoms = len(atom_names)
+    elements = np.array([name[0] for name in atom_names])
+
+    header = ('data_' + ''.join(c if c.isalnum() or c in '_-.' else '_' for c in id_) + '\n#\nloop_\n' +
+              ''.join('_atom_site.' + field + '\n' for field in
+                      ['group_PDB', 'id', 'type_symbol', 'label_atom_id', 'label_comp_id', 'label_asym_id',
+                       'label_seq_id', 'Cartn_x', 'Cartn_y', 'Cartn_z', 'occupancy', 'B_iso_or_equiv',
+                       'auth_seq_id', 'auth_asym_id', 'pdbx_PDB_model_num']))
+
+    row_format = 'ATOM %d %s %s %s ' + chain_id + ' %d %.3f %.3f %.3f 1.00 0.00 %d ' + chain_id + ' 1\n'
+    atoms = _format_rows(row_format, [np.arange(1, num_atoms + 1), elements, atom_names, residue_names,
+                                      residue_numbers, coordinates[:, 0], coordinates[:, 1], coordinates[:, 2],
+                                      residue_numbers])
+
+    return header + atoms + '#\n'
+
+
+def append_to_store(store_dir, predictions):
+    """ Appends predictions to the consolidated prediction store in store_dir, creating it if needed.
+
+        A store consists of two files, a raw data file holding the bytes of every array back to back,
+        and a tab-separated index file with one line per array (id, output, dtype, shape, byte offset,
+        round). The round is the offset the write started at, and identifies the arrays written together.
+        Both files are only ever appended to, and index entries are written after their data has been
+        flushed, so an interrupted write at worst leaves unreferenced bytes at the end of the data file.
+        If an id is written in more than one round, its latest round replaces all earlier ones when reading.
+
+    Args:
+        store_dir: existing directory to write into
+        predictions: dict of prediction dicts keyed by protein id
+
+    """
+
+    index_lines = []
+    with open(os.path.join(store_dir, STORE_DATA_FILENAME), 'ab') as data_file:
+        data_file.seek(0, os.SEEK_END)
+        offset = data_file.tell()
+        round_ = str(offset)
+        for id_, dict_ in predictions.iteritems():
+            for output, array in dict_.iteritems():
+                if array is not None:
+                    array = np.ascontiguousarray(array)
+                    padding = -offset % STORE_ALIGNMENT
+                    data_file.write(b'\0' * padding)
+                    offset += padding
+                    data_file.write(array.tobytes())
+                    index_lines.append('\t'.join([id_,
+                                                   output,
+                                                   array.dtype.str,
+                                                   ','.join(map(str, array.shape)),
+                                                   str(offset),
+                                                   round_]) + '\n')
+                    offset += array.nbytes
+        data_file.flush()
+        os.fsync(data_file.fileno())
+
+    with open(os.path.join(store_dir, STORE_INDEX_FILENAME), 'a') as index_file:
+        index_file.writelines(index_lines)
+
+
+class PredictionStore(object):
+    """
+    Read-only view of a consolidated prediction store written by append_to_store.
+
+    The data file is memory-mapped, so opening a store only reads its index, and arrays are
+    paged in lazily as they're accessed. Returned arrays are read-only views into the map.
+
+    Usage:
+        store = PredictionStore(outputs_dir)
+        coordinates = store['10#1ABC_1_A']['tertiary']
+    """
+
+    def __init__(self, store_dir):
+        # parse index, letting the latest round of each id replace its earlier ones
+        self._index = {}
+        rounds = {}
+        with open(os.path.join(store_dir, STORE_INDEX_FILENAME)) as index_file:
+            for line in index_file:
+                id_, output, dtype, shape, offset, round_ = line.rstrip('\n').split('\t')
+                if rounds.get(id_) != round_:
+                    self._index[id_] = {}
+                    rounds[id_] = round_
+                shape = tuple(int(dim) for dim in shape.split(',')) if shape else ()
+                self._index[id_][output] = (np.dtype(dtype), shape, int(offset))
+
+        # map data file (np.memmap can't map empty files)
+        data_path = os.path.join(store_dir, STORE_DATA_FILENAME)
+        self._data = np.memmap(data_path, dtype=np.uint8, mode='r') if os.path.getsize(data_path) > 0 else None
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, id_):
+        return id_ in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __getitem__(self, id_):
+        return {output: np.ndarray(shape, dtype, buffer=self._data, offset=offset)
+                for output, (dtype, shape, offset) in self._index[id_].iteritems()}
+
+    def ids(self):
+        """Returns the ids of all proteins in the store"""
+        return self._index.keys()
+
+    def outputs(self, id_):
+        """Returns the names of the outputs stored for the given protein"""
+        return self._index[id_].keys()
@@ -5,6 +5,8 @@ import fileinput
 import os
 import signal
 import sys
+import threading
+import time
 
 from copy import deepcopy
 from glob import glob
@@ -13,7 +15,8 @@ from setproctitle import setproctitle
 from shutil import rmtree
 
 from config import RGNConfig, RunConfig
-from model import RGNModel
+from model import RGNModel, UNWEIGHTED_PREFIX
+from outputs import PREDICTION_FORMATS, STRUCTURE_FORMATS, write_predictions
 from utils import *
 
 # constant directory and file names
@@ -21,6 +24,7 @@ RUNS_DIRNAME = 'runs'
 DATA_DIRNAME = 'data'
 CHECKPOINTS_DIRNAME = 'checkpoints'
 LOGS_DIRNAME = 'logs'
+GRAPHS_DIRNAME = 'graphs'
 ALPHABETS_DIRNAME = 'alphabets'
 FULL_TRAINING_DIRNAME = 'training'
 SAMPLE_VALIDATION_DIRNAME = 'validation'
@@ -28,6 +32,13 @@ FULL_TESTING_DIRNAME = 'testing'
 TRAINING_OUTPUTS_DIRNAME = 'outputsTraining'
 VALIDATION_OUTPUTS_DIRNAME = 'outputsValidation'
 TESTING_OUTPUTS_DIRNAME = 'outputsTesting'
+STARTUP_TIMES_FILENAME = 'startup.log'
+TRACES_DIRNAME = 'traces'
+PIPELINE_LOG_FILENAME = 'pipeline.log'
+
+
+# set on SIGUSR1, to trace the next training step
+trace_requested = threading.Event()
 
 
 # exception classes
@@ -42,30 +53,94 @@ class DeadGradientError(RuntimeError):
 
 
 # logging functions
-def evaluate_and_log(log_file, configs, models, session):
+def evaluate(label, configs, models, session, evaluations, snapshot=None, trace_prefix=None):
+    # shared evaluation models are only evaluated once, with their results memoized in evaluations
+    model = models[label]
+    if model not in evaluations:
+        evaluations.update({model: model.evaluate(session, snapshot=snapshot, trace_prefix=trace_prefix)})
+
+    # losses of the unweighted counterpart of a shared model are prefixed
+    if model.config.io['name'] == configs[label].io['name']:
+        return {k: v for k, v in evaluations[model].iteritems() if not k.startswith(UNWEIGHTED_PREFIX)}
+    else:
+        return {k[len(UNWEIGHTED_PREFIX):]: v for k, v in evaluations[model].iteritems()
+                if k.startswith(UNWEIGHTED_PREFIX)}
+
+
+def evaluated_labels(configs):
+    # labels of the evaluation models evaluated by evaluate_and_log, in order
+    labels = [label for label, option in [('eval_wt_train', 'include_weighted_training'),
+                                          ('eval_wt_val', 'include_weighted_validation'),
+                                          ('eval_wt_test', 'include_weighted_testing')]
+              if configs['run'].evaluation[option]]
+    if configs['training'].curriculum['mode'] is not None:
+        labels += [label for label, option in [('eval_unwt_train', 'include_unweighted_training'),
+                                               ('eval_unwt_val', 'include_unweighted_validation'),
+                                               ('eval_unwt_test', 'include_unweighted_testing')]
+                   if configs['run'].evaluation[option]]
+
+    return labels
+
+
+def evaluate_snapshot(configs, models, session, evaluations, snapshot, trace_prefix=None):
+    # forward passes only, against the snapshot, for running concurrently with training. the state that depends on the
+    # losses is updated from the results by complete_evaluation, on the training thread
+    for label in evaluated_labels(configs):
+        model = models[label]
+        if model not in evaluations:
+            evaluations.update({model: model.evaluate(session, snapshot=snapshot, trace_prefix=trace_prefix,
+                                                      update_state=False)})
+
+
+def complete_evaluation(evaluation_worker, pending):
+    # waits for the evaluation in flight if any, then updates the state that depends on its losses and logs and checks
+    # it as of the snapshot it was evaluated against. returns None, i.e. the new pending evaluation
+    evaluation_worker.join()
+    if pending is not None:
+        log_file, configs, models, session, snapshot, diagnostics, evaluations = pending
+        for model, evaluation in evaluations.items():
+            evaluations.update({model: model.update_evaluation_state(session, evaluation)})
+        evaluate_log_and_check(log_file, configs, models, session, snapshot, diagnostics, evaluations=evaluations)
+
+    return None
+
+
+def diagnose(configs, models, session):
+    if configs['run'].evaluation['include_diagnostics']:
+        return models['training'].diagnose(session)
+    else:
+        return {k: float('nan') for k in ('min_weight',
+                                          'max_weight',
+                                          'min_grad',
+                                          'max_grad',
+                                          'curriculum_step',
+                                          'curriculum_quantiles')}
+
+
+def evaluate_and_log(log_file, configs, models, session, snapshot=None, diagnostics=None, trace_prefix=None,
+                     evaluations=None):
+    # evaluation models are run against the snapshot if one is passed, in which case diagnostics must be passed as well.
+    # if a trace prefix is passed, the evaluation of each model is traced. models already evaluated in evaluations are
+    # not evaluated again
+    if evaluations is None:
+        evaluations = {}
+
     # evaluation of weighted losses
-    wt_train_loss_dict = models['eval_wt_train'].evaluate(session) \
+    wt_train_loss_dict = evaluate('eval_wt_train', configs, models, session, evaluations, snapshot, trace_prefix) \
         if configs['run'].evaluation['include_weighted_training'] \
         else {}
 
-    wt_val_loss_dict = models['eval_wt_val'].evaluate(session) \
+    wt_val_loss_dict = evaluate('eval_wt_val', configs, models, session, evaluations, snapshot, trace_prefix) \
         if configs['run'].evaluation['include_weighted_validation'] \
         else {}
 
-    wt_test_loss_dict = models['eval_wt_test'].evaluate(session) \
+    wt_test_loss_dict = evaluate('eval_wt_test', configs, models, session, evaluations, snapshot, trace_prefix) \
         if configs['run'].evaluation['include_weighted_testing'] \
         else {}
 
     # diagnostics
-    if configs['run'].evaluation['include_diagnostics']:
-        diagnostics = models['training'].diagnose(session)
-    else:
-        diagnostics = {k: float('nan') for k in ('min_weight',
-                                                 'max_weight',
-                                                 'min_grad',
-                                                 'max_grad',
-                                                 'curriculum_step',
-                                                 'curriculum_quantiles')}
+    if diagnostics is None:
+        diagnostics = diagnose(configs, models, session)
 
     # Retrieve the correct loss.
     for loss_key in ['tertiary_loss_all']:
@@ -96,7 +171,7 @@ def evaluate_and_log(log_file, configs, models, session):
         wt_test_loss = float('nan')
 
     # Log string
-    global_step = models['training'].current_step(session)
+    global_step = models['training'].current_step(session, snapshot)
     base_log = ('Iteration: {0}\tTrain: {1:.3f}\t'
                 + 'Validation: {2:.3f}\tTest: {3:.3f}\t'
                 + 'Weight: {min_weight:.4e} {max_weight:.4e}\t'
@@ -110,12 +185,12 @@ def evaluate_and_log(log_file, configs, models, session):
     # Additional diagnostics and losses if there's a curriculum.
     if configs['training'].curriculum['mode'] is not None:
         # evaluation of unweighted losses
-        unwt_train_loss_dict = models['eval_unwt_train'].evaluate(session) if configs['run'].evaluation[
-            'include_unweighted_training'] else {}
-        unwt_val_loss_dict = models['eval_unwt_val'].evaluate(session) if configs['run'].evaluation[
-            'include_unweighted_validation'] else {}
-        unwt_test_loss_dict = models['eval_unwt_test'].evaluate(session) if configs['run'].evaluation[
-            'include_unweighted_testing'] else {}
+        unwt_train_loss_dict = evaluate('eval_unwt_train', configs, models, session, evaluations, snapshot,
+                                        trace_prefix) if configs['run'].evaluation['include_unweighted_training'] else {}
+        unwt_val_loss_dict = evaluate('eval_unwt_val', configs, models, session, evaluations, snapshot,
+                                      trace_prefix) if configs['run'].evaluation['include_unweighted_validation'] else {}
+        unwt_test_loss_dict = evaluate('eval_unwt_test', configs, models, session, evaluations, snapshot,
+                                       trace_prefix) if configs['run'].evaluation['include_unweighted_testing'] else {}
 
         # Retrieve the correct loss.
         for loss_key in ['tertiary_loss_all']:
@@ -168,6 +243,17 @@ def evaluate_and_log(log_file, configs, models, session):
         with open(log_file + '.alphabet', 'a') as f:
             np.savetxt(f, diagnostics['alphabet'], footer='\n')
 
+    # per-protein dRMSDs of exactly evaluated sets
+    loss_dicts = [('Train', wt_train_loss_dict), ('Validation', wt_val_loss_dict), ('Test', wt_test_loss_dict)]
+    if configs['training'].curriculum['mode'] is not None:
+        loss_dicts += [('Unweighted Train', unwt_train_loss_dict), ('Unweighted Validation', unwt_val_loss_dict),
+                       ('Unweighted Test', unwt_test_loss_dict)]
+    for set_name, loss_dict in loss_dicts:
+        if 'drmsds' in loss_dict:
+            with open(log_file + '.drmsds', 'a') as f:
+                for id_, drmsd in zip(loss_dict['ids'], loss_dict['drmsds']):
+                    f.write('Iteration: {0}\t{1}\t{2}\t{3:.3f}\n'.format(global_step, set_name, id_, drmsd))
+
     # prep return 'package'
     diagnostics.update({'wt_train_loss': wt_train_loss,
                         'wt_val_loss': wt_val_loss,
@@ -182,7 +268,68 @@ def evaluate_and_log(log_file, configs, models, session):
     return diagnostics
 
 
-def predict_and_log(log_dir, configs, models, session):
+def check_diagnostics(configs, global_step, diagnostics):
+    # restart if a milestone is missed
+    val_ref_set_prefix = 'un' if configs['run'].optimization['validation_reference'] == 'unweighted' else ''
+    min_loss_achieved = diagnostics[val_ref_set_prefix + 'wt_val_loss']['min_tertiary_loss_achieved_all']
+    for step, loss in configs['run'].optimization['validation_milestone'].iteritems():
+        if global_step >= step and min_loss_achieved > loss:
+            raise MilestoneError('Milestone at step '
+                                 + str(global_step)
+                                 + ' missed because minimum loss achieved so far is '
+                                 + str(min_loss_achieved))
+
+    # restart if gradients are zero
+    if (diagnostics['min_grad'] == 0 and diagnostics['max_grad'] == 0)\
+        or (configs['run'].evaluation['include_diagnostics']
+            and (np.isnan(diagnostics['min_grad'])
+                 or np.isnan(diagnostics['max_grad']))):
+        raise DeadGradientError('Gradient is dead.')
+
+
+def evaluate_log_and_check(log_file, configs, models, session, snapshot=None, diagnostics=None, trace_prefix=None,
+                           evaluations=None):
+    diagnostics = evaluate_and_log(log_file, configs, models, session, snapshot, diagnostics, trace_prefix, evaluations)
+    check_diagnostics(configs, models['training'].current_step(session, snapshot), diagnostics)
+
+
+def steps_to_next_check(configs, global_step, trace_frequency=None):
+    # number of steps to train before the training loop checks in again: at most stepsBetweenChecks, and never past
+    # the next step that's evaluated, predicted, checkpointed, or traced
+    frequencies = [configs['run'].io['evaluation_frequency'],
+                   configs['run'].io['prediction_frequency'],
+                   configs['run'].io['checkpoint_frequency']] + ([trace_frequency] if trace_frequency is not None else [])
+
+    return min([configs['run'].computing['steps_between_checks']] +
+               [frequency - global_step % frequency for frequency in frequencies])
+
+
+def pipeline_health(models, session):
+    return merge_dicts(models['training'].pipeline_health(session), {'time': time.time()})
+
+
+def log_pipeline_health(log_file, global_step, health, last_health):
+    # throughput, drops, and mean dequeue wait of the training input pipeline between the two passed measurements
+    interval = {k: health[k] - last_health[k]
+                for k in ['time', 'records_read', 'records_dropped', 'dequeue_wait', 'dequeues']}
+    log = 'Iteration: {0}\tRecords/s: {1:.1f}\tDropped: {2}\tDequeue Wait: {3:.2f} ms'.format(
+        global_step,
+        interval['records_read'] / max(interval['time'], 1e-6),
+        interval['records_dropped'],
+        1000. * interval['dequeue_wait'] / max(interval['dequeues'], 1))
+
+    # current queue fill levels
+    for key, name in [('file_queue_fill', 'File Queue'),
+                      ('randomization_queue_fill', 'Randomization Queue'),
+                      ('batching_queue_fill', 'Batching Queue')]:
+        if key in health:
+            log += '\t{0}: {1:.1%}'.format(name, health[key])
+
+    with open(log_file, 'a') as f:
+        f.write(log + '\n')
+
+
+def predict_and_log(log_dir, configs, models, session, writer=None, ensemble=None):
     # assumes that the validation reference designation (wt vs. unwt) can be used for the training and test sets as well
     val_ref_set_prefix = 'un' if configs['run'].optimization['validation_reference'] == 'unweighted' else ''
 
@@ -205,21 +352,65 @@ def predict_and_log(log_dir, configs, models, session):
                 if not os.path.exists(outputs_dir):
                     os.makedirs(outputs_dir)
 
+                predictions = {}
                 for _ in range(configs[label].queueing['num_evaluation_invocations']):
-                    dicts = model.predict(session)
-                    for idx, dict_ in dicts.iteritems():
-                        if 'tertiary' in dict_:
-                            np.savetxt(os.path.join(outputs_dir, idx + '.tertiary'),
-                                       dict_['tertiary'], header='\n')
-                        if 'recurrent_states' in dict_:
-                            np.savetxt(os.path.join(outputs_dir, idx + '.recurrent_states'),
-                                       dict_['recurrent_states'])
+                    if ensemble is not None:
+                        predictions.update(model.predict_ensemble(session, ensemble))
+                    else:
+                        predictions.update(model.predict(session))
+
+                # hand off to the background writer if there is one, otherwise write in place
+                if writer is not None:
+                    writer.submit(write_predictions, outputs_dir, predictions, configs['run'].io['prediction_format'])
+                else:
+                    write_predictions(outputs_dir, predictions, configs['run'].io['prediction_format'])
+
+
+def roll_back(run_dir, configs, models, session, snapshot, workers=()):
+    """ Rolls the training model back in-session to a full snapshot, dropping the results of in-flight jobs of the
+        workers and log entries written past the snapshot, and returns the restored global step """
+
+    for worker in workers:
+        if worker is not None:
+            worker.join(reraise=False)
+    models['training'].restore_snapshot(session, snapshot)
+    global_step = models['training'].current_step(session)
+    remove_log_residue(run_dir, global_step, configs['run'].io['prediction_frequency'])
+
+    return global_step
+
+
+def remove_log_residue(run_dir, global_step, prediction_frequency):
+    """ Removes log directories and log entries written after global_step, e.g. past the last checkpoint """
+
+    # remove future directories
+    current_log_step = (global_step // prediction_frequency) + 1
+    for step in [int(os.path.basename(os.path.normpath(_dir))) for _dir in glob(os.path.join(run_dir, '*[0-9]'))]:
+        if step > current_log_step:
+            rmtree(os.path.join(run_dir, str(step)))
+
+    # remove future log entries in current log files
+    # (the dRMSD log has several entries per step, so files are cut right before their first entry past global_step)
+    for log_file in [os.path.join(run_dir, str(current_log_step), filename)
+                     for filename in ['error.log', 'error.log.drmsds', PIPELINE_LOG_FILENAME]]:
+        if os.path.exists(log_file):
+            with open(log_file, 'rw+') as f:
+                while True:
+                    position = f.tell()
+                    new_line = f.readline().split()
+                    if len(new_line) > 1:
+                        if int(new_line[1]) > global_step:
+                            f.truncate(position)
+                            break
+                    else:  # reached end without passing global_step, checkpoint is ahead of last recorded log entry
+                        break
 
 
 def loop(args_):
     # create config and model collection objects, and retrieve the run config
     configs = {}
-    configs.update({'run': RunConfig(args_.config_file)})
+    with timed('run config'):
+        configs.update({'run': RunConfig(args_.config_file)})
 
     # set GPU-related environmental options and config settings
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args_.gpu) if args_.gpu is not None else ''
@@ -231,6 +422,7 @@ def loop(args_):
     data_dir = os.path.join(base_dir, DATA_DIRNAME, configs['run'].names['dataset'])
     checkpoints_dir = os.path.join(run_dir, CHECKPOINTS_DIRNAME, '')
     logs_dir = os.path.join(run_dir, LOGS_DIRNAME, '')
+    traces_dir = os.path.join(logs_dir, TRACES_DIRNAME, '')
     stdout_err_file = os.path.join(base_dir, LOGS_DIRNAME, configs['run'].names['run'] + '.log')
     alphabet_file = os.path.join(data_dir, ALPHABETS_DIRNAME, configs['run'].names['alphabet'] + '.csv') \
         if configs['run'].names['alphabet'] is not None else None
@@ -284,41 +476,51 @@ def loop(args_):
         dd_evaluation = '/cpu:0'
 
     # create models configuration templates
-    configs.update({'training': RGNConfig(args_.config_file,
-                                          {'name': 'training',
-                                           'dataFilesGlob': full_training_glob,
-                                           'checkpointsDirectory': checkpoints_dir,
-                                           'logsDirectory': logs_dir,
-                                           'fileQueueCapacity': configs['run'].queueing['training_file_queue_capacity'],
-                                           'batchQueueCapacity': configs['run'].queueing[
-                                               'training_batch_queue_capacity'],
-                                           'minAfterDequeue': configs['run'].queueing['training_min_after_dequeue'],
-                                           'shuffle': configs['run'].queueing['training_shuffle'],
-                                           'tertiaryNormalization': configs['run'].loss[
-                                               'training_tertiary_normalization'],
-                                           'batchDependentNormalization': configs['run'].loss[
-                                               'training_batch_dependent_normalization'],
-                                           'alphabetFile': alphabet_file,
-                                           'functionsOnDevices': fod_training,
-                                           'defaultDevice': dd_training,
-                                           'fillGPU': args_.fill_gpu})})
-
-    configs.update({'evaluation': RGNConfig(args_.config_file,
-                                            {'fileQueueCapacity': configs['run'].queueing[
-                                                'evaluation_file_queue_capacity'],
-                                             'batchQueueCapacity': configs['run'].queueing[
-                                                 'evaluation_batch_queue_capacity'],
-                                             'minAfterDequeue': configs['run'].queueing['evaluation_min_after_dequeue'],
-                                             'shuffle': configs['run'].queueing['evaluation_shuffle'],
-                                             'tertiaryNormalization': configs['run'].loss[
-                                                 'evaluation_tertiary_normalization'],
-                                             'batchDependentNormalization': configs['run'].loss[
-                                                 'evaluation_batch_dependent_normalization'],
-                                             'alphabetFile': alphabet_file,
-                                             'functionsOnDevices': fod_evaluation,
-                                             'defaultDevice': dd_evaluation,
-                                             'numEpochs': eval_num_epochs,
-                                             'bucketBoundaries': None})})
+    with timed('model configs'):
+        configs.update({'training': RGNConfig(args_.config_file,
+                                              {'name': 'training',
+                                               'dataFilesGlob': full_training_glob,
+                                               'checkpointsDirectory': checkpoints_dir,
+                                               'logsDirectory': logs_dir,
+                                               'fileQueueCapacity': configs['run'].queueing[
+                                                   'training_file_queue_capacity'],
+                                               'batchQueueCapacity': configs['run'].queueing[
+                                                   'training_batch_queue_capacity'],
+                                               'minAfterDequeue': configs['run'].queueing['training_min_after_dequeue'],
+                                               'shuffle': configs['run'].queueing['training_shuffle'],
+                                               'exactEvaluation': False,
+                                               'tertiaryNormalization': configs['run'].loss[
+                                                   'training_tertiary_normalization'],
+                                               'batchDependentNormalization': configs['run'].loss[
+                                                   'training_batch_dependent_normalization'],
+                                               'alphabetFile': alphabet_file,
+                                               'functionsOnDevices': fod_training,
+                                               'defaultDevice': dd_training,
+                                               'fillGPU': args_.fill_gpu})})
+
+        configs.update({'evaluation': RGNConfig(args_.config_file,
+                                                {'fileQueueCapacity': configs['run'].queueing[
+                                                    'evaluation_file_queue_capacity'],
+                                                 'batchQueueCapacity': configs['run'].queueing[
+                                                     'evaluation_batch_queue_capacity'],
+                                                 'minAfterDequeue': configs['run'].queueing[
+                                                     'evaluation_min_after_dequeue'],
+                                                 'shuffle': configs['run'].queueing['evaluation_shuffle'],
+                                                 'cacheData': configs['run'].queueing['evaluation_cache_data']
+                                                              or configs['run'].evaluation['exact_evaluation'],
+                                                 'exactEvaluation': configs['run'].evaluation['exact_evaluation'],
+                                                 'tertiaryNormalization': configs['run'].loss[
+                                                     'evaluation_tertiary_normalization'],
+                                                 'batchDependentNormalization': configs['run'].loss[
+                                                     'evaluation_batch_dependent_normalization'],
+                                                 'alphabetFile': alphabet_file,
+                                                 'functionsOnDevices': fod_evaluation,
+                                                 'defaultDevice': dd_evaluation,
+                                                 'numEpochs': eval_num_epochs,
+                                                 'bucketBoundaries': None,
+                                                 'predictPrimary': configs['run'].io[
+                                                     'prediction_format'] in STRUCTURE_FORMATS,
+                                                 'ensemblePrediction': bool(args_.ensemble_checkpoint)})})
 
     # Override included evaluation models with list from command-line if specified
     # (assumes none are included and then includes ones that are specified)
@@ -345,29 +547,43 @@ def loop(args_):
     else:
         configs['evaluation'].loss['include'] = False
 
+    # Resolve ensemble checkpoints, which may be given as checkpoint prefixes or as checkpoint directories
+    if args_.ensemble_checkpoint and not args_.prediction_only:
+        raise RuntimeError('Ensemble prediction requires prediction only mode.')
+    ensemble_checkpoints = []
+    for path in args_.ensemble_checkpoint or []:
+        checkpoint = tf.train.latest_checkpoint(path) if os.path.isdir(path) else path
+        if checkpoint is None:
+            raise RuntimeError('No checkpoint found in ' + path + '.')
+        ensemble_checkpoints.append(checkpoint)
+    if ensemble_checkpoints and 'tertiary' not in configs['evaluation'].io['prediction_outputs']:
+        raise RuntimeError('Ensemble prediction requires tertiary outputs.')
+
+    if configs['run'].io['prediction_format'] not in PREDICTION_FORMATS:
+        raise RuntimeError('Unknown prediction format ' + configs['run'].io['prediction_format'] + '.')
+    if configs['run'].io['prediction_format'] in STRUCTURE_FORMATS \
+            and 'tertiary' not in configs['evaluation'].io['prediction_outputs']:
+        raise RuntimeError('Prediction format ' + configs['run'].io['prediction_format'] + ' requires tertiary outputs.')
+
     # rescaling needed to adjust for how frequently loss_history is updated
     if configs['training'].curriculum['behavior'] == 'loss_change':  # result must be >=1
         configs['training'].curriculum['change_num_iterations'] //= configs['run'].io['evaluation_frequency']
         configs['evaluation'].curriculum['change_num_iterations'] //= configs['run'].io['evaluation_frequency']
 
-    # create training model
-    models = {}
-    models.update({'training': RGNModel('training', configs['training'])})
     print('*** training configuration ***')
     pprint(configs['training'].__dict__)
 
-    # create weighted training evaluation model (conditional)
+    # configure weighted training evaluation model (conditional)
     if configs['run'].evaluation['include_weighted_training']:
         configs.update({'eval_wt_train': deepcopy(configs['evaluation'])})
         configs['eval_wt_train'].io['name'] = 'evaluation_wt_training'
         configs['eval_wt_train'].io['data_files_glob'] = sample_training_glob
         configs['eval_wt_train'].optimization['batch_size'] = training_batch_size
         configs['eval_wt_train'].queueing['num_evaluation_invocations'] = training_invocations
-        models.update({'eval_wt_train': RGNModel('evaluation', configs['eval_wt_train'])})
         print('\n\n\n*** weighted training evaluation configuration ***')
         pprint(configs['eval_wt_train'].__dict__)
 
-    # create weighted validation evaluation model (conditional)
+    # configure weighted validation evaluation model (conditional)
     if configs['run'].evaluation['include_weighted_validation']:
         configs.update({'eval_wt_val': deepcopy(configs['evaluation'])})
         configs['eval_wt_val'].io['name'] = 'evaluation_wt_validation'
@@ -376,24 +592,22 @@ def loop(args_):
         configs['eval_wt_val'].queueing['num_evaluation_invocations'] = validation_invocations
         if configs['run'].optimization['validation_reference'] == 'weighted':
             configs['eval_wt_val'].curriculum['update_loss_history'] = True
-        models.update({'eval_wt_val': RGNModel('evaluation', configs['eval_wt_val'])})
         print('\n\n\n*** weighted validation evaluation configuration ***')
         pprint(configs['eval_wt_val'].__dict__)
 
-    # create weighted testing evaluation model (conditional)
+    # configure weighted testing evaluation model (conditional)
     if configs['run'].evaluation['include_weighted_testing']:
         configs.update({'eval_wt_test': deepcopy(configs['evaluation'])})
         configs['eval_wt_test'].io['name'] = 'evaluation_wt_testing'
         configs['eval_wt_test'].io['data_files_glob'] = testing_glob
         configs['eval_wt_test'].optimization['batch_size'] = testing_batch_size
         configs['eval_wt_test'].queueing['num_evaluation_invocations'] = testing_invocations
-        models.update({'eval_wt_test': RGNModel('evaluation', configs['eval_wt_test'])})
         print('\n\n\n*** weighted testing evaluation configuration ***')
         pprint(configs['eval_wt_test'].__dict__)
 
-    # create equivalents for unweighted loss if there's a curriculum.
+    # configure equivalents for unweighted loss if there's a curriculum.
     if configs['training'].curriculum['mode'] is not None:
-        # create unweighted training evaluation model (conditional)
+        # configure unweighted training evaluation model (conditional)
         if configs['run'].evaluation['include_unweighted_training']:
             configs.update({'eval_unwt_train': deepcopy(configs['evaluation'])})
             configs['eval_unwt_train'].io['name'] = 'evaluation_unwt_training'
@@ -402,9 +616,8 @@ def loop(args_):
             configs['eval_unwt_train'].queueing['num_evaluation_invocations'] = training_invocations
             configs['eval_unwt_train'].curriculum['mode'] = None
             configs['eval_unwt_train'].curriculum['behavior'] = None
-            models.update({'eval_unwt_train': RGNModel('evaluation', configs['eval_unwt_train'])})
 
-        # create unweighted validation evaluation model (conditional)
+        # configure unweighted validation evaluation model (conditional)
         if configs['run'].evaluation['include_unweighted_validation']:
             configs.update({'eval_unwt_val': deepcopy(configs['evaluation'])})
             configs['eval_unwt_val'].io['name'] = 'evaluation_unwt_validation'
@@ -415,9 +628,8 @@ def loop(args_):
             configs['eval_unwt_val'].curriculum['behavior'] = None
             if configs['run'].optimization['validation_reference'] == 'unweighted':
                 configs['eval_unwt_val'].curriculum['update_loss_history'] = True
-            models.update({'eval_unwt_val': RGNModel('evaluation', configs['eval_unwt_val'])})
 
-        # create unweighted testing evaluation model (conditional)
+        # configure unweighted testing evaluation model (conditional)
         if configs['run'].evaluation['include_unweighted_testing']:
             configs.update({'eval_unwt_test': deepcopy(configs['evaluation'])})
             configs['eval_unwt_test'].io['name'] = 'evaluation_unwt_testing'
@@ -426,103 +638,226 @@ def loop(args_):
             configs['eval_unwt_test'].queueing['num_evaluation_invocations'] = testing_invocations
             configs['eval_unwt_test'].curriculum['mode'] = None
             configs['eval_unwt_test'].curriculum['behavior'] = None
-            models.update({'eval_unwt_test': RGNModel('evaluation', configs['eval_unwt_test'])})
+
+    # load the graph built from these configs if it was cached by a previous run (the cache is shared by all runs)
+    if configs['run'].io['cache_graph']:
+        graph_cache_prefix = os.path.join(base_dir, GRAPHS_DIRNAME, RGNModel.graph_cache_key(
+            [configs[label] for label in sorted(configs) if label != 'run']))
+        cached_graph = RGNModel.load_graph(graph_cache_prefix)
+    else:
+        graph_cache_prefix, cached_graph = None, None
+
+    # create training model
+    models = {}
+    models.update({'training': RGNModel('training', configs['training'], cached_graph=cached_graph)})
+
+    # create evaluation models. with a loss curriculum the weighted and unweighted evaluation models of a data set
+    # predict the same structures, and so a single shared model is created to compute both of their losses
+    for group in ['train', 'val', 'test']:
+        wt_label, unwt_label = 'eval_wt_' + group, 'eval_unwt_' + group
+        if wt_label in configs and unwt_label in configs and configs['training'].curriculum['mode'] == 'loss':
+            models.update({wt_label: RGNModel('evaluation', configs[wt_label], configs[unwt_label],
+                                              cached_graph=cached_graph)})
+            models.update({unwt_label: models[wt_label]})
+        elif wt_label in configs:
+            models.update({wt_label: RGNModel('evaluation', configs[wt_label], cached_graph=cached_graph)})
+    for group in ['train', 'val', 'test']:
+        unwt_label = 'eval_unwt_' + group
+        if unwt_label in configs and unwt_label not in models:
+            models.update({unwt_label: RGNModel('evaluation', configs[unwt_label], cached_graph=cached_graph)})
+
+    # background writer for predicted structures, so that writing them does not stall the main loop
+    if configs['run'].io['asynchronous_predictions']:
+        prediction_writer = BackgroundWorker(configs['run'].io['prediction_queue_capacity'], name='prediction_writer')
+    else:
+        prediction_writer = None
+
+    # background evaluator, so that evaluation overlaps training
+    if configs['run'].evaluation['asynchronous_evaluation'] and not args_.prediction_only:
+        evaluation_worker = BackgroundWorker(name='evaluator')
+    else:
+        evaluation_worker = None
+
+    # background checkpointer, so that writing checkpoints to disk overlaps training
+    if configs['run'].io['asynchronous_checkpoints'] and not args_.prediction_only:
+        checkpoint_worker = BackgroundWorker(name='checkpointer')
+    else:
+        checkpoint_worker = None
 
     # start head model and related prep
     stdout_err_file_handle.flush()
-    session = models['training'].start(models.values())
+    with timed('start'):
+        session = models['training'].start(models.values(), restore_training_state=not args_.prediction_only,
+                                           graph_cache_prefix=graph_cache_prefix)
     global_step = models['training'].current_step(session)
     current_log_step = (global_step // configs['run'].io['prediction_frequency']) + 1
     log_dir = os.path.join(run_dir, str(current_log_step))
     restart = False
 
+    # load weights of ensemble members (overwrites the session's own weights in turn, then puts them back)
+    ensemble = models['training'].load_ensemble(session, ensemble_checkpoints) if ensemble_checkpoints else None
+
     # predict or train depending on set mode behavior
+    startup_title = 'startup at step {} on {}'.format(global_step, time.strftime('%Y-%m-%d %H:%M:%S'))
     if args_.prediction_only:
+        write_timing_report(os.path.join(logs_dir, STARTUP_TIMES_FILENAME), startup_title, 'total, until start')
         try:
-            while not models['training'].is_done():
-                predict_and_log(log_dir, configs, models, session)
-        except tf.errors.OutOfRangeError:
-            pass
+            try:
+                while not models['training'].is_done():
+                    predict_and_log(log_dir, configs, models, session, prediction_writer, ensemble)
+            except tf.errors.OutOfRangeError:
+                pass
+
+            if prediction_writer is not None:  # failed writes are only reported if nothing else failed
+                prediction_writer.join()
         except:
             print('Unexpected error: ', sys.exc_info()[0])
             raise
         finally:
             if models['training'].is_started:
                 models['training'].finish(session, save=False)
+            if prediction_writer is not None:
+                prediction_writer.close(reraise=False)
             stdout_err_file_handle.close()
     else:
         # clean up post last checkpoint residue if any
         if global_step != 0:
-            # remove future directories
-            last_log_step = sorted([int(os.path.basename(os.path.normpath(_dir)))
-                                    for _dir in glob(os.path.join(run_dir, '*[0-9]'))])[-1]
-            for step in range(current_log_step + 1, last_log_step + 1):
-                rmtree(os.path.join(run_dir, str(step)))
-
-            # remove future log entries in current log files
-            log_file = os.path.join(log_dir, 'error.log')
-            if os.path.exists(log_file):
-                with open(log_file, 'rw+') as f:
-                    while True:
-                        new_line = f.readline().split()
-                        if len(new_line) > 1:
-                            step = int(new_line[1])
-                            if step == global_step:
-                                f.truncate()
-                                break
-                        else:  # reached end without seeing global_step, checkpoint is ahead of last recorded log entry
-                            break
+            remove_log_residue(run_dir, global_step, configs['run'].io['prediction_frequency'])
+
+        # in-memory copy of the full model state, taken at every checkpoint, to roll back to after a nan
+        num_recoveries = 0
+        last_good_snapshot = models['training'].snapshot(session, full=True) if args_.in_session_recoveries > 0 \
+                             else None
+
+        # training steps are traced every traceFrequency steps, and after a SIGUSR1, along with the next evaluation
+        trace_frequency = configs['run'].io['trace_frequency']
+        trace_evaluation = False
+
+        # state of the training input pipeline as of the last evaluation, whose health is logged at every evaluation
+        last_health = pipeline_health(models, session)
+
+        # evaluation running in the background, to be completed on this thread (see complete_evaluation)
+        pending_evaluation = None
 
         # training loop
+        startup_reported = False
+        done = models['training'].is_done()
         try:
-            while not models['training'].is_done():
-                # Train for one step
-                global_step, ids = models['training'].train(session)
-
-                # Set and create logging directory and files if needed
-                log_dir = os.path.join(run_dir, str((global_step // configs['run'].io['prediction_frequency']) + 1))
-                log_file = os.path.join(log_dir, 'error.log')
-                if not os.path.exists(log_dir):
-                    os.makedirs(log_dir)
-
-                # Evaluate error, get diagnostics, and raise exceptions if necessary
-                if global_step % configs['run'].io['evaluation_frequency'] == 0:
-                    diagnostics = evaluate_and_log(log_file, configs, models, session)
-
-                    # restart if a milestone is missed
-                    val_ref_set_prefix = 'un'\
-                        if configs['run'].optimization['validation_reference'] == 'unweighted'\
-                        else ''
-                    min_loss_achieved = diagnostics[val_ref_set_prefix + 'wt_val_loss']['min_tertiary_loss_achieved_all']
-                    for step, loss in configs['run'].optimization['validation_milestone'].iteritems():
-                        if global_step >= step and min_loss_achieved > loss:
-                            raise MilestoneError('Milestone at step '
-                                                 + str(global_step)
-                                                 + ' missed because minimum loss achieved so far is '
-                                                 + str(min_loss_achieved))
-
-                    # restart if gradients are zero
-                    if (diagnostics['min_grad'] == 0 and diagnostics['max_grad'] == 0)\
-                        or (configs['run'].evaluation['include_diagnostics']
-                            and (np.isnan(diagnostics['min_grad'])
-                                 or np.isnan(diagnostics['max_grad']))):
-                        raise DeadGradientError('Gradient is dead.')
-
-                # Predict structures.
-                # Currently assumes that weighted training and validation models are available,
-                # and fails if they're not.
-                if global_step % configs['run'].io['prediction_frequency'] == 0:
-                    predict_and_log(log_dir, configs, models, session)
-
-                # Checkpoint
-                if global_step % configs['run'].io['checkpoint_frequency'] == 0:
-                    models['training'].save(session)
+            while not done:
+                try:
+                    # Train for up to stepsBetweenChecks steps, stopping at the next step that's evaluated, predicted,
+                    # or checkpointed. if enabled, diagnostics needed at the new step are computed with the last step
+                    num_steps = steps_to_next_check(configs, global_step, trace_frequency)
+                    if trace_requested.is_set() or \
+                            (trace_frequency is not None and (global_step + num_steps) % trace_frequency == 0):
+                        trace_requested.clear()
+                        trace_prefix = os.path.join(traces_dir, str(global_step + num_steps) + '_')
+                        trace_evaluation = True
+                    else:
+                        trace_prefix = None
+                    if configs['run'].computing['fuse_step_fetches'] \
+                            and configs['run'].evaluation['include_diagnostics'] \
+                            and (global_step + num_steps) % configs['run'].io['evaluation_frequency'] == 0:
+                        global_step, ids, step_diagnostics = models['training'].train_and_diagnose(
+                            session, num_steps, trace_prefix=trace_prefix)
+                    else:
+                        global_step, ids = models['training'].train(session, num_steps, trace_prefix=trace_prefix)
+                        step_diagnostics = None
+
+                    # report where the time until the first training call finished went
+                    if not startup_reported:
+                        write_timing_report(os.path.join(logs_dir, STARTUP_TIMES_FILENAME), startup_title,
+                                            'total, until end of first training call')
+                        startup_reported = True
+
+                    # Set and create logging directory and files if needed
+                    log_dir = os.path.join(run_dir, str((global_step // configs['run'].io['prediction_frequency']) + 1))
+                    log_file = os.path.join(log_dir, 'error.log')
+                    if not os.path.exists(log_dir):
+                        os.makedirs(log_dir)
+
+                    # Evaluate error, get diagnostics, and raise exceptions if necessary
+                    if global_step % configs['run'].io['evaluation_frequency'] == 0:
+                        health = pipeline_health(models, session)
+                        log_pipeline_health(os.path.join(log_dir, PIPELINE_LOG_FILENAME), global_step, health,
+                                            last_health)
+                        last_health = health
+
+                        trace_prefix = os.path.join(traces_dir, str(global_step) + '_') if trace_evaluation else None
+                        trace_evaluation = False
+                        if evaluation_worker is not None:
+                            # evaluate a snapshot in the background, with only one evaluation in flight at a time.
+                            # diagnostics need a training batch and so are computed here, before training resumes.
+                            # the state updates and checks of the last evaluation are completed first, on this thread
+                            pending_evaluation = complete_evaluation(evaluation_worker, pending_evaluation)
+                            evaluation_snapshot = models['training'].snapshot(session)
+                            evaluations = {}
+                            evaluation_worker.submit(evaluate_snapshot, configs, models, session, evaluations,
+                                                     evaluation_snapshot, trace_prefix)
+                            pending_evaluation = (log_file, configs, models, session, evaluation_snapshot,
+                                                  step_diagnostics or diagnose(configs, models, session), evaluations)
+                        else:
+                            evaluate_log_and_check(log_file, configs, models, session, diagnostics=step_diagnostics,
+                                                   trace_prefix=trace_prefix)
+
+                    # Predict structures.
+                    # Currently assumes that weighted training and validation models are available,
+                    # and fails if they're not.
+                    if global_step % configs['run'].io['prediction_frequency'] == 0:
+                        if evaluation_worker is not None:  # evaluation and prediction models share their data queues
+                            pending_evaluation = complete_evaluation(evaluation_worker, pending_evaluation)
+                        predict_and_log(log_dir, configs, models, session, prediction_writer, ensemble)
+
+                    # Checkpoint
+                    if global_step % configs['run'].io['checkpoint_frequency'] == 0:
+                        if evaluation_worker is not None:  # checkpoints include minimum evaluation losses
+                            pending_evaluation = complete_evaluation(evaluation_worker, pending_evaluation)
+                        if checkpoint_worker is not None:
+                            # write a snapshot in the background, with only one checkpoint in flight at a time
+                            checkpoint_worker.join()
+                            snapshot = models['training'].snapshot(session, full=True)
+                            checkpoint_worker.submit(models['training'].save, session, snapshot)
+                        else:
+                            snapshot = None
+                            models['training'].save(session)
+                        if last_good_snapshot is not None:
+                            last_good_snapshot = snapshot or models['training'].snapshot(session, full=True)
+
+                    # wait for the last jobs once training is done, so that their failures can still be recovered from
+                    done = models['training'].is_done()
+                    if done:
+                        if evaluation_worker is not None:
+                            pending_evaluation = complete_evaluation(evaluation_worker, pending_evaluation)
+                        if checkpoint_worker is not None:
+                            checkpoint_worker.join()
+                        if prediction_writer is not None:
+                            prediction_writer.join()
+
+                except (tf.errors.InvalidArgumentError,
+                        DeadGradientError):  # InvalidArgumentError is usually triggered by a nan
+                    if num_recoveries == args_.in_session_recoveries:
+                        raise
+
+                    # roll back to the last checkpointed state and carry on with the next batch, skipping the
+                    # offending one. in-flight evaluations are of the diverged model, so their results are dropped
+                    num_recoveries += 1
+                    pending_evaluation = None
+                    global_step = roll_back(run_dir, configs, models, session, last_good_snapshot,
+                                            [evaluation_worker, prediction_writer])
+                    print('Nan or dead gradient encountered; model rolled back in-session to step ' + str(global_step) +
+                          ' (recovery ' + str(num_recoveries) + ' of ' + str(args_.in_session_recoveries) + ').')
 
         except tf.errors.OutOfRangeError:
             print('Epoch limit reached.')
+            if prediction_writer is not None:
+                prediction_writer.join()
 
         except (tf.errors.InvalidArgumentError,
                 DeadGradientError):  # InvalidArgumentError is usually triggered by a nan
+            if evaluation_worker is not None:
+                evaluation_worker.close(reraise=False)
+            if checkpoint_worker is not None:
+                checkpoint_worker.close(reraise=False)
             models['training'].finish(session, save=False)
 
             if args_.restart_on_dead_gradient:
@@ -537,6 +872,10 @@ def loop(args_):
                 print('Nan or dead gradient encountered; model will be terminated.')
 
         except MilestoneError:
+            if evaluation_worker is not None:
+                evaluation_worker.close(reraise=False)
+            if checkpoint_worker is not None:
+                checkpoint_worker.close(reraise=False)
             models['training'].finish(session, save=False)
 
             if args_.restart_on_missed_milestone:
@@ -560,8 +899,14 @@ def loop(args_):
             raise
 
         finally:  # Wrap up (ask threads to stop, save final checkpoint, etc.)
+            if evaluation_worker is not None:
+                evaluation_worker.close(reraise=False)
+            if checkpoint_worker is not None:  # pending checkpoints are completed before the model finishes
+                checkpoint_worker.close(reraise=False)
             if models['training'].is_started:
                 models['training'].finish(session, save=args_.checkpoint_on_finish)
+            if prediction_writer is not None:  # failures were already reported on the normal exit path
+                prediction_writer.close(reraise=False)
             stdout_err_file_handle.close()
 
     return restart
@@ -582,6 +927,13 @@ if __name__ == '__main__':
                         action='store_true',
                         help='if set only a single batch of prediction is made with no training')
 
+    parser.add_argument('-E',
+                        '--ensemble_checkpoint',
+                        action='append',
+                        help='checkpoint (prefix or directory) to include in an ensemble prediction (more than one is '
+                             + 'allowed). requires -p. predicted structures are the consensus of the ensemble, obtained by averaging '
+                             + 'dihedrals, and the structures predicted by each checkpoint are saved alongside them.')
+
     parser.add_argument('-e',
                         '--evaluation_model',
                         action='append',
@@ -601,6 +953,16 @@ if __name__ == '__main__':
                              + 'restart from last checkpoint or from scratch if no checkpoint is found. '
                              + 'default behavior is for model to terminate.')
 
+    # noinspection PyTypeChecker
+    parser.add_argument('-n',
+                        '--in_session_recoveries',
+                        type=int,
+                        default=0,
+                        help='number of times a zero gradient or nan is recovered from without restarting, by rolling '
+                             + 'back to an in-memory copy of the last checkpoint and skipping the offending batch. '
+                             + 'once exhausted, the model is restarted or terminated as determined by '
+                             + 'restart_on_dead_gradient.')
+
     parser.add_argument('-R',
                         '--restart_on_missed_milestone',
                         action='store_true',
@@ -642,8 +1004,9 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    # set up signal for premature interruption
+    # set up signal for premature interruption, and for tracing the next training step
     signal.signal(signal.SIGINT, lambda _, __: exit(0))
+    signal.signal(signal.SIGUSR1, lambda _, __: trace_requested.set())
 
     # invoke inner loop
     while loop(args):
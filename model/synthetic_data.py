@@ -0,0 +1,286 @@
+#!/usr/bin/python
+
+""" Generates synthetic ProteinNet-like data sets for load testing.
+
+    Proteins are written as TF Records in the same schema as convert_to_tfrecord. Their tertiary structures
+    are reconstructed with NeRF from random but plausible backbone dihedrals, using the same bond lengths and
+    angles as the model, and are in picometers. Secondary structures follow the sampled dihedrals. Missing
+    residues come in contiguous gaps, whose coordinates are zeroed out as in ProteinNet.
+
+    Generation is vectorized over blocks of proteins, and shards are written in parallel by separate
+    processes. Each shard is seeded independently, so the data set is the same regardless of the number of
+    processes used.
+"""
+
+__author__ = "Mohammed AlQuraishi"
+__copyright__ = "Copyright 2018, Harvard Medical School"
+__license__ = "MIT"
+
+import argparse
+import os
+
+from multiprocessing import Pool
+
+import numpy as np
+import tensorflow as tf
+
+from convert_to_tfrecord import dict_to_tfrecord
+from geom_ops import BOND_LENGTHS, BOND_ANGLES, NUM_DIHEDRALS, NUM_DIMENSIONS
+
+# constants
+NUM_AAS = 20
+BLOCK_SIZE = 256  # number of proteins generated at once
+LENGTH_DISTRIBUTIONS = ['lognormal', 'uniform']
+LOGNORMAL_MEDIAN_LENGTH = 200.
+LOGNORMAL_SIGMA = 0.6
+MEAN_GAP_LENGTH = 5.
+
+# background amino acid frequencies, in the order of convert_to_tfrecord's alphabet (ACDEFGHIKLMNPQRSTVWY)
+AA_FREQUENCIES = np.array([8.25, 1.37, 5.45, 6.75, 3.86, 7.07, 2.27, 5.96, 5.84, 9.66,
+                           2.42, 4.06, 4.70, 3.93, 5.53, 6.56, 5.34, 6.87, 1.08, 2.92])
+AA_FREQUENCIES /= AA_FREQUENCIES.sum()
+
+# secondary structure elements as (DSSP label, mean phi, mean psi, mean length), in degrees and residues
+# the label indices are those of convert_to_tfrecord's DSSP alphabet (LHBEGITS)
+SECONDARY_ELEMENTS = np.array([[1, -57., -47., 12.],  # alpha helix
+                               [3, -119., 113., 6.],  # beta strand
+                               [0, -80., 150., 4.],   # coil (polyproline)
+                               [6, 60., 40., 2.]])    # turn (left-handed)
+SECONDARY_FREQUENCIES = np.array([0.35, 0.25, 0.3, 0.1])
+DIHEDRAL_STDDEV = 12.
+OMEGA_STDDEV = 5.
+
+
+def sample_lengths(num_proteins, rng, min_length, max_length, length_distribution='lognormal'):
+    """ Samples protein lengths, clipped to [min_length, max_length]. """
+
+    if length_distribution == 'lognormal':
+        lengths = rng.lognormal(np.log(LOGNORMAL_MEDIAN_LENGTH), LOGNORMAL_SIGMA, num_proteins)
+    elif length_distribution == 'uniform':
+        lengths = rng.uniform(min_length, max_length + 1, num_proteins)
+    else:
+        raise ValueError('Invalid length distribution: ' + length_distribution)
+
+    return np.clip(lengths.astype(int), min_length, max_length)
+
+
+def sample_dihedrals(num_residues, num_proteins, rng):
+    """
+    Samples backbone dihedrals from runs of secondary structure elements.
+
+    Returns [NUM_RESIDUES, NUM_PROTEINS, NUM_DIHEDRALS] dihedrals in radians and [NUM_RESIDUES, NUM_PROTEINS]
+    DSSP labels.
+    """
+
+    # runs of elements. each run is at least one residue long, so num_residues of them cover every protein.
+    elements = rng.choice(len(SECONDARY_ELEMENTS), (num_residues, num_proteins), p=SECONDARY_FREQUENCIES)
+    run_ends = np.cumsum(rng.geometric(1. / SECONDARY_ELEMENTS[elements, 3]), axis=0)
+
+    # element of each residue, found from the runs' ends
+    residue_elements = np.empty((num_residues, num_proteins), dtype=int)
+    for protein in range(num_proteins):
+        residue_elements[:, protein] = elements[np.searchsorted(run_ends[:, protein], np.arange(num_residues),
+                                                                side='right'), protein]
+
+    phi = rng.normal(SECONDARY_ELEMENTS[residue_elements, 1], DIHEDRAL_STDDEV)
+    psi = rng.normal(SECONDARY_ELEMENTS[residue_elements, 2], DIHEDRAL_STDDEV)
+    omega = rng.normal(180., OMEGA_STDDEV, phi.shape)
+    dihedrals = np.radians(np.stack([phi, psi, omega], axis=-1))
+
+    return dihedrals, SECONDARY_ELEMENTS[residue_elements, 0].astype(int)
+
+
+def dihedrals_to_coordinates(dihedrals):
+    """
+    NumPy counterpart of geom_ops' dihedral_to_point and point_to_coordinate (with a single fragment).
+
+    Takes [NUM_RESIDUES, NUM_PROTEINS, NUM_DIHEDRALS] dihedrals and returns
+    [NUM_RESIDUES x NUM_DIHEDRALS, NUM_PROTEINS, NUM_DIMENSIONS] coordinates.
+    """
+
+    num_residues, num_proteins = dihedrals.shape[:2]
+
+    # [NUM_RESIDUES x NUM_DIHEDRALS, NUM_PROTEINS, NUM_DIMENSIONS]
+    r_cos_theta = np.broadcast_to(BOND_LENGTHS * np.cos(np.pi - BOND_ANGLES), dihedrals.shape)
+    r_sin_theta = BOND_LENGTHS * np.sin(np.pi - BOND_ANGLES)
+    points = np.stack([r_cos_theta, np.cos(dihedrals) * r_sin_theta, np.sin(dihedrals) * r_sin_theta], axis=-1)
+    points = points.transpose([0, 2, 1, 3]).reshape([-1, num_proteins, NUM_DIMENSIONS])
+
+    # same initial coordinates as point_to_coordinate
+    a, b, c = [np.tile(row, [num_proteins, 1]) for row in np.array([[-np.sqrt(1.0 / 2.0), np.sqrt(3.0 / 2.0), 0],
+                                                                     [-np.sqrt(2.0), 0, 0], [0, 0, 0]])]
+
+    coordinates = np.empty_like(points)
+    for i, point in enumerate(points):
+        bc = c - b
+        bc /= np.linalg.norm(bc, axis=-1, keepdims=True)
+        n = np.cross(b - a, bc)
+        n /= np.linalg.norm(n, axis=-1, keepdims=True)
+        m = np.stack([bc, np.cross(n, bc), n], axis=-1)  # [NUM_PROTEINS, NUM_DIMS, 3 TRANS]
+        coordinates[i] = np.einsum('pdt,pt->pd', m, point) + c
+        a, b, c = b, c, coordinates[i]
+
+    # lose last atom and pad from the front with the origin, as point_to_coordinate does
+    return np.concatenate([np.zeros_like(coordinates[:1]), coordinates[:-1]])
+
+
+def sample_mask(length, rng, gap_fraction):
+    """ Samples a 0/1 mask of missing residues, which come in contiguous gaps. """
+
+    mask = np.ones(length, dtype=int)
+    for _ in range(rng.poisson(length * gap_fraction / MEAN_GAP_LENGTH)):
+        start = rng.randint(length)
+        mask[start:start + rng.geometric(1. / MEAN_GAP_LENGTH)] = 0
+
+    return mask
+
+
+def synthetic_proteins(num_proteins, rng, min_length, max_length, length_distribution='lognormal',
+                       num_evo_entries=20, gap_fraction=0.05):
+    """ Generates dicts of synthetic proteins in the format expected by dict_to_tfrecord. """
+
+    for block_start in range(0, num_proteins, BLOCK_SIZE):
+        block_size = min(BLOCK_SIZE, num_proteins - block_start)
+        lengths = sample_lengths(block_size, rng, min_length, max_length, length_distribution)
+        num_residues = lengths.max()
+
+        # structures, reconstructed at the block's maximum length and then truncated
+        dihedrals, secondaries = sample_dihedrals(num_residues, block_size, rng)
+        coordinates = dihedrals_to_coordinates(dihedrals)
+
+        # sequences, and PSSM-like profiles that favor each residue's own amino acid. entries past the 20th
+        # (e.g. ProteinNet's information content) are uniform.
+        primaries = rng.choice(NUM_AAS, (num_residues, block_size), p=AA_FREQUENCIES)
+        profiles = rng.gamma(0.5, size=(num_residues, block_size, NUM_AAS))
+        profiles[np.arange(num_residues)[:, np.newaxis], np.arange(block_size), primaries] += 2.
+        profiles /= profiles.sum(axis=-1, keepdims=True)
+        evolutionaries = np.concatenate([profiles, rng.rand(num_residues, block_size,
+                                                            max(num_evo_entries - NUM_AAS, 0))], axis=-1)
+
+        for protein, length in enumerate(lengths):
+            mask = sample_mask(length, rng, gap_fraction)
+            tertiary = coordinates[:length * NUM_DIHEDRALS, protein] * np.repeat(mask, NUM_DIHEDRALS)[:, np.newaxis]
+
+            yield {'id': str(block_start + protein),
+                   'primary': primaries[:length, protein].tolist(),
+                   'evolutionary': evolutionaries[:length, protein, :num_evo_entries].T.tolist(),
+                   'secondary': secondaries[:length, protein].tolist(),
+                   'tertiary': tertiary.T.tolist(),
+                   'mask': mask.tolist()}
+
+
+def write_shard(filename, num_proteins, seed, id_prefix='', groups=None, **kwargs):
+    """
+    Writes num_proteins synthetic proteins to filename as TF Records. kwargs are passed to synthetic_proteins.
+
+    If groups are passed, ids are prefixed by them in turn (e.g. '30#') as in ProteinNet's validation sets.
+    """
+
+    writer = tf.python_io.TFRecordWriter(filename)
+    for protein in synthetic_proteins(num_proteins, np.random.RandomState(seed), **kwargs):
+        group_prefix = groups[int(protein['id']) % len(groups)] + '#' if groups else ''
+        protein['id'] = group_prefix + id_prefix + protein['id']
+        writer.write(dict_to_tfrecord(protein).SerializeToString())
+    writer.close()
+
+
+def _write_shard(args):
+    # unpacks arguments for Pool.map
+    filename, num_proteins, seed, groups, kwargs = args
+    write_shard(filename, num_proteins, seed, id_prefix=os.path.basename(filename) + '_', groups=groups, **kwargs)
+
+
+# main
+if __name__ == '__main__':
+    # parse command-line arguments
+    parser = argparse.ArgumentParser(description="Generate a synthetic ProteinNet-like data set of TF Records.")
+
+    parser.add_argument('output_directory',
+                        help='directory to write shards to. shards are named 1, 2, ... as in ProteinNet.')
+
+    # noinspection PyTypeChecker
+    parser.add_argument('-n',
+                        '--num_proteins',
+                        type=int,
+                        default=10000,
+                        help='total number of proteins')
+
+    # noinspection PyTypeChecker
+    parser.add_argument('-s',
+                        '--num_shards',
+                        type=int,
+                        default=10,
+                        help='number of shards (files) the proteins are split across')
+
+    # noinspection PyTypeChecker
+    parser.add_argument('-p',
+                        '--num_processes',
+                        type=int,
+                        default=None,
+                        help='number of processes writing shards in parallel. default is the number of CPUs.')
+
+    parser.add_argument('-l',
+                        '--length_distribution',
+                        choices=LENGTH_DISTRIBUTIONS,
+                        default='lognormal',
+                        help='distribution of protein lengths. lognormal roughly follows that of ProteinNet.')
+
+    # noinspection PyTypeChecker
+    parser.add_argument('--min_length',
+                        type=int,
+                        default=30,
+                        help='minimum protein length')
+
+    # noinspection PyTypeChecker
+    parser.add_argument('--max_length',
+                        type=int,
+                        default=700,
+                        help='maximum protein length')
+
+    # noinspection PyTypeChecker
+    parser.add_argument('-e',
+                        '--num_evo_entries',
+                        type=int,
+                        default=20,
+                        help='number of entries in evolutionary profiles (numEvoEntries)')
+
+    # noinspection PyTypeChecker
+    parser.add_argument('-m',
+                        '--gap_fraction',
+                        type=float,
+                        default=0.05,
+                        help='expected fraction of residues missing from structures')
+
+    parser.add_argument('-g',
+                        '--groups',
+                        type=lambda g: g.split(','),
+                        help='comma-separated evaluation groups (e.g. 30,50,70,90) to prefix ids with in turn, '
+                             + 'as in ProteinNet validation sets')
+
+    # noinspection PyTypeChecker
+    parser.add_argument('-r',
+                        '--seed',
+                        type=int,
+                        default=0,
+                        help='random seed. shard i is seeded with seed + i.')
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.output_directory):
+        os.makedirs(args.output_directory)
+
+    generation_kwargs = {'min_length': args.min_length,
+                         'max_length': args.max_length,
+                         'length_distribution': args.length_distribution,
+                         'num_evo_entries': args.num_evo_entries,
+                         'gap_fraction': args.gap_fraction}
+    shards = [(os.path.join(args.output_directory, str(shard + 1)),
+               args.num_proteins // args.num_shards + (1 if shard < args.num_proteins % args.num_shards else 0),
+               args.seed + shard,
+               args.groups,
+               generation_kwargs) for shard in range(args.num_shards)]
+
+    pool = Pool(args.num_processes)
+    pool.map(_write_shard, shards)
+    pool.close()
+    pool.join()
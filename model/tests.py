@@ -9,11 +9,23 @@ from ast import literal_eval
 import numpy as np
 import numpy.random as npr
 import tensorflow as tf
+import json
 import time
 import os
-
-from model import RGNModel
-from config import RGNConfig
+import warnings
+
+from model import RGNModel, _apply_checkpoint_delta, _save_checkpoint_delta, _write_memory_summary, \
+    _graph_elements_to_names, _read_proteins, _loss_quotient_factors, _reduce_loss_quotients, _accumulate_losses, \
+    _exact_losses, _coordinates, _ensemble_coordinates
+from config import RGNConfig, RunConfig
+from net_ops import group_index, id_filter, parse_protein
+from outputs import PredictionStore, backbone_to_pdb, write_predictions
+from geom_ops import dihedral_to_point, point_to_coordinate
+from synthetic_data import dihedrals_to_coordinates, sample_dihedrals, write_shard
+from utils import BackgroundWorker, Switch, timed, write_timing_report
+from benchmarks import benchmark_weighting_matrix, run_benchmark
+from protling import DeadGradientError, check_diagnostics, roll_back, steps_to_next_check, pipeline_health, \
+    log_pipeline_health, evaluate_and_log, PIPELINE_LOG_FILENAME, STARTUP_TIMES_FILENAME
 
 # Constants and shared templates used by most / all test functions
 base_dir = '../'
@@ -114,6 +126,27 @@ def dicts_to_matched_tuples(dict1, dict2):
         raise RuntimeError('Dictionaries are not comparable.')
 
 
+def synthetic_configs(data_dir, num_proteins=30, groups=None):
+    """
+    Writes a shard of synthetic proteins to data_dir, and returns copies of the training and evaluation templates
+    that read it instead of the canonical data.
+    """
+
+    data_file = os.path.join(data_dir, 'synthetic')
+    write_shard(data_file, num_proteins, 0, groups=groups, min_length=20, max_length=max_seq_length,
+                length_distribution='uniform')
+
+    configs = []
+    for template in [c_train_template, c_eval_template]:
+        config = deepcopy(template)
+        config.io['data_files'] = [data_file]
+        config.io['checkpoints_directory'] = os.path.join(data_dir, 'checkpoints', '')
+        config.io['num_edge_residues'] = 0  # synthetic proteins have no edge residues
+        configs.append(config)
+
+    return configs
+
+
 # Test classes
 # noinspection PyShadowingBuiltins,PyShadowingNames
 class CanonicalTest(tf.test.TestCase):
@@ -3657,5 +3690,803 @@ class IdiosyncraticTest(tf.test.TestCase):
             # run tests
 
 
+class OutputsTest(tf.test.TestCase):
+    """ Predictions written in each format and read back, and PDB output. """
+
+    def testPredictionStoreRoundTrip(self):
+        store_dir = self.get_temp_dir()
+        first = {'a': {'tertiary': npr.rand(3, 9), 'recurrent_states': npr.rand(8).astype('float16')},
+                 'b': {'tertiary': npr.rand(3, 6).astype('float32')}}
+        second = {'a': {'tertiary': npr.rand(3, 12)}}
+
+        write_predictions(store_dir, first, 'store')
+        write_predictions(store_dir, second, 'store')
+        store = PredictionStore(store_dir)
+
+        self.assertEqual(sorted(store.ids()), ['a', 'b'])
+        self.assertAllEqual(store['b']['tertiary'], first['b']['tertiary'])
+        self.assertEqual(store['b']['tertiary'].dtype, np.float32)
+        self.assertAllEqual(store['a']['tertiary'], second['a']['tertiary'])  # latest round wins
+        self.assertEqual(store.outputs('a'), ['tertiary'])  # and replaces the earlier round's recurrent states
+
+    def testEveryFormatReadable(self):
+        tertiary = (npr.rand(3, 9) * 1000).astype('float32')  # three residues
+        recurrent_states = npr.rand(8).astype('float16')
+        predictions = {'1ABC_1_A': {'tertiary': tertiary, 'recurrent_states': recurrent_states,
+                                    'primary': np.array([0, 19, 5])}}
+
+        for format_ in ['text', 'npy', 'npz', 'store', 'pdb', 'cif']:
+            outputs_dir = os.path.join(self.get_temp_dir(), format_)
+            os.makedirs(outputs_dir)
+            write_predictions(outputs_dir, predictions, format_)
+            path = os.path.join(outputs_dir, '1ABC_1_A')
+
+            for case in Switch(format_):
+                if case('text'):
+                    self.assertAllClose(np.loadtxt(path + '.tertiary'), tertiary, rtol=1e-6)
+                    self.assertAllClose(np.loadtxt(path + '.recurrent_states'), recurrent_states)
+                elif case('npy'):
+                    self.assertAllEqual(np.load(path + '.tertiary.npy'), tertiary)
+                    self.assertEqual(np.load(path + '.recurrent_states.npy').dtype, np.float16)
+                elif case('npz'):
+                    archive = np.load(os.path.join(outputs_dir, 'predictions_0.npz'))
+                    self.assertAllEqual(archive['1ABC_1_A.tertiary'], tertiary)
+                    self.assertAllEqual(archive['1ABC_1_A.primary'], [0, 19, 5])
+                elif case('store'):
+                    self.assertAllEqual(PredictionStore(outputs_dir)['1ABC_1_A']['tertiary'], tertiary)
+                elif case('pdb', 'cif'):
+                    with open(path + '.' + format_) as f:
+                        atoms = [line for line in f if line.startswith('ATOM')]
+                    self.assertEqual(len(atoms), 9)
+
+    def testBackboneToPdb(self):
+        tertiary = np.arange(18, dtype='float32').reshape(3, 6) * 100  # two residues, in picometers
+        primary = np.array([0, 19, 5])  # ALA TYR, trailing edge residue ignored
+
+        lines = backbone_to_pdb(tertiary, primary).splitlines()
+
+        self.assertEqual(len(lines), 8)  # six atoms, TER, and END
+        self.assertTrue(all(len(line) == 80 for line in lines[:6]))
+        self.assertEqual(lines[1][12:26], ' CA  ALA A   1')
+        self.assertEqual(lines[5][12:26], ' C   TYR A   2')
+        self.assertAllClose([float(lines[4][i:i + 8]) for i in [30, 38, 46]], [4., 10., 16.])
+        self.assertEqual(lines[6][:6], 'TER   ')
+
+
+class NetOpsTest(tf.test.TestCase):
+    """ Group membership of protein ids. """
+
+    def testGroupIndex(self):
+        ids = ['30#1ABC_1_A', '10#2DEF_1_B', '1GHI_1_C', '50#3JKL_2_A#extra', '10#4MNO_1_A']
+
+        with self.test_session():
+            self.assertAllEqual(group_index(ids, ['10', '30']).eval(), [1, 0, -1, -1, 0])
+            self.assertAllEqual(group_index(ids[0], ['10', '30']).eval(), 1)
+            self.assertAllEqual(id_filter(ids, '10').eval(), [False, True, False, False, True])
+
+
+class CheckpointTest(tf.test.TestCase):
+    """ Checkpoints written from snapshots or as deltas, and restored in shards. """
+
+    def testDeltaRoundTrip(self):
+        delta_file = os.path.join(self.get_temp_dir(), 'checkpoint-10.delta.npz')
+        base = {'RGN/weights': npr.rand(4, 3).astype('float32'), 'RGN/global_step': np.int64(10),
+                'RGN/min_loss': np.float32(2.5)}
+        values = {'RGN/weights': base['RGN/weights'] + npr.rand(4, 3).astype('float32'),
+                  'RGN/global_step': np.int64(25), 'RGN/min_loss': np.float32(2.5)}
+
+        _save_checkpoint_delta(delta_file, base, values)
+        deltas = np.load(delta_file)
+
+        self.assertEqual(sorted(deltas.files), ['RGN/global_step', 'RGN/weights'])  # unchanged variables omitted
+        for name in deltas.files:
+            restored = _apply_checkpoint_delta(base[name], deltas[name])
+            self.assertEqual(restored.dtype, np.asarray(values[name]).dtype)
+            self.assertAllEqual(restored, values[name])
+
+    def testSnapshotSaveAndPruning(self):
+        c_train, _ = synthetic_configs(self.get_temp_dir())
+        c_train.io['max_checkpoints'] = 2
+        checkpoints_dir = os.path.dirname(c_train.io['checkpoints_directory'])
+
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+            m_train = RGNModel('training', c_train)
+            m_train.start([], sess, False)
+            try:
+                # snapshots are saved after training has moved past them, as a background checkpoint would be
+                prefixes = []
+                for _ in range(3):
+                    m_train.train(sess)
+                    snapshot = m_train.snapshot(sess, full=True)
+                    m_train.train(sess)
+                    prefixes.append(m_train.save(sess, snapshot))
+
+                latest_checkpoint = tf.train.latest_checkpoint(checkpoints_dir)
+                self.assertEqual(latest_checkpoint, prefixes[-1])
+                self.assertEqual(latest_checkpoint, c_train.io['checkpoints_directory'] + '-5')
+                self.assertEqual(sorted(glob(os.path.join(checkpoints_dir, '*.index'))),
+                                 [prefix + '.index' for prefix in prefixes[1:]])  # oldest one pruned
+                self.assertEqual(glob(os.path.join(checkpoints_dir, '*_temp*')), [])
+
+                # noinspection PyProtectedMember
+                m_train._restore(sess, latest_checkpoint)
+                for var, value in snapshot.iteritems():
+                    self.assertAllEqual(sess.run(var), value)
+            finally:
+                m_train.finish(sess, save=False, close_session=False, reset_graph=False)
+
+    def testDeltaSaveAndRestore(self):
+        c_train, _ = synthetic_configs(self.get_temp_dir())
+        c_train.io['checkpoint_base_frequency'] = 3
+        c_train.optimization['optimizer'] = 'adam'
+        checkpoints_dir = os.path.dirname(c_train.io['checkpoints_directory'])
+
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+            m_train = RGNModel('training', c_train)
+            m_train.start([], sess, False)
+            try:
+                m_train.train(sess, 2)
+                base_prefix = m_train.save(sess)
+                m_train.train(sess, 2)
+                snapshot = m_train.snapshot(sess, full=True)
+                delta_file = m_train.save(sess)
+                m_train.train(sess, 2)
+
+                self.assertEqual(delta_file, base_prefix + '.delta.npz')
+                self.assertEqual(tf.train.latest_checkpoint(checkpoints_dir), base_prefix)
+
+                # noinspection PyProtectedMember
+                m_train._restore(sess, base_prefix)
+                for var, value in snapshot.iteritems():
+                    restored = sess.run(var)
+                    self.assertEqual(restored.tobytes(), np.asarray(value).tobytes())  # bit for bit
+            finally:
+                m_train.finish(sess, save=False, close_session=False, reset_graph=False)
+
+    def testShardedRestore(self):
+        c_train, _ = synthetic_configs(self.get_temp_dir())
+        c_train.optimization['optimizer'] = 'adam'  # has slots, which are training state
+
+        def run(num_restore_shards, restore_training_state=True):
+            config = deepcopy(c_train)
+            config.computing['num_restore_shards'] = num_restore_shards
+            with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+                m_train = RGNModel('training', config)
+                m_train.start([], sess, restore_training_state=restore_training_state)
+                try:
+                    if num_restore_shards == 1:
+                        m_train.train(sess, 3)
+                        m_train.save(sess)
+                    model_vars = m_train.snapshot(sess)
+                    return ({var.op.name: value for var, value in m_train.snapshot(sess, full=True).iteritems()},
+                            [var.op.name for var in model_vars],
+                            {var.op.name: sess.run(var.initial_value) for var in tf.global_variables()
+                             if var not in model_vars})
+                finally:
+                    m_train.finish(sess, save=False, close_session=False, reset_graph=False)
+
+        saved, model_vars, _ = run(1)
+        restored, _, _ = run(3)
+        self.assertEqual(sorted(restored.keys()), sorted(saved.keys()))
+        for name, value in saved.iteritems():
+            self.assertAllEqual(restored[name], value)
+
+        # without training state, only the model weights, global step, and curriculum step are restored
+        restored, _, initial_values = run(3, restore_training_state=False)
+        self.assertTrue(any('Adam' in name and not np.array_equal(saved[name], value)
+                            for name, value in initial_values.iteritems()))  # i.e. slots were saved trained
+        for name in model_vars:
+            self.assertAllEqual(restored[name], saved[name])
+        for name, value in initial_values.iteritems():
+            self.assertAllEqual(restored[name], value)
+
+
+class TraceTest(tf.test.TestCase):
+    """ Memory summaries written from the metadata of traced runs. """
+
+    def testMemorySummary(self):
+        run_metadata = tf.RunMetadata()
+        dev_stats = run_metadata.step_stats.dev_stats.add(device='/job:localhost/replica:0/task:0/device:CPU:0')
+        for name, records in [('RGN/training/rnn/MatMul', [(1, 1000000), (4, -1000000)]),
+                              ('RGN/training/gradients/RGN/training/rnn/MatMul_grad/MatMul', [(2, 2000000),
+                                                                                              (3, -2000000)]),
+                              ('RGN/evaluation/drmsds/sub', [(5, 500000)])]:
+            memory = dev_stats.node_stats.add(node_name=name).memory.add(allocator_name='cpu')
+            for micros, bytes_ in records:
+                memory.allocation_records.add(alloc_micros=micros, alloc_bytes=bytes_)
+        summary_file = os.path.join(self.get_temp_dir(), 'trace.memory.txt')
+
+        _write_memory_summary(summary_file, run_metadata, [('RGN/training/randomization_queue', 10, 4000000)])
+        with open(summary_file) as f_:
+            lines = f_.read().splitlines()
+
+        self.assertEqual(lines[0], 'cpu allocator peak: 3.000 MB')  # forward and gradient ops overlap
+        for line in ['       3.000        3.000        3.000  RGN/training',
+                     '       0.500        0.000        0.500  RGN/evaluation',
+                     '       2.000        2.000        2.000  RGN/training/rnn (gradients)',
+                     '       1.000        1.000        1.000  RGN/training/rnn',
+                     '          10        4.000  RGN/training/randomization_queue']:
+            self.assertIn(line, lines)
+
+    def testTracedStepAndStartupReport(self):
+        c_train, _ = synthetic_configs(self.get_temp_dir())
+        logs_dir = os.path.join(self.get_temp_dir(), 'logs')
+        trace_prefix = os.path.join(logs_dir, 'traces', '3_')
+        write_timing_report(os.path.join(self.get_temp_dir(), 'earlier.log'), '', '')  # clears earlier timings
+
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+            m_train = RGNModel('training', c_train)
+            with timed('start'):
+                m_train.start([], sess, False)
+            try:
+                write_timing_report(os.path.join(logs_dir, STARTUP_TIMES_FILENAME), 'startup', 'total, until start')
+                m_train.train(sess, 3, trace_prefix=trace_prefix)
+                self.assertEqual(m_train.current_step(sess), 3)  # only the last step is traced
+            finally:
+                m_train.finish(sess, save=False, close_session=False, reset_graph=False)
+
+        prefix = trace_prefix + m_train.config.io['name']
+        with open(prefix + '.timeline.json') as f:
+            self.assertTrue(json.load(f)['traceEvents'])
+        with open(prefix + '.ops.txt') as f:
+            self.assertTrue(f.readline().startswith('wall time: '))
+        self.assertTrue(os.path.exists(prefix + '.memory.txt'))
+
+        with open(os.path.join(logs_dir, STARTUP_TIMES_FILENAME)) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], 'startup')
+        self.assertTrue(any(line.endswith('s  start') for line in lines))  # after graph construction
+        self.assertIn('total, until start', lines[-2])
+
+
+class SyntheticDataTest(tf.test.TestCase):
+    """ Generated proteins, checked against the model's geometry and the record format. """
+
+    def testCoordinatesMatchModel(self):
+        dihedrals, _ = sample_dihedrals(50, 4, npr.RandomState(1))
+
+        with self.test_session():
+            expected = point_to_coordinate(dihedral_to_point(dihedrals.astype('float32')), num_fragments=1).eval()
+
+        self.assertAllClose(dihedrals_to_coordinates(dihedrals), expected, atol=0.1)  # picometers
+
+    def testRecordsRoundTrip(self):
+        shard_file = os.path.join(self.get_temp_dir(), '1')
+        write_shard(shard_file, 5, 0, id_prefix='1_', groups=['30', '50'], min_length=20, max_length=40,
+                    length_distribution='uniform', num_evo_entries=21, gap_fraction=0.2)
+        serialized = tf.placeholder(tf.string)
+        protein = parse_protein(serialized, 0, 21)
+
+        with self.test_session() as sess:
+            for i, record in enumerate(tf.python_io.tf_record_iterator(shard_file)):
+                id_, primary, evolutionary, secondary, tertiary, mask, length = sess.run(protein, {serialized: record})
+
+                self.assertEqual(id_, ['30', '50'][i % 2] + '#1_' + str(i))
+                self.assertTrue(20 <= length <= 40)
+                self.assertEqual(evolutionary.shape, (length, 21))
+                self.assertEqual(tertiary.shape, (length * 3, 3))
+                self.assertEqual(mask.shape, (length,))
+                self.assertAllEqual(tertiary[np.repeat(mask, 3) == 0], np.zeros([(mask == 0).sum() * 3, 3]))
+
+
+class LossReductionTest(tf.test.TestCase):
+    """ Loss quotients of all evaluation groups, reduced in the graph or on the host. """
+
+    config = {'tertiary_normalization': 'first', 'batch_dependent_normalization': True, 'num_edge_residues': 0,
+              'num_steps': max_seq_length}
+
+    def _proteins(self, num_proteins):
+        data_file = os.path.join(self.get_temp_dir(), 'synthetic')
+        write_shard(data_file, num_proteins, 0, groups=['30', '50', '70'], min_length=20, max_length=max_seq_length,
+                    length_distribution='uniform')
+        return _read_proteins([data_file], 0, 20)
+
+    @staticmethod
+    def _masks(batch):
+        masks = np.zeros([max_seq_length, max_seq_length, len(batch)], dtype='float32')
+        for i, protein in enumerate(batch):
+            length = len(protein['mask'])
+            masks[:length, :length, i] = np.outer(protein['mask'], protein['mask'])
+        return masks
+
+    def testGroupQuotientsOverTwoInvocations(self):
+        proteins = self._proteins(12)
+        groups = ['30', '50']  # proteins of group 70 only belong to 'all'
+        batch_size = 6
+        config = self.config
+
+        ids = tf.placeholder(tf.string, [batch_size])
+        drmsds = tf.placeholder(tf.float32, [batch_size])
+        masks = tf.placeholder(tf.float32, [max_seq_length, max_seq_length, batch_size])
+        memberships = tf.concat([tf.fill([batch_size, 1], True),
+                                 tf.equal(tf.expand_dims(group_index(ids, groups), 1), tf.range(len(groups)))], 1)
+        numerators, denominators = _reduce_loss_quotients(config, drmsds, masks, memberships, name_prefix='losses')
+        losses, update_op, reduce_op = _accumulate_losses({'exact_evaluation': False, 'num_evaluation_invocations': 2},
+                                                          numerators, denominators, name_prefix='losses')
+
+        # reference quotients of each group, masked separately
+        numerator_factors, denominator_factors = _loss_quotient_factors(config, drmsds, masks)
+        expected_numerators = tf.stack([tf.reduce_sum(tf.boolean_mask(numerator_factors * drmsds, memberships[:, i]))
+                                        for i in range(len(groups) + 1)])
+        expected_denominators = tf.stack([tf.reduce_sum(tf.boolean_mask(denominator_factors, memberships[:, i]))
+                                          for i in range(len(groups) + 1)])
+
+        with self.test_session() as sess:
+            sess.run(tf.local_variables_initializer())
+            totals = np.zeros([2, len(groups) + 1])
+            for i in range(2):
+                batch = proteins[i * batch_size:(i + 1) * batch_size]
+                feed_dict = {ids: [protein['id'] for protein in batch], drmsds: npr.rand(batch_size) * 10,
+                             masks: self._masks(batch)}
+
+                fetches = [numerators, denominators, expected_numerators, expected_denominators]
+                if i == 0:
+                    actual_numerators, actual_denominators, numerators_, denominators_, _ = sess.run(
+                        fetches + [update_op], feed_dict)
+                else:
+                    actual_numerators, actual_denominators, numerators_, denominators_, actual_losses, _ = sess.run(
+                        fetches + [losses, reduce_op], feed_dict)
+
+                self.assertAllClose(actual_numerators, numerators_)
+                self.assertAllClose(actual_denominators, denominators_)
+                self.assertTrue(np.all(actual_denominators[1:] > 0))  # every batch has members of every group
+                totals += [actual_numerators, actual_denominators]
+
+            # noinspection PyUnboundLocalVariable
+            self.assertAllClose(actual_losses, totals[0] / totals[1])
+            self.assertAllEqual(sess.run(tf.local_variables()), [np.zeros(3), np.zeros(3)])  # reset for next time
+
+    def testExactLossesMatchGraph(self):
+        batch = self._proteins(8)
+        groups = ['30', '50', '70', '90']  # no protein belongs to group 90
+        batch_size = len(batch)
+        valid = np.array([True] * 6 + [False] * 2)  # as if the last two proteins filled up a cached batch
+        group_indices = np.where(valid, [groups.index(protein['id'].split('#')[0]) for protein in batch],
+                                 -1).astype('int32')
+
+        drmsds = tf.constant(npr.rand(batch_size) * 10, dtype=tf.float32)
+        masks = tf.constant(self._masks(batch))
+        memberships = tf.concat([tf.expand_dims(valid, 1), tf.equal(tf.expand_dims(group_indices, 1),
+                                                                    tf.range(len(groups)))], 1)
+        numerators, denominators = _reduce_loss_quotients(self.config, drmsds, masks, memberships,
+                                                          name_prefix='losses')
+        losses, _, _ = _accumulate_losses({'exact_evaluation': False, 'num_evaluation_invocations': 1},
+                                          numerators, denominators, name_prefix='losses')
+        numerator_factors, denominator_factors = _loss_quotient_factors(self.config, drmsds, masks)
+
+        with self.test_session() as sess:
+            graph_losses, drmsds_, numerator_factors_, denominator_factors_ = sess.run(
+                [losses, drmsds, numerator_factors, denominator_factors])
+
+        protein_dict = {'valid': valid, 'group_indices': group_indices, 'drmsds': drmsds_,
+                        'numerator_factors': numerator_factors_, 'denominator_factors': denominator_factors_}
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            exact_losses = _exact_losses(protein_dict, {'': ['all'] + groups}, {'': 'losses'})['losses']
+
+        self.assertEqual(caught, [])
+        self.assertTrue(np.isnan(exact_losses[-1]) and np.isnan(graph_losses[-1]))  # empty group
+        self.assertAllClose(exact_losses[:-1], graph_losses[:-1])
+
+
+class GroupMembershipTest(tf.test.TestCase):
+    """ Which evaluation groups the proteins of cached data count towards. """
+
+    def testUngroupedAndRepeatedProteinsExcluded(self):
+        c_train, c_eval = synthetic_configs(self.get_temp_dir(), groups=['30', '50', '70'])
+        ungrouped_file = os.path.join(self.get_temp_dir(), 'ungrouped')
+        write_shard(ungrouped_file, 5, 1, id_prefix='u', min_length=20, max_length=max_seq_length,
+                    length_distribution='uniform')
+        c_eval.io['data_files'].append(ungrouped_file)
+        c_eval.io['evaluation_sub_groups'] = groups = ['30', '50']
+        c_eval.queueing['cache_data'] = True
+
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+            m_train = RGNModel('training', c_train)
+            m_eval = RGNModel('evaluation', c_eval)
+
+            # group indices resolved on the host when the data is read
+            arrays = m_eval._cached_data
+            prefixes = [id_.split('#')[0] if '#' in id_ else None for id_ in arrays['ids']]
+            expected = [groups.index(prefix) if valid and prefix in groups else -1
+                        for prefix, valid in zip(prefixes, arrays['valid'])]
+            self.assertAllEqual(arrays['group_indices'], expected)
+            self.assertEqual(sorted(set(prefixes)), [None, '30', '50', '70'])
+            self.assertEqual(len(arrays['valid']) - sum(arrays['valid']), 2 * eval_batch_size - 35)  # repeats
+            memberships = np.concatenate([arrays['valid'][:, np.newaxis],
+                                          arrays['group_indices'][:, np.newaxis] == np.arange(len(groups))], 1)
+
+            # and the memberships that losses are reduced over, 'all' first
+            membership_node = graph.get_tensor_by_name('RGN/' + m_eval.config.io['name'] + '/group_memberships:0')
+            m_train.start([m_eval], sess, False)
+            try:
+                for batch in range(m_eval._data_ops['num_batches']):
+                    self.assertAllEqual(sess.run(membership_node),
+                                        memberships[batch * eval_batch_size:(batch + 1) * eval_batch_size])
+            finally:
+                m_train.finish(sess, save=False, close_session=False, reset_graph=False)
+
+        ungrouped = np.array([prefix not in groups for prefix in prefixes])
+        self.assertFalse(memberships[~arrays['valid']].any())  # repeats belong to no group, not even 'all'
+        self.assertFalse(memberships[ungrouped, 1:].any())
+        self.assertTrue(memberships[ungrouped & arrays['valid'], 0].all())
+
+
+class DiagnosticsTest(tf.test.TestCase):
+    """ Weight and gradient extrema and norms reduced on the device. """
+
+    def testReducedMatchFullValues(self):
+        c_train, _ = synthetic_configs(self.get_temp_dir())
+
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+            m_train = RGNModel('training', c_train)
+            m_train.start([], sess, False)
+            try:
+                m_train.train(sess, 2)
+                self.assertNotIn('weights', m_train.diagnose(sess))  # only scalars unless asked for
+                diagnostics = m_train.diagnose(sess, full=True)  # one run, so all of the same batch
+            finally:
+                m_train.finish(sess, save=False, close_session=False, reset_graph=False)
+
+        for kind, values in [('weight', diagnostics['weights']), ('grad', diagnostics['gradients'])]:
+            self.assertEqual(diagnostics['min_' + kind], min(np.min(value) for value in values))
+            self.assertEqual(diagnostics['max_' + kind], max(np.max(value) for value in values))
+            self.assertAllClose(diagnostics[kind + '_norm'], np.sqrt(sum(np.sum(np.square(value)) for value in values)),
+                                rtol=1e-5)
+
+
+class FusedDiagnosticsTest(tf.test.TestCase):
+    """ Diagnostics fetched along with a training step. """
+
+    def testWeightsReadAfterUpdate(self):
+        c_train, _ = synthetic_configs(self.get_temp_dir())
+        c_train.curriculum.update({'mode': 'loss', 'behavior': 'fixed_rate'})
+
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+            m_train = RGNModel('training', c_train)
+            m_train.start([], sess, False)
+            try:
+                curriculum_step = [var for var in tf.global_variables() if var.op.name == 'RGN/curriculum_step'][0]
+                for _ in range(3):
+                    _, _, diagnostics = m_train.train_and_diagnose(sess)
+                    weights, step = sess.run([tf.trainable_variables(), curriculum_step])
+
+                    self.assertEqual(diagnostics['min_weight'], min(np.min(w) for w in weights))
+                    self.assertEqual(diagnostics['max_weight'], max(np.max(w) for w in weights))
+                    self.assertEqual(diagnostics['curriculum_step'], step)
+            finally:
+                m_train.finish(sess, save=False, close_session=False, reset_graph=False)
+
+
+class RollbackTest(tf.test.TestCase):
+    """ In-session recovery of training from a diverged model. """
+
+    def testRollbackAfterDeadGradient(self):
+        c_train, _ = synthetic_configs(self.get_temp_dir())
+        c_train.curriculum.update({'mode': 'loss', 'behavior': 'fixed_rate'})
+        configs = {'training': c_train, 'run': RunConfig(config={'predictionFrequency': 8})}
+        run_dir = os.path.join(self.get_temp_dir(), 'run')
+
+        def log_lines(step):
+            with open(os.path.join(run_dir, str(step // 8 + 1), 'error.log')) as f_:
+                return [int(line.split()[1]) for line in f_]
+
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+            models = {'training': RGNModel('training', c_train)}
+            models['training'].start([], sess, False)
+            try:
+                # train and log every other step, taking a snapshot at step 4 as if it were checkpointed
+                for step in range(1, 11):
+                    models['training'].train(sess)
+                    if step % 2 == 0:
+                        log_dir = os.path.join(run_dir, str(step // 8 + 1))
+                        if not os.path.exists(log_dir):
+                            os.makedirs(log_dir)
+                        with open(os.path.join(log_dir, 'error.log'), 'a') as f:
+                            f.write('Iteration: ' + str(step) + '\tTrain: 1.0\n')
+                    if step == 4:
+                        snapshot = models['training'].snapshot(sess, full=True)
+
+                # diverge, with the gradient reported dead
+                diverged_var = tf.trainable_variables()[0]
+                diverged_var.load(np.full(diverged_var.get_shape().as_list(), np.nan), sess)
+                diagnostics = {'min_grad': 0., 'max_grad': 0., 'wt_val_loss': {'min_tertiary_loss_achieved_all': 0.}}
+                self.assertRaises(DeadGradientError, check_diagnostics, configs, 10, diagnostics)
+                curriculum_step = [var for var in tf.global_variables() if var.op.name == 'RGN/curriculum_step'][0]
+                self.assertNotEqual(sess.run(curriculum_step), snapshot[curriculum_step])
+
+                # noinspection PyUnboundLocalVariable
+                global_step = roll_back(run_dir, configs, models, sess, snapshot)
+
+                self.assertEqual(global_step, 4)
+                for var, value in snapshot.iteritems():  # weights, optimizer slots, global and curriculum steps, etc.
+                    self.assertAllEqual(sess.run(var), value)
+                self.assertEqual(log_lines(4), [2, 4])
+                self.assertFalse(os.path.exists(os.path.join(run_dir, '2')))
+            finally:
+                models['training'].finish(sess, save=False, close_session=False, reset_graph=False)
+
+
+class GraphCacheTest(tf.test.TestCase):
+    """ Graphs cached by start and imported again by load_graph. """
+
+    def testExportedGraphBindsSameOps(self):
+        c_train, c_eval = synthetic_configs(self.get_temp_dir(), groups=['30', '50'])
+        c_eval.queueing['cache_data'] = True
+        c_eval.io['evaluation_sub_groups'] = ['30', '50']
+        prefix = os.path.join(self.get_temp_dir(), 'graphs', 'graph')
+
+        states, losses = [], []
+        for _ in range(2):  # first exports the graph, then imports it
+            with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+                cached_graph = RGNModel.load_graph(prefix)
+                m_train = RGNModel('training', c_train, cached_graph=cached_graph)
+                m_eval = RGNModel('evaluation', c_eval, cached_graph=cached_graph)
+                m_train.start([m_eval], sess, False, graph_cache_prefix=prefix)
+
+                try:
+                    states.append([_graph_elements_to_names(vars(model)[attr]) for model in [m_train, m_eval]
+                                   for attr in ['_training_ops', '_evaluation_ops', '_data_ops', '_global_step']
+                                   if attr in vars(model)])
+                    losses.append(m_eval.evaluate(sess))
+                finally:
+                    m_train.finish(sess, save=False, close_session=False, reset_graph=False)
+
+        self.assertEqual(states[0], states[1])
+        self.assertEqual(sorted(cached_graph[m_eval.config.io['name']]['_data_ops'].keys()),
+                         ['load_op', 'load_placeholders', 'num_batches', 'rewind_op'])  # data is read, not pickled
+        self.assertAllClose(losses[0]['tertiary_loss_all'], losses[1]['tertiary_loss_all'])
+        self.assertAllClose(losses[0]['tertiary_loss_30'], losses[1]['tertiary_loss_30'])
+
+
+class AsynchronousEvaluationTest(tf.test.TestCase):
+    """ Evaluation of a snapshot on a background thread while training carries on. """
+
+    def testSnapshotEvaluationMatchesSynchronous(self):
+        c_train, c_eval = synthetic_configs(self.get_temp_dir())
+        c_eval.queueing['cache_data'] = True
+
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+            m_train = RGNModel('training', c_train)
+            m_eval = RGNModel('evaluation', c_eval)
+            m_train.start([m_eval], sess, False)
+            try:
+                for _ in range(3):
+                    m_train.train(sess)
+                synchronous = m_eval.evaluate(sess)
+                snapshot = m_train.snapshot(sess)
+
+                # forward passes in the background while training advances, state updates on this thread
+                worker, results = BackgroundWorker(name='evaluator'), []
+                worker.submit(lambda: results.append(m_eval.evaluate(sess, snapshot=snapshot, update_state=False)))
+                for _ in range(3):
+                    m_train.train(sess)
+                worker.close()
+                asynchronous = m_eval.update_evaluation_state(sess, results[0])
+
+                self.assertEqual(m_train.current_step(sess, snapshot), 3)
+                self.assertEqual(m_train.current_step(sess), 6)
+                for key in ['tertiary_loss_all', 'min_tertiary_loss_achieved_all']:
+                    self.assertAllClose(asynchronous[key], synchronous[key])
+            finally:
+                m_train.finish(sess, save=False, close_session=False, reset_graph=False)
+
+
+class TrainingScheduleTest(tf.test.TestCase):
+    """ Several training steps taken between checks of the training loop. """
+
+    def testTrainAdvancesByNumSteps(self):
+        c_train, _ = synthetic_configs(self.get_temp_dir())
+
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+            m_train = RGNModel('training', c_train)
+            m_train.start([], sess, False)
+            try:
+                for num_steps in [1, 4, 3]:
+                    step = m_train.current_step(sess)
+                    global_step, _ = m_train.train(sess, num_steps)
+                    self.assertEqual(global_step, step + num_steps)
+                    self.assertEqual(m_train.current_step(sess), step + num_steps)
+            finally:
+                m_train.finish(sess, save=False, close_session=False, reset_graph=False)
+
+    def testChecksNeverSkipped(self):
+        configs = {'run': RunConfig(config={'evaluationFrequency': 30, 'predictionFrequency': 50,
+                                            'checkpointFrequency': 70, 'stepsBetweenChecks': 25})}
+
+        for trace_frequency in [None, 9]:
+            steps, step = [], 0
+            while step < 500:
+                num_steps = steps_to_next_check(configs, step, trace_frequency)
+                self.assertTrue(1 <= num_steps <= 25)
+                step += num_steps
+                steps.append(step)
+
+            frequencies = [frequency for frequency in [30, 50, 70, trace_frequency] if frequency is not None]
+            scheduled = [step for step in range(1, 501) if any(step % frequency == 0 for frequency in frequencies)]
+            self.assertEqual(sorted(set(scheduled) - set(steps)), [])
+
+
+class EnsembleTest(tf.test.TestCase):
+    """ Consensus structures predicted by ensembles of checkpoints. """
+
+    def testSingleMemberMatchesPredict(self):
+        c_train, c_eval = synthetic_configs(self.get_temp_dir())
+        c_eval.queueing['cache_data'] = True
+        c_eval.io['ensemble_prediction'] = True
+
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+            m_train = RGNModel('training', c_train)
+            m_eval = RGNModel('evaluation', c_eval)
+            m_train.start([m_eval], sess, False)
+            try:
+                m_train.train(sess, 2)
+                checkpoint = m_train.save(sess)
+                m_train.train(sess, 2)  # so that the members' weights aren't the session's own
+
+                ensembles = [m_train.load_ensemble(sess, [checkpoint]), m_train.load_ensemble(sess, [checkpoint] * 2)]
+
+                # predictions of the checkpoint itself, after which the session's own weights are put back
+                snapshot = m_train.snapshot(sess, full=True)
+                # noinspection PyProtectedMember
+                m_train._restore(sess, checkpoint, training_state=False)
+                # noinspection PyProtectedMember
+                rewind_op = m_eval._data_ops['rewind_op']
+                sess.run(rewind_op)
+                predictions = m_eval.predict(sess)
+                m_train.restore_snapshot(sess, snapshot)
+
+                for ensemble in ensembles:
+                    sess.run(rewind_op)
+                    ensemble_predictions = m_eval.predict_ensemble(sess, ensemble)
+                    self.assertEqual(sorted(ensemble_predictions.keys()), sorted(predictions.keys()))
+                    for id_, prediction in predictions.iteritems():
+                        for output in ['tertiary'] + ['tertiary_' + str(i) for i in range(len(ensemble))]:
+                            self.assertAllClose(ensemble_predictions[id_][output], prediction['tertiary'],
+                                                rtol=1e-4, atol=0.1)
+            finally:
+                m_train.finish(sess, save=False, close_session=False, reset_graph=False)
+
+    def testConsensusIsCircularMean(self):
+        config = {'num_reconstruction_fragments': 6, 'num_reconstruction_parallel_iters': 4}
+        member_dihedrals = npr.uniform(-np.pi, np.pi, [2, 12, 3, 3]).astype('float32')
+        mean_dihedrals = np.arctan2(np.sin(member_dihedrals).mean(0), np.cos(member_dihedrals).mean(0))
+
+        with self.test_session() as sess:
+            consensus, expected = sess.run([_ensemble_coordinates(config, tf.constant(member_dihedrals)),
+                                            _coordinates(config, tf.constant(mean_dihedrals))])
+
+        self.assertAllClose(consensus, expected, rtol=1e-4, atol=0.1)  # coordinates are in picometers
+
+
+class PipelineHealthTest(tf.test.TestCase):
+    """ Throughput and dequeue waits of the training input pipeline. """
+
+    def testDequeueWaitAndLog(self):
+        c_train, _ = synthetic_configs(self.get_temp_dir())
+        log_file = os.path.join(self.get_temp_dir(), PIPELINE_LOG_FILENAME)
+
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+            models = {'training': RGNModel('training', c_train)}
+            models['training'].start([], sess, False)
+            try:
+                last_health = pipeline_health(models, sess)
+                for step in range(1, 4):
+                    models['training'].train(sess)
+                    health = pipeline_health(models, sess)
+                    self.assertEqual(health['dequeues'], step)
+                    self.assertGreaterEqual(health['dequeue_wait'], last_health['dequeue_wait'])
+                    log_pipeline_health(log_file, step, health, last_health)
+                    last_health = health
+            finally:
+                models['training'].finish(sess, save=False, close_session=False, reset_graph=False)
+
+        with open(log_file) as f:
+            lines = f.readlines()
+        self.assertEqual([int(line.split()[1]) for line in lines], [1, 2, 3])
+        self.assertTrue(all('Dequeue Wait: ' in line and 'Dequeue Wait: -' not in line for line in lines))
+
+
+class ExactEvaluationTest(tf.test.TestCase):
+    """ Exact evaluation of every protein of a set, with summaries and per-protein logs. """
+
+    def testSummariesAndDrmsdLog(self):
+        c_train, c_eval = synthetic_configs(self.get_temp_dir())
+        logs_dir = os.path.join(self.get_temp_dir(), 'logs')
+        for config in [c_train, c_eval]:
+            config.io.update({'log_model_summaries': True, 'detailed_logs': True, 'logs_directory': logs_dir})
+        c_eval.queueing.update({'cache_data': True, 'exact_evaluation': True})
+        c_eval.optimization['num_epochs'] = 1  # so that dequeuing a batch more than the set has fails
+        log_file = os.path.join(self.get_temp_dir(), 'error.log')
+
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+            models = {'training': RGNModel('training', c_train), 'eval_wt_test': RGNModel('evaluation', c_eval)}
+            configs = {'run': RunConfig(config={'includeWeightedTesting': True}), 'training': models['training'].config,
+                       'eval_wt_test': models['eval_wt_test'].config}  # as named by the models
+            models['training'].start([models['eval_wt_test']], sess, False)
+            try:
+                for _ in range(2):
+                    evaluation = models['eval_wt_test'].evaluate(sess)
+                    self.assertEqual(sorted(evaluation['ids']), sorted(set(evaluation['ids'])))
+                    self.assertEqual(len(evaluation['drmsds']), 30)
+                evaluate_and_log(log_file, configs, models, sess)
+            finally:
+                models['training'].finish(sess, save=False, close_session=False, reset_graph=False)
+
+        tags = [value.tag for events_file in glob(os.path.join(logs_dir, 'events.*'))
+                for event in tf.train.summary_iterator(events_file) for value in event.summary.value]
+        self.assertTrue(any('drmsds' in tag for tag in tags))
+        with open(log_file + '.drmsds') as f:
+            entries = [line.rstrip('\n').split('\t') for line in f]
+        self.assertEqual(sorted(entry[2] for entry in entries), sorted(evaluation['ids']))
+        self.assertTrue(all(entry[1] == 'Test' and float(entry[3]) >= 0 for entry in entries))
+
+
+class TimingReportTest(tf.test.TestCase):
+    """ Reports of the time spent in nested timed blocks, possibly on several threads. """
+
+    def testNestedBlocksAcrossThreads(self):
+        report_file = os.path.join(self.get_temp_dir(), 'timings', 'startup.log')
+        write_timing_report(os.path.join(self.get_temp_dir(), 'earlier.log'), '', '')  # clears earlier timings
+
+        def stage(label):
+            with timed(label):
+                time.sleep(0.01)
+
+        with timed('outer'):
+            worker = BackgroundWorker(name='timed')
+            for _ in range(2):
+                worker.submit(stage, 'background')  # not a stage of outer, which only this thread is in
+                stage('inner')
+            worker.close()
+        write_timing_report(report_file, 'startup', 'total')
+
+        with open(report_file) as f:
+            lines = f.read().split('\n')
+        self.assertEqual(lines[0], 'startup')
+        labels = [line.split('s  ', 1)[1] for line in lines[1:5]]
+        self.assertEqual(labels[0], 'outer')
+        self.assertEqual(sorted(labels[1:3]), ['    inner (x2)', 'background (x2)'])  # in order of first entry
+        self.assertEqual(labels[3], 'total')
+        self.assertGreaterEqual(float(lines[1].split('s  ')[0]), 0.02)
+        self.assertEqual(lines[5:], ['', ''])
+
+
+class BenchmarksTest(tf.test.TestCase):
+    """ Benchmarks of hot paths, checked for timing what they're named after. """
+
+    def testWeightingMatrixRunsMatrix(self):
+        class RecordingSession(object):
+            """ Session that records the fetches of the callables it makes """
+            def __init__(self, session):
+                self.session, self.fetches = session, []
+
+            def make_callable(self, fetches, **kwargs):
+                self.fetches.append(fetches)
+                return self.session.make_callable(fetches, **kwargs)
+
+            def run(self, *args, **kwargs):
+                return self.session.run(*args, **kwargs)
+
+        with tf.Graph().as_default() as graph, tf.Session(graph=graph) as sess:
+            session = RecordingSession(sess)
+            run, _, _ = benchmark_weighting_matrix(session, self.get_temp_dir(), 20)
+            run()
+
+            # the fetched matrix is computed from the variable base at every run, rather than folded into a constant
+            matrix = session.fetches[0].outputs[0]
+            base = tf.global_variables()[0]
+            matrices = []
+            for value in [20., 10.]:
+                base.load(value, sess)
+                matrices.append(sess.run(matrix))
+            self.assertEqual(matrices[0].shape, (20, 20))
+            self.assertFalse(np.array_equal(matrices[0], matrices[1]))
+
+        result = run_benchmark('weighting_matrix', {'length': 20}, 0., 2, 1)
+        self.assertEqual((result['runs'], result['unit']), (2, 'matrices/s'))
+        self.assertGreater(result['throughput'], 0)
+
+
 if __name__ == "__main__":
     tf.test.main()
@@ -2,6 +2,15 @@ __author__ = "Mohammed AlQuraishi"
 __copyright__ = "Copyright 2018, Harvard Medical School"
 __license__ = "MIT"
 
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from Queue import Queue
+
 import numpy as np
 import tensorflow as tf
 
@@ -31,6 +40,139 @@ class Switch(object):
             return False
 
 
+class BackgroundWorker(object):
+    """
+    Runs submitted jobs in submission order on a separate daemon thread.
+
+    The job queue is bounded, so that submit blocks when the worker falls behind instead of accumulating
+    unbounded amounts of pending work. If a job fails, its exception is re-raised in the submitting thread
+    on the next call to submit, join, or close, and all jobs submitted in the meantime are dropped.
+    """
+
+    def __init__(self, capacity=1, name=None):
+        self._queue = Queue(maxsize=capacity)
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                elif self._exc_info is None:
+                    func, args, kwargs = job
+                    func(*args, **kwargs)
+            except Exception:
+                self._exc_info = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _reraise(self):
+        if self._exc_info is not None:
+            exc_type, exc_value, exc_traceback = self._exc_info
+            self._exc_info = None
+            raise exc_type, exc_value, exc_traceback
+
+    def submit(self, func, *args, **kwargs):
+        """Queues func(*args, **kwargs) for execution, blocking if the queue is full"""
+        self._reraise()
+        self._queue.put((func, args, kwargs))
+
+    def join(self, reraise=True):
+        """Blocks until all submitted jobs are done, discarding any failure if reraise is False"""
+        self._queue.join()
+        if reraise:
+            self._reraise()
+        else:
+            self._exc_info = None
+
+    def close(self, reraise=True):
+        """Finishes all submitted jobs and stops the worker thread, discarding any failure if reraise is False"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if reraise:
+            self._reraise()
+        else:
+            self._exc_info = None
+
+
+class _TimedPath(threading.local):
+    """ Labels of the timed blocks currently being executed by a thread, outermost first """
+    def __init__(self):
+        self.labels = []
+
+
+_timings = OrderedDict()  # maps paths of nested timed labels to [total seconds, number of calls]
+_timing_start = [None]  # wall time at which the first recorded block was entered
+_timing_lock = threading.Lock()  # guards the two above, which are shared by all threads
+_timed_path = _TimedPath()
+
+
+@contextmanager
+def timed(label):
+    """
+    Context manager that records the wall time spent in its block under label, for write_timing_report.
+
+    Blocks entered within other blocks of the same thread are recorded as stages of them, and repeated blocks with
+    the same label (and enclosing blocks) are accumulated, also across threads.
+    """
+    _timed_path.labels.append(label)
+    path = tuple(_timed_path.labels)
+    with _timing_lock:
+        timing = _timings.setdefault(path, [0., 0])
+        if _timing_start[0] is None:
+            _timing_start[0] = time.time()
+    start = time.time()
+    try:
+        yield
+    finally:
+        with _timing_lock:
+            timing[0] += time.time() - start
+            timing[1] += 1
+        _timed_path.labels.pop()
+
+
+def timed_calls(label):
+    """
+    Decorator that records the wall time spent in calls of the decorated function under label, like timed.
+    """
+    def decorator(func):
+        @wraps(func)
+        def timed_func(*args, **kwargs):
+            with timed(label):
+                return func(*args, **kwargs)
+        return timed_func
+    return decorator
+
+
+def write_timing_report(filename, title, total_label):
+    """
+    Appends a report of all blocks timed so far to filename, with stages indented under their enclosing blocks,
+    followed by the wall time elapsed since the first block, and clears the timings.
+    """
+    with _timing_lock:
+        timings = [(path, list(timing)) for path, timing in _timings.iteritems()]
+        timing_start = _timing_start[0]
+        _timings.clear()
+        _timing_start[0] = None
+
+    lines = [title]
+    for path, (seconds, calls) in timings:
+        lines.append('{:10.3f}s  {}{}{}'.format(seconds, '    ' * (len(path) - 1), path[-1],
+                                               ' (x{})'.format(calls) if calls > 1 else ''))
+    if timing_start is not None:
+        lines.append('{:10.3f}s  {}'.format(time.time() - timing_start, total_label))
+
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'a') as file_:
+        file_.write('\n'.join(lines) + '\n\n')
+
+
 def merge_two_dicts(x, y):
     """
     Efficiently merges two dicts, giving precedence to second dict.
@@ -50,19 +192,31 @@ def merge_dicts(*dict_args):
     return result
 
 
-def ops_to_dict(session, ops):
+def ops_to_dict(session, ops, feed_dict=None, options=None, run_metadata=None):
     """
     Helper function that converts canonical dict of TF ops to an actual dict. Runs ops first.
     """
-    dict_ = dict(zip(ops.keys(), session.run(ops.values())))
+    dict_ = dict(zip(ops.keys(), session.run(ops.values(), feed_dict=feed_dict, options=options,
+                                             run_metadata=run_metadata)))
     return dict_
 
 
+def ops_to_callable(session, ops):
+    """
+    Helper function that precompiles a canonical dict of TF ops into a callable which, like ops_to_dict, runs the
+    ops and returns an actual dict, but without the overhead of preparing the fetches on every call.
+    The callable optionally takes RunOptions and RunMetadata, as options and run_metadata.
+    """
+    keys = ops.keys()
+    callable_ = session.make_callable([ops[key] for key in keys], accept_options=True)
+    return lambda **kwargs: dict(zip(keys, callable_(**kwargs)))
+
+
 def cum_quantile_positions(weights, quantiles=np.linspace(0.25, 0.99, 4)):
     """
     Computes cumulative quantiles from curriculum weights.
     """
-    if weights:
+    if len(weights) > 0:
         return [next(x[0] + 1 for x in enumerate(np.cumsum(weights / sum(weights))) if x[1] > p) for p in quantiles]
     else:
         return []